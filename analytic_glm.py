@@ -0,0 +1,483 @@
+""" Closed form evaluation of the GLM log probability, its gradient, and its
+    Hessian with NumPy. For the exponential and exp-linear nonlinearities the
+    derivatives of the Poisson log likelihood with respect to the linear
+    predictor u are simple functions of u, so the gradient is Z^T g and the
+    Hessian is Z^T diag(h) Z for the design matrix Z = [1, stim, ir]. Only
+    BLAS products over the data are required, and nothing is compiled.
+"""
+import numpy as np
+import scipy.linalg
+import scipy.special
+
+from components.bias import ConstantBias
+from components.bkgd import NoStimulus, BasisStimulus
+from components.impulse import LinearBasisImpulses, NormalizedBasisImpulses
+from components.nlin import ExpNonlinearity, ExpLinearNonlinearity
+from utils.theano_func_wrapper import compile_expr
+
+class AnalyticGlm:
+    """ Evaluate the log probability of the n-th GLM, and its derivatives with
+        respect to the differentiable GLM parameters, for a dictionary of
+        variables of the form returned by Population.extract_vars. The
+        parameters are ordered as in packdict.
+    """
+    def __init__(self, population, chunk_sz=10000):
+        glm = population.glm
+        self.glm = glm
+        self.chunk_sz = chunk_sz
+
+        if not isinstance(glm.nlin_model, (ExpNonlinearity,
+                                           ExpLinearNonlinearity)):
+            raise Exception("The analytic engine does not support the %s "
+                            "nonlinearity" % glm.nlin_model.__class__.__name__)
+
+        # One block of parameters for each component, in sorted order of the
+        # component name to match the order of packdict.
+        blocks = [('bias', create_bias_block(glm.bias_model)),
+                  ('bkgd', create_bkgd_block(glm.bkgd_model, chunk_sz)),
+                  ('imp', create_imp_block(glm.imp_model, chunk_sz))]
+        self.blocks = [b for (_,b) in sorted(blocks, key=lambda t: t[0])
+                       if b is not None]
+
+        # The effective weights only depend on the network variables
+        net = population.network
+        self.f_W_eff = compile_expr(net.graph.A * net.weights.W,
+                                    population.get_variables()['net'])
+
+    def _predictor(self, x):
+        """ Compute the linear predictor of the GLM, along with the quantities
+            needed for its derivatives.
+        """
+        n = x['glm']['n']
+        W_n = np.asarray(self.f_W_eff(x['net']))[:,n]
+        thetas = [b.params(x['glm']) for b in self.blocks]
+
+        u = 0.0
+        for (b,theta) in zip(self.blocks, thetas):
+            u = u + b.current(theta, W_n)
+
+        S_n = self.glm.spike_counts(n)
+        dt = self.glm.bin_widths()
+        return u, S_n, dt, thetas, W_n
+
+    def _ll(self, u, S_n, dt):
+        lam = self.glm.nlin_model.f_nlin(u)
+        return np.sum(-dt*lam + np.log(lam)*S_n)
+
+    def _ll_derivs(self, u, S_n, dt):
+        """ First and second derivatives of the log likelihood with respect
+            to the linear predictor in each time bin.
+        """
+        nlin = self.glm.nlin_model
+        lam = nlin.f_nlin(u)
+        dlam = nlin.f_grad_nlin(u)
+        g = dlam * (S_n/lam - dt)
+        h = nlin.f_hess_nlin(u) * (S_n/lam - dt) - S_n * (dlam/lam)**2
+        return g, h
+
+    def _log_prior(self, thetas):
+        return sum([b.log_prior(theta) for (b,theta) in zip(self.blocks, thetas)])
+
+    def _grad(self, thetas, W_n, g):
+        """ Chain the gradient with respect to the predictor through the
+            design matrix and the Jacobian of each block.
+        """
+        grads = []
+        for (b,theta) in zip(self.blocks, thetas):
+            c = b.design_T_dot(g)
+            grads.append(b.jacobian_dot(theta, W_n, c) +
+                         b.grad_log_prior(theta))
+        return np.concatenate(grads)
+
+    def ll(self, x):
+        """ Compute the log likelihood of the GLM
+        """
+        u, S_n, dt, _, _ = self._predictor(x)
+        return self._ll(u, S_n, dt)
+
+    def log_p(self, x):
+        """ Compute the log likelihood plus the log prior of the GLM
+        """
+        u, S_n, dt, thetas, _ = self._predictor(x)
+        return self._ll(u, S_n, dt) + self._log_prior(thetas)
+
+    def grad_log_p(self, x):
+        """ Compute the gradient of the log probability
+        """
+        return self.log_p_and_grad(x)[1]
+
+    def log_p_and_grad(self, x):
+        """ Compute the log probability and its gradient from a single
+            evaluation of the linear predictor
+        """
+        u, S_n, dt, thetas, W_n = self._predictor(x)
+        g, _ = self._ll_derivs(u, S_n, dt)
+        lp = self._ll(u, S_n, dt) + self._log_prior(thetas)
+        return lp, self._grad(thetas, W_n, g)
+
+    def hessian_log_p(self, x):
+        """ Compute the Hessian of the log probability one block of parameters
+            at a time. Each block of the Hessian with respect to the raw
+            design is a single weighted Gram product Z_a^T diag(h) Z_b, which
+            is then mapped through the Jacobians of the two blocks. The
+            curvature of the nonlinear parameterizations and the priors only
+            enter the diagonal blocks.
+        """
+        u, S_n, dt, thetas, W_n = self._predictor(x)
+        g, h = self._ll_derivs(u, S_n, dt)
+
+        K = len(self.blocks)
+        H = [[None]*K for _ in np.arange(K)]
+        for a in np.arange(K):
+            (ba, ta) = (self.blocks[a], thetas[a])
+            for b in np.arange(a, K):
+                (bb, tb) = (self.blocks[b], thetas[b])
+                G = ba.weighted_gram(h, bb, self.chunk_sz)
+                # The Jacobians are symmetric
+                H_ab = ba.jacobian_dot(ta, W_n, bb.jacobian_dot(tb, W_n, G.T).T)
+                if a == b:
+                    H_ab += ba.curvature(ta, W_n, ba.design_T_dot(g)) + \
+                            ba.hess_log_prior(ta)
+                H[a][b] = H_ab
+                H[b][a] = H_ab.T
+
+        return np.vstack([np.hstack(row) for row in H])
+
+    def hessian_vector_product(self, x, v):
+        """ Compute the product of the Hessian of the log probability with a
+            vector v without forming the Hessian: J^T Z^T diag(h) Z J v plus
+            the curvature and prior terms, at the cost of two passes over
+            the design.
+        """
+        u, S_n, dt, thetas, W_n = self._predictor(x)
+        g, h = self._ll_derivs(u, S_n, dt)
+        vs = np.split(v, np.cumsum([b.size for b in self.blocks])[:-1])
+
+        z = 0.0
+        for (b,theta,v_b) in zip(self.blocks, thetas, vs):
+            z = z + b.design_dot(b.jacobian_dot(theta, W_n, v_b))
+        hz = h*z
+
+        Hv = []
+        for (b,theta,v_b) in zip(self.blocks, thetas, vs):
+            Hv.append(b.jacobian_dot(theta, W_n, b.design_T_dot(hz)) +
+                      b.curvature_dot(theta, W_n, b.design_T_dot(g), v_b) +
+                      b.hess_log_prior_dot(theta, v_b))
+        return np.concatenate(Hv)
+
+def supports(glm):
+    """ Check whether the components of the GLM are supported by the
+        closed form engine.
+    """
+    if not isinstance(glm.nlin_model, (ExpNonlinearity,
+                                       ExpLinearNonlinearity)):
+        return False
+    if not isinstance(glm.bias_model, ConstantBias):
+        return False
+    if not isinstance(glm.bkgd_model, (NoStimulus, BasisStimulus)):
+        return False
+    if isinstance(glm.imp_model, NormalizedBasisImpulses):
+        return True
+    return isinstance(glm.imp_model, LinearBasisImpulses) and \
+           hasattr(glm.imp_model.prior, 'f_hess_log_p_dot')
+
+def create_bias_block(bias_model):
+    if isinstance(bias_model, ConstantBias):
+        return BiasBlock(bias_model)
+    raise Exception("The analytic engine does not support the %s bias" %
+                    bias_model.__class__.__name__)
+
+def create_bkgd_block(bkgd_model, chunk_sz):
+    if isinstance(bkgd_model, NoStimulus):
+        return None
+    elif isinstance(bkgd_model, BasisStimulus):
+        return StimulusBlock(bkgd_model, chunk_sz)
+    raise Exception("The analytic engine does not support the %s background" %
+                    bkgd_model.__class__.__name__)
+
+def create_imp_block(imp_model, chunk_sz):
+    if isinstance(imp_model, LinearBasisImpulses):
+        return LinearImpulseBlock(imp_model, chunk_sz)
+    elif isinstance(imp_model, NormalizedBasisImpulses):
+        return NormalizedImpulseBlock(imp_model, chunk_sz)
+    raise Exception("The analytic engine does not support %s" %
+                    imp_model.__class__.__name__)
+
+class ParameterBlock:
+    """ A block of parameters whose contribution to the linear predictor is
+        Z f(theta) for a raw design matrix Z. The Jacobian J of f is applied
+        by jacobian_dot, and the second order term sum_t g_t d^2 u_t/dtheta^2
+        is returned by curvature given c = Z^T g. All the Jacobians are
+        symmetric, so jacobian_dot also applies J^T.
+    """
+    def params(self, xg):
+        return xg[self.component][self.name]
+
+    def design_dot(self, v):
+        return self.design(0, None).dot(v)
+
+    def weighted_gram(self, h, other, chunk_sz):
+        """ Compute Z_self^T diag(h) Z_other, accumulated over chunks of
+            time bins so that the weighted design is never held in memory.
+        """
+        G = np.zeros((self.size, other.size))
+        for start in np.arange(0, len(h), chunk_sz):
+            stop = min(start + chunk_sz, len(h))
+            G += np.dot(self.design(start, stop).T,
+                        h[start:stop,None] * other.design(start, stop))
+        return G
+
+    def jacobian_dot(self, theta, W_n, M):
+        return M
+
+    def curvature(self, theta, W_n, c):
+        return np.zeros((self.size, self.size))
+
+    def curvature_dot(self, theta, W_n, c, v):
+        return np.zeros_like(v)
+
+class BiasBlock(ParameterBlock):
+    def __init__(self, bias_model):
+        self.model = bias_model
+        self.component = 'bias'
+        self.name = str(bias_model.bias)
+        self.size = 1
+
+    def current(self, theta, W_n):
+        return theta[0]
+
+    def design(self, start, stop):
+        return np.ones((stop-start, 1))
+
+    def design_dot(self, v):
+        return v[0]
+
+    def design_T_dot(self, g):
+        return np.array([np.sum(g)])
+
+    def weighted_gram(self, h, other, chunk_sz):
+        # The design is a column of ones
+        return np.reshape(other.design_T_dot(h), (1, other.size))
+
+    def log_prior(self, theta):
+        return -0.5/self.model.sig_bias**2 * (theta[0] - self.model.mu_bias)**2
+
+    def grad_log_prior(self, theta):
+        return -1.0/self.model.sig_bias**2 * (theta - self.model.mu_bias)
+
+    def hess_log_prior(self, theta):
+        return -1.0/self.model.sig_bias**2 * np.eye(1)
+
+    def hess_log_prior_dot(self, theta, v):
+        return -1.0/self.model.sig_bias**2 * v
+
+class StimulusBlock(ParameterBlock):
+    """ The stimulus currents are the filtered stimulus projected onto the
+        weights. If the stimulus is filtered at the resolution of the
+        stimulus frames, the rows of the design are the frames of the time
+        bins, and products with the design are taken at frame resolution.
+        The products are taken over chunks of rows, so that a single
+        precision stimulus is only promoted to double precision one chunk
+        at a time.
+    """
+    def __init__(self, bkgd_model, chunk_sz):
+        self.model = bkgd_model
+        self.component = 'bkgd'
+        self.name = str(bkgd_model.w_stim)
+        self.size = bkgd_model.n_vars
+        self.chunk_sz = chunk_sz
+
+    def _stim(self):
+        return self.model.stim.get_value(borrow=True)
+
+    def _index(self):
+        if self.model.resolution == 'stim':
+            return self.model.stim_index.get_value(borrow=True)
+        return None
+
+    def _frame_sum(self, g):
+        # Sum a vector over the time bins of each frame
+        return np.bincount(self._index(), weights=g,
+                           minlength=self._stim().shape[0])
+
+    def _chunks(self, nT):
+        return [(start, min(start + self.chunk_sz, nT))
+                for start in np.arange(0, nT, self.chunk_sz)]
+
+    def _stim_T_dot(self, g):
+        stim = self._stim()
+        c = np.zeros(self.size)
+        for (start, stop) in self._chunks(stim.shape[0]):
+            c += np.dot(stim[start:stop].T, g[start:stop])
+        return c
+
+    def current(self, theta, W_n):
+        stim = self._stim()
+        I = np.empty(stim.shape[0])
+        for (start, stop) in self._chunks(stim.shape[0]):
+            I[start:stop] = np.dot(stim[start:stop], theta)
+        if self._index() is None:
+            return I
+        return I[self._index()]
+
+    def design(self, start, stop):
+        if self._index() is None:
+            return self._stim()[start:stop,:]
+        return self._stim()[self._index()[start:stop],:]
+
+    def design_dot(self, v):
+        return self.current(v, None)
+
+    def design_T_dot(self, g):
+        if self._index() is None:
+            return self._stim_T_dot(g)
+        return self._stim_T_dot(self._frame_sum(g))
+
+    def weighted_gram(self, h, other, chunk_sz):
+        if self._index() is None or other is not self:
+            return ParameterBlock.weighted_gram(self, h, other, chunk_sz)
+        stim = self._stim()
+        h_frames = self._frame_sum(h)
+        G = np.zeros((self.size, self.size))
+        for (start, stop) in self._chunks(stim.shape[0]):
+            G += np.dot(stim[start:stop].T,
+                        h_frames[start:stop,None] * stim[start:stop])
+        return G
+
+    def log_prior(self, theta):
+        return np.sum(-0.5/self.model.sig_w_stim**2 * theta**2)
+
+    def grad_log_prior(self, theta):
+        return -1.0/self.model.sig_w_stim**2 * theta
+
+    def hess_log_prior(self, theta):
+        return -1.0/self.model.sig_w_stim**2 * np.eye(self.size)
+
+    def hess_log_prior_dot(self, theta, v):
+        return -1.0/self.model.sig_w_stim**2 * v
+
+class LinearImpulseBlock(ParameterBlock):
+    """ The impulse currents are the filtered spike trains of each
+        presynaptic neuron projected onto the basis weights, scaled by the
+        effective weight of the connection. The filtered spike trains may be
+        memory mapped, so products with the design are reduced over chunks
+        of time bins and only one chunk is read into memory at a time.
+    """
+    def __init__(self, imp_model, chunk_sz):
+        self.model = imp_model
+        self.component = 'imp'
+        self.name = str(imp_model.w_ir)
+        self.N = imp_model.N
+        self.B = imp_model.B
+        self.size = self.N*self.B
+        self.chunk_sz = chunk_sz
+
+    def _ir(self):
+        ir = self.model.ir.get_value(borrow=True)
+        return np.reshape(ir, (ir.shape[0], self.size))
+
+    def _chunks(self, nT):
+        return [(start, min(start + self.chunk_sz, nT))
+                for start in np.arange(0, nT, self.chunk_sz)]
+
+    def weights(self, theta):
+        return theta
+
+    def current(self, theta, W_n):
+        return self.design_dot(np.repeat(W_n, self.B) * self.weights(theta))
+
+    def design(self, start, stop):
+        return self._ir()[start:stop,:]
+
+    def design_dot(self, v):
+        ir = self._ir()
+        u = np.empty(ir.shape[0])
+        for (start, stop) in self._chunks(ir.shape[0]):
+            u[start:stop] = np.dot(ir[start:stop], v)
+        return u
+
+    def design_T_dot(self, g):
+        ir = self._ir()
+        c = np.zeros(self.size)
+        for (start, stop) in self._chunks(ir.shape[0]):
+            c += np.dot(ir[start:stop].T, g[start:stop])
+        return c
+
+    def jacobian_dot(self, theta, W_n, M):
+        W_rep = np.repeat(W_n, self.B)
+        return np.reshape(W_rep, (-1,) + (1,)*(M.ndim-1)) * M
+
+    def log_prior(self, theta):
+        return self.model.prior.f_log_p(np.reshape(theta, (self.N,self.B)))
+
+    def grad_log_prior(self, theta):
+        return self.model.prior.f_grad_log_p(np.reshape(theta, (self.N,self.B)))
+
+    def hess_log_prior(self, theta):
+        return self.model.prior.f_hess_log_p(np.reshape(theta, (self.N,self.B)))
+
+    def hess_log_prior_dot(self, theta, v):
+        return self.model.prior.f_hess_log_p_dot(np.reshape(theta, (self.N,self.B)), v)
+
+class NormalizedImpulseBlock(LinearImpulseBlock):
+    """ The basis weights of each connection are the softmax of the log
+        gammas, so the Jacobian is block diagonal with blocks
+        diag(w) - w w^T, and the predictor has curvature in the log gammas.
+    """
+    def __init__(self, imp_model, chunk_sz):
+        self.model = imp_model
+        self.component = 'imp'
+        self.name = str(imp_model.lng)
+        self.N = imp_model.N
+        self.B = imp_model.B
+        self.size = self.N*self.B
+        self.chunk_sz = chunk_sz
+
+    def _softmax(self, theta):
+        g = np.exp(np.reshape(theta, (self.N,self.B)))
+        return g / np.sum(g, axis=1)[:,None]
+
+    def weights(self, theta):
+        return self._softmax(theta).ravel()
+
+    def jacobian_dot(self, theta, W_n, M):
+        w = self._softmax(theta)[:,:,None]
+        M3 = np.reshape(M, (self.N, self.B, -1))
+        JM = w*M3 - w*np.sum(w*M3, axis=1)[:,None,:]
+        return np.reshape(W_n[:,None,None]*JM, M.shape)
+
+    def curvature(self, theta, W_n, c):
+        w = self._softmax(theta)
+        c = np.reshape(c, (self.N,self.B))
+        blocks = []
+        for j in np.arange(self.N):
+            cw = c[j]*w[j]
+            cbar = np.sum(cw)
+            M = np.diag(cw - cbar*w[j]) - np.outer(cw, w[j]) - \
+                np.outer(w[j], cw) + 2.0*cbar*np.outer(w[j], w[j])
+            blocks.append(W_n[j] * M)
+        return scipy.linalg.block_diag(*blocks)
+
+    def curvature_dot(self, theta, W_n, c, v):
+        w = self._softmax(theta)
+        cw = np.reshape(c, (self.N,self.B))*w
+        cbar = np.sum(cw, axis=1)[:,None]
+        v = np.reshape(v, (self.N,self.B))
+        wv = np.sum(w*v, axis=1)[:,None]
+        cwv = np.sum(cw*v, axis=1)[:,None]
+        Mv = (cw - cbar*w)*v - cw*wv - w*cwv + 2.0*cbar*w*wv
+        return np.ravel(W_n[:,None]*Mv)
+
+    def log_prior(self, theta):
+        alpha = self.model.alpha
+        return -self.size*scipy.special.gammaln(alpha) + \
+               np.sum((alpha-2.0)*np.exp(theta))
+
+    def grad_log_prior(self, theta):
+        return (self.model.alpha-2.0)*np.exp(theta)
+
+    def hess_log_prior(self, theta):
+        return np.diag((self.model.alpha-2.0)*np.exp(theta))
+
+    def hess_log_prior_dot(self, theta, v):
+        return (self.model.alpha-2.0)*np.exp(theta)*v
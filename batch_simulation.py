@@ -0,0 +1,180 @@
+""" Simulate many trials of a population over a pool of processes. Each
+    trial either reuses the same network parameters or samples its own, and
+    gets its own stimulus and spikes. The random numbers of the k-th trial
+    are drawn from a stream seeded with [seed, 0, k], so every trial is
+    reproducible and independent of the others, no matter which process
+    simulates it or in what order. Parameters shared by all trials are drawn
+    from the stream seeded with [seed, 1, 0]. The keys have the same length
+    so that the streams never coincide; numpy maps some keys of different
+    lengths to the same stream.
+
+    The trials are written to a single dataset of trials (see
+    utils.dataset) as they finish. Each trial is a dataset like those of
+    test.generate_synth_data, so it can be loaded on its own.
+"""
+import os
+import cPickle
+import multiprocessing
+
+import numpy as np
+import scipy.sparse
+
+from population import Population
+from models.model_factory import check_stability
+from utils.dataset import save_dataset, save_trial
+
+# The population simulated by this process and the parameters of the batch.
+# They are set before the worker processes are forked, which inherit them.
+_popn = None
+_x = None
+_prms = None
+
+def trial_seed(seed, k):
+    """ Seed of the random stream of the k-th trial
+    """
+    return [seed, 0, k]
+
+def network_seed(seed):
+    """ Seed of the random stream of the parameters shared by all trials
+    """
+    return [seed, 1, 0]
+
+def simulate_trials(model, T_stop, path, n_trials, x=None, resample=False,
+                    seed=0, n_workers=None, dt=0.001, dt_stim=0.1, D_stim=1,
+                    save_currents=False):
+    """ Simulate n_trials trials of a population and write them to a dataset
+        of trials in path.
+    :param x        the parameters of the network to simulate. If None, they
+                    are sampled from the stream seeded with
+                    network_seed(seed), i.e. [seed, 1, 0].
+    :param resample sample new parameters for every trial
+    :param n_workers number of processes. Defaults to the number of CPUs,
+                    and 1 simulates in this process.
+    :param save_currents save the TxN currents of each trial as 'X'
+
+    :rtype list of the number of spikes of each neuron in each trial
+    """
+    if not os.path.exists(path):
+        os.makedirs(path)
+
+    # Save the model so it can be loaded alongside each trial
+    with open(os.path.join(path, 'model.pkl'), 'w') as f:
+        cPickle.dump(model, f, protocol=-1)
+
+    prms = {'T_stop' : T_stop,
+            'path' : path,
+            'resample' : resample,
+            'seed' : seed,
+            'dt' : dt,
+            'dt_stim' : dt_stim,
+            'D_stim' : D_stim,
+            'save_currents' : save_currents}
+
+    # Build the population and compile its functions before the workers are
+    # forked, so that they share the compiled functions rather than compile
+    # them concurrently
+    _init_worker(model, x, prms)
+    if x is None and not resample:
+        _sample_shared_network()
+    _compile()
+
+    if n_workers is None:
+        n_workers = multiprocessing.cpu_count()
+    n_workers = min(n_workers, n_trials)
+    if n_workers <= 1:
+        results = map(_simulate_trial, np.arange(n_trials))
+    else:
+        pool = multiprocessing.Pool(n_workers)
+        try:
+            results = pool.map(_simulate_trial, np.arange(n_trials),
+                               chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+
+    # Write the entries shared by all trials last so that a partially
+    # written dataset is not recognized
+    save_dataset({'N' : model['N'],
+                  'dt' : dt,
+                  'T' : float(T_stop),
+                  'dt_stim' : dt_stim,
+                  'model' : 'model.pkl',
+                  'n_trials' : n_trials,
+                  'seed' : seed,
+                  'resample' : resample,
+                  'nS' : np.array(results)},
+                 path)
+    return results
+
+def _init_worker(model, x, prms):
+    """ Build the population of this process
+    """
+    global _popn, _x, _prms
+    _popn = Population(model)
+    _x = x
+    _prms = prms
+
+def _sample_shared_network():
+    """ Sample the parameters shared by all trials from their own stream.
+        The random state is restored afterwards.
+    """
+    global _x
+    state = np.random.get_state()
+    np.random.seed(network_seed(_prms['seed']))
+    _x = _popn.sample()
+    np.random.set_state(state)
+
+def _compile():
+    """ Compile the functions used by the simulation by simulating a few
+        bins. The random state is restored afterwards.
+    """
+    state = np.random.get_state()
+    dt = _prms['dt']
+    _popn.set_data({"S": scipy.sparse.csr_matrix((10, _popn.N)),
+                    "N": _popn.N,
+                    "dt": dt,
+                    "T": 10*dt,
+                    "stim": np.zeros((1, _prms['D_stim'])),
+                    "dt_stim": 10*dt})
+    x = _x if _x is not None else _popn.sample()
+    _popn.simulate(x, (0, 10*dt), dt, sparse=True)
+    np.random.set_state(state)
+
+def _simulate_trial(k):
+    """ Simulate the k-th trial and write it to the dataset
+    """
+    prms = _prms
+    N = _popn.N
+    np.random.seed(trial_seed(prms['seed'], k))
+
+    # Sample the parameters of the network
+    if prms['resample']:
+        x = _popn.sample()
+    else:
+        x = _x
+    stable = check_stability(_popn.model, x, N)
+
+    # Generate random white noise stimulus
+    stim = np.random.randn(int(prms['T_stop']/prms['dt_stim']), prms['D_stim'])
+    nT = int(prms['T_stop']/prms['dt'])
+    data = {"S": scipy.sparse.csr_matrix((nT, N)),
+            "N": N,
+            "dt": prms['dt'],
+            "T": float(prms['T_stop']),
+            "stim": stim,
+            "dt_stim": prms['dt_stim']}
+    _popn.set_data(data)
+
+    S,X = _popn.simulate(x, (0, prms['T_stop']), prms['dt'], sparse=True)
+    data['S'] = S
+    if prms['save_currents']:
+        data['X'] = X
+    data['vars'] = x
+    data['model'] = 'model.pkl'
+    data['trial'] = k
+    data['stable'] = stable
+    save_trial(prms['path'], k, data)
+
+    nS = np.asarray(S.sum(0)).ravel()
+    print "Trial %d: %d spikes" % (k, np.sum(nS))
+    return nS
@@ -53,6 +53,12 @@ class ConstantBias(Component):
 
     def get_state(self):
         return {'bias': self.bias}
+
+    def batched_I_bias(self, stacked):
+        """ Get the bias of all N neurons at once given a dictionary of
+            stacked variables with one row per neuron.
+        """
+        return stacked[str(self.bias)][:,0]
     
     def sample(self):
         """
@@ -1,9 +1,10 @@
 import theano
 import theano.tensor as T
 
-from components.component import Component
+from components.component import Component, data_dtype, data_dot
 from components.priors import create_prior
 from utils.basis import *
+from utils.data_cache import data_tensor
 
 def create_bkgd_component(model):
     type = model['bkgd']['type'].lower()
@@ -19,6 +20,38 @@ def create_bkgd_component(model):
         raise Exception("Unrecognized backgound model: %s" % type)
     return bkgd
 
+def bins_per_frame(dt, dt_stim):
+    """ Number of time bins of width dt in each stimulus frame. Convolving at
+        the resolution of the stimulus requires a whole number.
+    """
+    m = int(np.round(dt_stim/dt))
+    if m < 1 or np.abs(m*dt - dt_stim) > 1e-6*dt_stim:
+        raise Exception("The stimulus frames (%f) must span a whole number of time bins (%f)" % (dt_stim, dt))
+    return m
+
+def stim_frame_tensor(name, data, params, compute, recent):
+    """ Get the tensor called name which compute(data) derives from the
+        stimulus with one row per stimulus frame, and the index of the row
+        for each time bin of data. For a segment, the tensor of the full
+        data is returned, so it includes the history before the segment.
+        recent is the dictionary of recent tensors of the component (see
+        utils.data_cache.data_tensor).
+    """
+    seg = data.get('segment', None)
+    if seg is None:
+        (full, start) = (data, 0)
+    elif seg.data is not None:
+        (full, start) = (seg.data, seg.start)
+    else:
+        # The full data was not sent along with the segment
+        full = dict(data)
+        del full['segment']
+        start = 0
+
+    x = data_tensor(name, full, 'stim', params, compute, recent)
+    t = data['dt'] * np.arange(start, start + data['S'].shape[0])
+    return x, frame_index(t, full['dt_stim'], x.shape[0])
+
 class NoStimulus(Component):
     """ No stimulus dependence. Constant biases are handled by the 
         bias component. 
@@ -34,6 +67,11 @@ class NoStimulus(Component):
         self.stim = T.constant(0.0)
         # Expose outputs to the Glm class
         self.I_stim = T.dot(T.constant(1.0), self.stim)
+
+    def batched_I_stim(self, stacked):
+        """ The stimulus current is zero for all neurons
+        """
+        return self.I_stim
     
 class BasisStimulus(Component):
     """ Filter the stimulus and expose the filtered stimulus
@@ -57,19 +95,30 @@ class BasisStimulus(Component):
 #        self.prior = create_prior(self.prms['prior'], name='w_stim', D=self.n_vars)
         self.w_stim = T.dvector('w_stim')
 
-        # Store stimulus in shared memory
+        # Store stimulus in shared memory. If the resolution is 'stim' the
+        # stimulus is filtered at the resolution of the stimulus frames and
+        # stim_index maps each time bin to its frame.
+        self.resolution = self.prms.get('resolution', 'data').lower()
+        self.dtype = data_dtype(model)
+        # The tensors derived from the most recent full data, see
+        # utils.data_cache.data_tensor
+        self.recent_tensors = {}
         self.stim = theano.shared(name='stim',
-                                  value=np.zeros((1,self.n_vars)))
+                                  value=np.zeros((1,self.n_vars),
+                                                 dtype=self.dtype))
+        self.stim_index = theano.shared(name='stim_index',
+                                        value=np.zeros(1, dtype=np.int64))
 
         # Log probability
 #        self.log_p = self.prior.log_p
 #         self.log_p = -0.5/0.1**2 *T.sum(T.pow(self.w_stim-0,2))
-        self.log_p = T.sum(-0.5/(0.01**2) * (self.w_stim-0.0)**2)
+        self.sig_w_stim = 0.01
+        self.log_p = T.sum(-0.5/(self.sig_w_stim**2) * (self.w_stim-0.0)**2)
 #         self.log_p = 0.0
 
         # Expose outputs to the Glm class
 #        self.I_stim = T.dot(self.stim,self.prior.value)
-        self.I_stim = T.dot(self.stim,self.w_stim)
+        self.I_stim = self._expand(data_dot(self.stim,self.w_stim))
 
         # A symbolic variable for the for the stimulus response
 #        self.stim_resp = T.dot(self.ibasis,self.prior.value)
@@ -88,6 +137,21 @@ class BasisStimulus(Component):
         """
         return {'stim_response' : self.stim_resp,
                 'basis' : self.ibasis}
+
+    def batched_I_stim(self, stacked):
+        """ Get the TxN stimulus currents of all neurons at once given a
+            dictionary of stacked variables with one row per neuron.
+        """
+        return self._expand(data_dot(self.stim,
+                                     T.transpose(stacked[str(self.w_stim)])))
+
+    def _expand(self, x):
+        """ Expand currents computed from the filtered stimulus to the time
+            bins of the data
+        """
+        if self.resolution == 'stim':
+            return x[self.stim_index]
+        return x
         
     def set_data(self, data):
         """ Set the shared memory variables that depend on the data
@@ -102,43 +166,59 @@ class BasisStimulus(Component):
                data['dt_stim']:
             raise Exception('Stimulus length is not the same as data time length!')
 
-        # Interpolate stimulus at the resolution of the data
+        # Interpolate basis at the resolution of the data
         dt = data['dt']
         dt_stim = data['dt_stim']
-        t = dt * np.arange(data['S'].shape[0])
-        t_stim = dt_stim * np.arange(data['stim'].shape[0])
-        stim = np.zeros((len(t), D_stim))
-        for d in np.arange(D_stim):
-            stim[:, d] = np.interp(t,
-                                   t_stim,
-                                   data['stim'][:, d])
-
-        # Interpolate basis at the resolution of the data
-        (L,B) = self.basis.shape
-        Lt_int = self.prms['dt_max']/dt
-        t_int = np.linspace(0,1,Lt_int)
-        t_bas = np.linspace(0,1,L)
-        ibasis = np.zeros((len(t_int), B))
-        for b in np.arange(B):
-            ibasis[:,b] = np.interp(t_int, t_bas, self.basis[:,b])
-            # Keep the total L1 norm the same
-            #ibasis[:,b] /= (np.sum(ibasis[:,b])/np.sum(self.basis[:,b]))
+        ibasis = interpolate_basis(self.basis, self.prms['dt_max']/dt)
+        # Keep the total L1 norm the same
+        #ibasis /= (np.sum(ibasis,0)/np.sum(self.basis,0))
 
         # Normalize so that the interpolated basis has volume 1
         if self.prms['basis']['norm']:
-            ibasis = ibasis / np.tile(np.sum(ibasis,0),[Lt_int,1])
+            ibasis = ibasis / np.sum(ibasis,0)
         self.ibasis.set_value(ibasis)
 
-        # Project the stimulus onto the basis
-        cstim = convolve_with_basis(stim, ibasis)
-
-        # Flatten this manually (there's surely a way to do this with numpy)
-        (nT,D,B) = cstim.shape 
-        fstim = np.empty((nT,D*B))
-        for d in np.arange(D):
-            for b in np.arange(B):
-                fstim[:,d*B+b] = cstim[:,d,b]
-        self.stim.set_value(fstim)
+        if self.resolution == 'stim':
+            # Sum the basis over the time bins of each frame and filter the
+            # stimulus frames. This is exact at the first bin of each frame
+            # if the stimulus is held constant between frames.
+            fbasis = downsample_basis(ibasis, bins_per_frame(dt, dt_stim))
+            def _filter_frames(data):
+                (nT,D) = data['stim'].shape
+                fstim = convolve_with_basis_as(data['stim'], fbasis, self.dtype,
+                                               self.prms.get('chunk_sz', 10000))
+                return np.reshape(fstim, (nT,D*fbasis.shape[1]))
+
+            (fstim, index) = stim_frame_tensor('stim_frames', data,
+                                               [dt, dt_stim, fbasis, self.dtype],
+                                               _filter_frames,
+                                               self.recent_tensors)
+            self.stim.set_value(fstim, borrow=True)
+            self.stim_index.set_value(index)
+            return
+        elif self.resolution != 'data':
+            raise Exception("Unrecognized stimulus resolution: %s" % self.resolution)
+
+        interp = self.prms.get('interp', 'linear')
+        def _filter_stim(data):
+            # Interpolate stimulus at the resolution of the data
+            t = dt * np.arange(data['S'].shape[0])
+            stim = resample_stimulus(data['stim'], dt_stim, t, interp)
+
+            # Project the stimulus onto the basis
+            cstim = convolve_with_basis_as(stim, ibasis, self.dtype,
+                                           self.prms.get('chunk_sz', 10000))
+
+            # Flatten so that column d*B+b holds dimension d filtered with
+            # basis b. The convolution is C ordered, so this is a view.
+            (nT,D,B) = cstim.shape 
+            return np.reshape(cstim, (nT,D*B))
+
+        # The filtered stimulus is loaded from the data cache if possible
+        fstim = data_tensor('stim', data, 'stim',
+                            [dt, dt_stim, interp, ibasis, self.dtype],
+                            _filter_stim, self.recent_tensors)
+        self.stim.set_value(fstim, borrow=True)
 
     def set_hyperparameters(self, model):
         """ Set hyperparameters of the model
@@ -189,8 +269,17 @@ class SpatiotemporalStimulus(Component):
         self.n_vars = Bx+Bt
 
         # Store stimulus (after projection onto the spatiotemporal basis, in shared memory
+        # If the resolution is 'stim' it is stored at the resolution of the
+        # stimulus frames, as in BasisStimulus.
+        self.resolution = self.prms.get('resolution', 'data').lower()
+        self.dtype = data_dtype(model)
+        # The tensors derived from the most recent full data, see
+        # utils.data_cache.data_tensor
+        self.recent_tensors = {}
         self.stim = theano.shared(name='stim',
-                                  value=np.zeros((1,Bx*Bt)))
+                                  value=np.zeros((1,Bx*Bt), dtype=self.dtype))
+        self.stim_index = theano.shared(name='stim_index',
+                                        value=np.zeros(1, dtype=np.int64))
 
         # Get the two factors of the stimulus response
         self.w_x = T.dvector('w_x')
@@ -210,7 +299,7 @@ class SpatiotemporalStimulus(Component):
                      -0.5/self.sigma**2 *T.sum((self.w_t-self.mu)**2)
 
         # Expose outputs to the Glm class
-        self.I_stim = T.dot(self.stim, self.w_stim)
+        self.I_stim = self._expand(data_dot(self.stim, self.w_stim))
 
 
         # Create function handles for the stimulus responses
@@ -232,6 +321,27 @@ class SpatiotemporalStimulus(Component):
         w_t = self.mu + self.sigma * np.random.randn(self.Bt)
         return {str(self.w_x) : w_x,
                 str(self.w_t) : w_t}
+
+    def batched_I_stim(self, stacked):
+        """ Get the TxN stimulus currents of all neurons at once given a
+            dictionary of stacked variables with one row per neuron.
+        """
+        w_t = stacked[str(self.w_t)]
+        w_x = stacked[str(self.w_x)]
+
+        # Take the outer product of the factors for each neuron and flatten
+        # it in the same order as w_stim
+        w_op = w_t.dimshuffle(0,1,'x') * w_x.dimshuffle(0,'x',1)
+        w_stim = T.reshape(w_op, (w_op.shape[0], self.Bt*self.Bx))
+        return self._expand(data_dot(self.stim, T.transpose(w_stim)))
+
+    def _expand(self, x):
+        """ Expand currents computed from the filtered stimulus to the time
+            bins of the data
+        """
+        if self.resolution == 'stim':
+            return x[self.stim_index]
+        return x
     
     def get_state(self):
         """ Get the stimulus response
@@ -260,44 +370,19 @@ class SpatiotemporalStimulus(Component):
     def set_data(self, data):
         """ Set the shared memory variables that depend on the data
         """
-        # Interpolate stimulus at the resolution of the data
         dt = data['dt']
         dt_stim = data['dt_stim']
-        t = np.arange(0, data['T'], dt)
-        nt = len(t)
-#         t_stim = np.arange(0, data['T'], dt_stim)
-        t_stim = dt_stim * np.arange(data['stim'].shape[0])
-        stim = np.zeros((nt, self.prms['D_stim']))
-        for d in np.arange(self.prms['D_stim']):
-            stim[:, d] = np.interp(t,
-                                   t_stim,
-                                   data['stim'][:, d])
-
-        # TODO Interpolate in spatial dimension as well?
 
         # Interpolate basis at the resolution of the data
-        (Lt,Bt) = self.temporal_basis.shape
-        Lt_int = self.prms['dt_max']/dt
-        t_int = np.linspace(0,1,Lt_int)
-        t_bas = np.linspace(0,1,Lt)
-        ibasis_t = np.zeros((len(t_int), Bt))
-        for b in np.arange(Bt):
-            ibasis_t[:,b] = np.interp(t_int, t_bas, self.temporal_basis[:,b])
-        
-        (Lx,Bx) = self.spatial_basis.shape
-        Lx_int = self.prms['D_stim']
-        x_int = np.linspace(0,1,Lx_int)
-        x_bas = np.linspace(0,1,Lx)
-        ibasis_x = np.zeros((len(x_int), Bx))
-        for b in np.arange(Bx):
-            ibasis_x[:,b] = np.interp(x_int, x_bas, self.spatial_basis[:,b])
+        ibasis_t = interpolate_basis(self.temporal_basis, self.prms['dt_max']/dt)
+        ibasis_x = interpolate_basis(self.spatial_basis, self.prms['D_stim'])
 
         # Normalize so that the interpolated basis has volume 1
 #         if self.prms['temporal_basis']['norm']:
 #             ibasis_t = ibasis_t / self.prms['dt_max']
         # Normalize so that the interpolated basis has unit L1 norm
         if self.prms['temporal_basis']['norm']:
-            ibasis_t = ibasis_t / np.tile(np.sum(ibasis_t,0),[Lt_int,1])
+            ibasis_t = ibasis_t / np.sum(ibasis_t,0)
 
         # Save the interpolated bases
         self.ibasis_t.set_value(ibasis_t)
@@ -316,16 +401,55 @@ class SpatiotemporalStimulus(Component):
         #                      np.atleast_2d(ibasis_x[:,bx]))
         #         fstim[:,bt,bx] = convolve_with_2d_basis(stim, bas)
 
-        # Leverage low rank to speed up convolutions
-        print "Convolving the stimulus with the low rank filters"
-        fstim = convolve_with_low_rank_2d_basis(stim, ibasis_x, ibasis_t)
-
-        # Permute output to get shape(T,Bt,Bx)
-        assert fstim.shape == (nt,Bx,Bt)
-        fstim = np.transpose(fstim, axes=[0,2,1])
-        
-        # Flatten the filtered stimulus 
-        fstim2 = np.reshape(fstim,(nt,Bt*Bx))
-
-        self.stim.set_value(fstim2)
+        if self.resolution == 'stim':
+            fbasis_t = downsample_basis(ibasis_t, bins_per_frame(dt, dt_stim))
+            def _filter_frames(data):
+                # Filter into a TxBtxBx array of the data precision
+                nT = data['stim'].shape[0]
+                fstim = np.empty((nT,Bt,Bx), dtype=self.dtype)
+                convolve_projection_with_basis(np.dot(data['stim'], ibasis_x),
+                                               fbasis_t,
+                                               out=np.transpose(fstim, axes=[0,2,1]))
+                return np.reshape(fstim, (nT,Bt*Bx))
+
+            (fstim, index) = stim_frame_tensor('stim_st_frames', data,
+                                               [dt, dt_stim, fbasis_t, ibasis_x,
+                                                self.dtype],
+                                               _filter_frames,
+                                               self.recent_tensors)
+            self.stim.set_value(fstim, borrow=True)
+            self.stim_index.set_value(index)
+            return
+        elif self.resolution != 'data':
+            raise Exception("Unrecognized stimulus resolution: %s" % self.resolution)
+
+        interp = self.prms.get('interp', 'linear')
+        def _filter_stim(data):
+            t = np.arange(0, data['T'], dt)
+            nt = len(t)
+
+            # TODO Interpolate in spatial dimension as well?
+
+            # Leverage low rank to speed up convolutions. The resampling is
+            # linear in the stimulus, so project each frame onto the spatial
+            # basis first and resample the Bx projections rather than the
+            # D_stim pixels.
+            print "Convolving the stimulus with the low rank filters"
+            fstimx = resample_stimulus(np.dot(data['stim'], ibasis_x),
+                                       dt_stim, t, interp)
+            # Filter into a TxBtxBx array of the data precision, through
+            # a view of it with shape (T,Bx,Bt)
+            fstim = np.empty((nt,Bt,Bx), dtype=self.dtype)
+            convolve_projection_with_basis(fstimx, ibasis_t,
+                                           out=np.transpose(fstim, axes=[0,2,1]))
+
+            # Flatten the filtered stimulus 
+            return np.reshape(fstim,(nt,Bt*Bx))
+
+        # The filtered stimulus is loaded from the data cache if possible
+        fstim2 = data_tensor('stim_st', data, 'stim',
+                             [dt, dt_stim, interp, ibasis_t, ibasis_x,
+                              self.dtype],
+                             _filter_stim, self.recent_tensors)
+        self.stim.set_value(fstim2, borrow=True)
 
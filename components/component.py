@@ -1,3 +1,97 @@
+import numpy as np
+import theano
+import theano.tensor as T
+
+def data_dtype(model):
+    """ Get the dtype in which the tensors derived from the data, e.g. the
+        filtered spike trains and stimulus, are stored. model['precision'] is
+        'double' (the default) or 'single'.
+    """
+    precision = model.get('precision', 'double').lower()
+    if precision == 'double':
+        return np.dtype(np.float64)
+    elif precision == 'single':
+        return np.dtype(np.float32)
+    raise Exception("Unrecognized precision: %s" % precision)
+
+def data_dot(x, w):
+    """ Product of a TxD data tensor x with float64 parameters w. The
+        parameters are cast to the dtype of x so that x is not copied, and
+        the result is cast back to float64. In single precision the gradient
+        wrt w sums over the time bins in double precision, one chunk of x at
+        a time, rather than in the dtype of x.
+    """
+    if x.dtype == 'float64':
+        return T.dot(x, T.cast(w, 'float64'))
+    return DataDot()(x, T.cast(w, 'float64'))
+
+# Number of time bins of a data tensor upcast to float64 at once
+_DATA_DOT_CHUNK = 10000
+
+class DataDot(theano.Op):
+    """ The float64 product dot(x, w) of a TxD single precision data tensor x
+        with a D or DxK float64 w, computed in the dtype of x. Gradients are
+        only taken wrt w.
+    """
+    __props__ = ()
+
+    def make_node(self, x, w):
+        x = T.as_tensor_variable(x)
+        w = T.as_tensor_variable(w)
+        out = T.TensorType('float64', (False,)*w.ndim)()
+        return theano.Apply(self, [x, w], [out])
+
+    def perform(self, node, inputs, outputs):
+        (x, w) = inputs
+        outputs[0][0] = np.dot(x, w.astype(x.dtype)).astype(np.float64)
+
+    def infer_shape(self, node, shapes):
+        return [(shapes[0][0],) + tuple(shapes[1][1:])]
+
+    def grad(self, inputs, output_grads):
+        (x, w) = inputs
+        return [theano.gradient.grad_undefined(self, 0, x),
+                DataDotT()(x, output_grads[0])]
+
+    def R_op(self, inputs, eval_points):
+        if eval_points[1] is None:
+            return [None]
+        return [self(inputs[0], eval_points[1])]
+
+class DataDotT(theano.Op):
+    """ The float64 product dot(x.T, g) of a TxD single precision data tensor
+        x with a T or TxK float64 g. The sum over time bins is taken in
+        float64 over chunks of _DATA_DOT_CHUNK time bins of x.
+    """
+    __props__ = ()
+
+    def make_node(self, x, g):
+        x = T.as_tensor_variable(x)
+        g = T.as_tensor_variable(g)
+        out = T.TensorType('float64', (False,)*g.ndim)()
+        return theano.Apply(self, [x, g], [out])
+
+    def perform(self, node, inputs, outputs):
+        (x, g) = inputs
+        out = np.zeros((x.shape[1],) + g.shape[1:])
+        for start in np.arange(0, x.shape[0], _DATA_DOT_CHUNK):
+            stop = min(start + _DATA_DOT_CHUNK, x.shape[0])
+            out += np.dot(x[start:stop].astype(np.float64).T, g[start:stop])
+        outputs[0][0] = out
+
+    def infer_shape(self, node, shapes):
+        return [(shapes[0][1],) + tuple(shapes[1][1:])]
+
+    def grad(self, inputs, output_grads):
+        (x, g) = inputs
+        return [theano.gradient.grad_undefined(self, 0, x),
+                DataDot()(x, output_grads[0])]
+
+    def R_op(self, inputs, eval_points):
+        if eval_points[1] is None:
+            return [None]
+        return [self(inputs[0], eval_points[1])]
+
 class Component:
     """
     """
@@ -1,9 +1,90 @@
+import atexit
+import os
+import tempfile
+
 import theano
 import theano.tensor as T
 from utils.basis import *
-from component import Component
+from utils.data_cache import data_tensor
+from utils.spikes import as_dense_spikes
+from component import Component, data_dtype, data_dot
 from priors import create_prior
 
+def batched_impulse_currents(ir, w_ir, W_eff):
+    """ Compute the TxN network currents of all postsynaptic neurons with a
+        single matrix product.
+    :param ir     TxNxB filtered presynaptic spike trains
+    :param w_ir   NxNxB basis weights indexed by (post, pre, basis)
+    :param W_eff  NxN effective weights indexed by (pre, post)
+    """
+    (N,_,B) = (w_ir.shape[0], w_ir.shape[1], w_ir.shape[2])
+    # Scale the basis weights of each connection by its effective weight
+    w_eff = w_ir * T.transpose(W_eff).dimshuffle(0,1,'x')
+    # Contract over presynaptic neurons and bases at once
+    ir2 = T.reshape(ir, (ir.shape[0], ir.shape[1]*ir.shape[2]))
+    w_eff2 = T.reshape(w_eff, (N, w_ir.shape[1]*B))
+    return data_dot(ir2, T.transpose(w_eff2))
+
+# The temporary files of filtered spike trains made by filter_spike_train
+_ir_files = set()
+
+def filter_spike_train(S, ibasis, prms, dtype=np.float64):
+    """ Convolve the TxN spike train with the interpolated basis. If the
+        impulse parameters specify a 'memmap_dir', the TxNxB result is
+        computed in chunks of 'chunk_sz' time bins into a memory mapped file
+        in that directory, so that it is never held in memory at once.
+        The result is stored with the given dtype, and in single precision
+        it is also computed in chunks so that it is never held in double
+        precision. Only the closed form engine (analytic_glm) evaluates the
+        memory mapped result a chunk at a time; the Theano graphs read all
+        of it at once.
+    """
+    memmap_dir = prms.get('memmap_dir', None)
+    if memmap_dir is None:
+        return convolve_with_basis_as(S, ibasis, dtype, prms.get('chunk_sz', 10000))
+
+    (nT,N) = S.shape
+    (fd, fname) = tempfile.mkstemp(suffix='.ir', dir=memmap_dir)
+    os.close(fd)
+    _ir_files.add(fname)
+    fS = np.memmap(fname, dtype=dtype, mode='w+',
+                   shape=(nT, N, ibasis.shape[1]))
+    convolve_with_basis(S, ibasis, out=fS, chunk_sz=prms.get('chunk_sz', 10000))
+    fS.flush()
+    return fS
+
+def set_filtered_spikes(ir, fS):
+    """ Set the shared filtered spike trains ir to fS, without copying. If
+        the previous ones were in a temporary file made by
+        filter_spike_train which fS does not use, e.g. after setting other
+        data, the file is removed. Memory maps of a removed file remain
+        valid until they are closed.
+    """
+    old = _memmap_file(ir.get_value(borrow=True))
+    ir.set_value(fS, borrow=True)
+    if old in _ir_files and old != _memmap_file(fS):
+        _ir_files.discard(old)
+        _remove_file(old)
+
+def _memmap_file(x):
+    if isinstance(x, np.memmap):
+        return x.filename
+    return None
+
+def _remove_file(fname):
+    try:
+        os.remove(fname)
+    except OSError:
+        pass
+
+@atexit.register
+def _remove_ir_files():
+    """ Remove the temporary files of filtered spike trains on exit
+    """
+    for fname in list(_ir_files):
+        _remove_file(fname)
+    _ir_files.clear()
+
 def create_impulse_component(model):
     typ = model['impulse']['type'].lower()
     if typ.lower() == 'basis': 
@@ -36,8 +117,13 @@ class LinearBasisImpulses(Component):
         self.ibasis = theano.shared(value=np.zeros((2,self.B)))
 
         # Initialize memory for the filtered spike train
+        self.dtype = data_dtype(model)
+        # The tensors derived from the most recent full data, see
+        # utils.data_cache.data_tensor
+        self.recent_tensors = {}
         self.ir = theano.shared(name='ir',
-                                value=np.zeros((1,self.N,self.B)))
+                                value=np.zeros((1,self.N,self.B),
+                                               dtype=self.dtype))
 
         # Define weights
         self.w_ir = T.dvector('w_ir')
@@ -62,6 +148,10 @@ class LinearBasisImpulses(Component):
         # after projecting onto the basis
         self.impulse = T.dot(w_ir2, T.transpose(self.ibasis))
 
+        # The impulse responses of a subset n_pre of the presynaptic neurons
+        self.n_pre = T.lvector('n_pre')
+        self.impulse_pre = T.dot(w_ir2[self.n_pre], T.transpose(self.ibasis))
+
     def get_variables(self):
         """ Get the theano variables associated with this model.
         """
@@ -80,6 +170,14 @@ class LinearBasisImpulses(Component):
         w = self.prior.sample(size=(self.N, self.B)).ravel()
         return {str(self.w_ir): w}
 
+    def batched_I_imp(self, stacked, W_eff):
+        """ Get the TxN network currents of all neurons at once given a
+            dictionary of stacked variables with one row per neuron and the
+            NxN matrix of effective weights.
+        """
+        w_ir = T.reshape(stacked[str(self.w_ir)], (-1, self.N, self.B))
+        return batched_impulse_currents(self.ir, w_ir, W_eff)
+
 
     def get_state(self):
         """ Get the impulse responses
@@ -108,18 +206,23 @@ class LinearBasisImpulses(Component):
 #             ibasis = ibasis / np.tile(np.sum(ibasis,0),[Lt_int,1])
         self.ibasis.set_value(ibasis)
 
-        # Project the presynaptic spiking onto the basis
+        # Project the presynaptic spiking onto the basis. Sparse spike trains
+        # are convolved by scattering the basis after each spike.
         nT,Ns = data["S"].shape
         assert Ns == self.N, "ERROR: Spike train must be (TxN) " \
                              "dimensional where N=%d" % self.N
-        fS = convolve_with_basis(data["S"], ibasis)
+        fS = data_tensor('ir', data, 'S', [ibasis, self.dtype],
+                         lambda d: filter_spike_train(d["S"], ibasis,
+                                                      self.prms, self.dtype),
+                         self.recent_tensors)
 
         # Flatten this manually to be safe
         # (there's surely a way to do this with numpy)
         (nT,Nc,B) = fS.shape
         assert Nc == self.N, "ERROR: Convolution with spike train " \
                              "resulted in incorrect shape: %s" % str(fS.shape)
-        self.ir.set_value(fS)
+        # Borrow the array so that a memory mapped or cached ir is not copied
+        set_filtered_spikes(self.ir, fS)
 
 class NormalizedBasisImpulses(Component):
     """ Normalized impulse response functions. Here we make use of Theano's
@@ -141,8 +244,13 @@ class NormalizedBasisImpulses(Component):
         self.ibasis = theano.shared(value=np.zeros((2,self.B)))
 
         # Initialize memory for the filtered spike train
+        self.dtype = data_dtype(model)
+        # The tensors derived from the most recent full data, see
+        # utils.data_cache.data_tensor
+        self.recent_tensors = {}
         self.ir = theano.shared(name='ir',
-                                value=np.zeros((1,self.N,self.B)))
+                                value=np.zeros((1,self.N,self.B),
+                                               dtype=self.dtype))
 
         # Define Dirichlet distributed weights by normalizing gammas
         # The variables are log-gamma distributed
@@ -178,6 +286,11 @@ class NormalizedBasisImpulses(Component):
         # after projecting onto the basis
         self.impulse = T.dot(self.w_ir2, T.transpose(self.ibasis))
 
+        # The impulse responses of a subset n_pre of the presynaptic neurons
+        self.n_pre = T.lvector('n_pre')
+        self.impulse_pre = T.dot(self.w_ir2[self.n_pre],
+                                 T.transpose(self.ibasis))
+
     def get_variables(self):
         """ Get the theano variables associated with this model.
         """
@@ -191,6 +304,15 @@ class NormalizedBasisImpulses(Component):
         lng = np.log(g)
         return {str(self.lng): lng}
 
+    def batched_I_imp(self, stacked, W_eff):
+        """ Get the TxN network currents of all neurons at once given a
+            dictionary of stacked variables with one row per neuron and the
+            NxN matrix of effective weights.
+        """
+        g = T.exp(T.reshape(stacked[str(self.lng)], (-1, self.N, self.B)))
+        w_ir = g / T.sum(g, axis=2).dimshuffle(0,1,'x')
+        return batched_impulse_currents(self.ir, w_ir, W_eff)
+
     def get_state(self):
         """ Get the impulse responses
         """
@@ -220,18 +342,23 @@ class NormalizedBasisImpulses(Component):
 #             ibasis = ibasis / np.tile(np.sum(ibasis,0),[Lt_int,1])
         self.ibasis.set_value(ibasis)
 
-        # Project the presynaptic spiking onto the basis
+        # Project the presynaptic spiking onto the basis. Sparse spike trains
+        # are convolved by scattering the basis after each spike.
         nT,Ns = data["S"].shape
         assert Ns == self.N, "ERROR: Spike train must be (TxN) " \
                              "dimensional where N=%d" % self.N
-        fS = convolve_with_basis(data["S"], ibasis)
+        fS = data_tensor('ir', data, 'S', [ibasis, self.dtype],
+                         lambda d: filter_spike_train(d["S"], ibasis,
+                                                      self.prms, self.dtype),
+                         self.recent_tensors)
 
         # Flatten this manually to be safe
         # (there's surely a way to do this with numpy)
         (nT,Nc,B) = fS.shape
         assert Nc == self.N, "ERROR: Convolution with spike train " \
                              "resulted in incorrect shape: %s" % str(fS.shape)
-        self.ir.set_value(fS)
+        # Borrow the array so that a memory mapped or cached ir is not copied
+        set_filtered_spikes(self.ir, fS)
 
 class ExponentialImpulses(Component):
     """ Exponential impulse response functions. Here we make use of Theano's
@@ -267,6 +394,13 @@ class ExponentialImpulses(Component):
                                      outputs_info=None,
                                      sequences=[self.taus],
                                      non_sequences=[])
+
+        # The impulse responses of a subset n_pre of the presynaptic neurons
+        self.n_pre = T.lvector('n_pre')
+        self.impulse_pre,_ = theano.scan(fn=lambda tau: T.exp(-self.t_ir[1:]/tau),
+                                         outputs_info=None,
+                                         sequences=[self.taus[self.n_pre]],
+                                         non_sequences=[])
                 
         # The filtered stimulus is found by convolving the spike train with the
         # impulse response function and keeping the first T_bins 
@@ -318,7 +452,7 @@ class ExponentialImpulses(Component):
         """ Set the shared memory variables that depend on the data
         """
         # Set data
-        self.S.set_value(data['S'])
+        self.S.set_value(as_dense_spikes(data['S']))
 
         # Set t_ir, the time delta for each impulse bin
         N_ir = self.prms['dt_max'] / data['dt']
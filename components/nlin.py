@@ -26,6 +26,8 @@ class ExpNonlinearity(Component):
 
 
         self.f_nlin = np.exp
+        self.f_grad_nlin = np.exp
+        self.f_hess_nlin = np.exp
 
 
 class ExpLinearNonlinearity(Component):
@@ -42,3 +44,5 @@ class ExpLinearNonlinearity(Component):
         self.log_p = T.constant(0.)
         
         self.f_nlin = lambda x: np.exp(x)*(x<0) + (1.0+x)*(x>=0)
+        self.f_grad_nlin = lambda x: np.exp(x)*(x<0) + 1.0*(x>=0)
+        self.f_hess_nlin = lambda x: np.exp(x)*(x<0)
@@ -33,6 +33,30 @@ class Gaussian(Component):
         """
         return -0.5/self.sigma**2  * T.sum((value-self.mu)**2)
 
+    def f_log_p(self, value):
+        """ Compute log prob of the given numpy value under this prior
+        """
+        sigma = self.sigma.get_value()
+        return -0.5/sigma**2 * np.sum((value-self.mu.get_value())**2)
+
+    def f_grad_log_p(self, value):
+        """ Compute the gradient of the log prob wrt the flattened value
+        """
+        sigma = self.sigma.get_value()
+        return np.ravel(-1.0/sigma**2 * (value-self.mu.get_value()))
+
+    def f_hess_log_p(self, value):
+        """ Compute the Hessian of the log prob wrt the flattened value
+        """
+        sigma = self.sigma.get_value()
+        return -1.0/sigma**2 * np.eye(np.size(value))
+
+    def f_hess_log_p_dot(self, value, v):
+        """ Compute the product of the Hessian of the log prob with v
+        """
+        sigma = self.sigma.get_value()
+        return -1.0/sigma**2 * v
+
     def get_variables(self):
 #        return {str(self.mu): self.mu, 
 #                str(self.sigma) : self.sigma}
@@ -95,6 +119,45 @@ class GroupLasso(Component):
         """
         return -1.0*self.lam * T.sum(T.sqrt(T.sum(((value-self.mu)/self.sigma)**2, axis=1)))
 
+    def f_log_p(self, value):
+        """ Compute log prob of the given numpy value under this prior
+        """
+        d = (value-self.mu.get_value())/self.sigma.get_value()
+        return -1.0*self.lam.get_value() * np.sum(np.sqrt(np.sum(d**2, axis=1)))
+
+    def f_grad_log_p(self, value):
+        """ Compute the gradient of the log prob wrt the flattened value
+        """
+        sigma = self.sigma.get_value()
+        d = (value-self.mu.get_value())/sigma
+        r = np.sqrt(np.sum(d**2, axis=1))
+        return np.ravel(-1.0*self.lam.get_value() * d/(sigma*r[:,None]))
+
+    def f_hess_log_p(self, value):
+        """ Compute the Hessian of the log prob wrt the flattened value.
+            It is block diagonal with one block per group.
+        """
+        sigma = self.sigma.get_value()
+        d = (value-self.mu.get_value())/sigma
+        r = np.sqrt(np.sum(d**2, axis=1))
+        (N,B) = d.shape
+        H = np.zeros((N*B, N*B))
+        for j in np.arange(N):
+            H[j*B:(j+1)*B, j*B:(j+1)*B] = -1.0*self.lam.get_value()/sigma**2 * \
+                (np.eye(B)/r[j] - np.outer(d[j], d[j])/r[j]**3)
+        return H
+
+    def f_hess_log_p_dot(self, value, v):
+        """ Compute the product of the Hessian of the log prob with v
+            without forming the Hessian.
+        """
+        sigma = self.sigma.get_value()
+        d = (value-self.mu.get_value())/sigma
+        r = np.sqrt(np.sum(d**2, axis=1))[:,None]
+        V = np.reshape(v, d.shape)
+        dV = np.sum(d*V, axis=1)[:,None]
+        return np.ravel(-1.0*self.lam.get_value()/sigma**2 * (V/r - d*dV/r**3))
+
 
     def get_variables(self):
         return {}
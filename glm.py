@@ -8,6 +8,29 @@ from components.bkgd import *
 from components.bias import *
 from components.impulse import *
 from components.nlin import *
+from components.component import data_dtype
+from utils.spikes import spike_indices
+
+def _stack_variable(v):
+    """ Create a symbolic variable with an extra leading dimension
+        to hold the values of v for all neurons.
+    """
+    typ = T.TensorType(v.dtype, (False,)*(v.ndim+1))
+    return typ(str(v) + '_all')
+
+def _stack_variables(syms, stacked):
+    """ Create a dictionary of stacked variables mirroring syms.
+        The mapping from each variable to its stacked version is
+        added to stacked.
+    """
+    ssyms = {}
+    for (k,v) in syms.items():
+        if isinstance(v, dict):
+            ssyms[k] = _stack_variables(v, stacked)
+        else:
+            stacked[v] = _stack_variable(v)
+            ssyms[k] = stacked[v]
+    return ssyms
 
 class Glm:
     def __init__(self, model, network):
@@ -16,11 +39,31 @@ class Glm:
         This corresponds to the spikes in the n-th column of data["S"]
         """
         # Define the Poisson regression model
+        self.N = model['N']
+        self.network = network
         self.n = T.lscalar('n')
         self.dt = theano.shared(name='dt',
                                 value=1.0)
-        self.S = theano.shared(name='S',
-                               value=np.zeros((1, model['N'])))
+        # The spike counts are stored sparsely as the time bins, neurons and
+        # counts of the nonzero entries, ordered by neuron. The entries of
+        # neuron n are spk_ptr[n]:spk_ptr[n+1]. The counts are stored with
+        # the precision of the other data tensors.
+        self.T_bins = 1
+        self.spk_t = theano.shared(name='spk_t',
+                                   value=np.zeros(0, dtype=np.int64))
+        self.spk_n = theano.shared(name='spk_n',
+                                   value=np.zeros(0, dtype=np.int64))
+        self.spk_c = theano.shared(name='spk_c',
+                                   value=np.zeros(0, dtype=data_dtype(model)))
+        self.spk_ptr = theano.shared(name='spk_ptr',
+                                     value=np.zeros(model['N']+1, dtype=np.int64))
+
+        # The time bins held out of the likelihood, e.g. by
+        # utils.io.kfold_splits, have zero weight in the mask. Their spikes
+        # still enter the history of the later bins.
+        self.holdout = None
+        self.mask = theano.shared(name='mask',
+                                  value=np.ones(1))
 
 
         # Define a bias to the membrane potential
@@ -49,16 +92,80 @@ class Glm:
                                    self.bkgd_model.I_stim +
                                    self.I_net)
 
-        # Compute the log likelihood under the Poisson process
-        self.ll = T.sum(-self.dt*self.lam + T.log(self.lam)*self.S[:,self.n])
+        # Compute the log likelihood under the Poisson process. The log rate
+        # only enters in the bins where the neuron spiked.
+        spk = slice(self.spk_ptr[self.n], self.spk_ptr[self.n+1])
+        self.ll = T.sum(-self.dt*self.lam*self.mask) + \
+                  T.sum(T.log(self.lam[self.spk_t[spk]]) * self.spk_c[spk])
 
         # Compute the log prior
         lp_bias = self.bias_model.log_p
         lp_bkgd = self.bkgd_model.log_p
         lp_imp = self.imp_model.log_p
         lp_nlin = self.nlin_model.log_p
-        self.log_p = self.ll + lp_bias + lp_bkgd + lp_imp + lp_nlin
+        self.log_prior = lp_bias + lp_bkgd + lp_imp + lp_nlin
+        self.log_p = self.ll + self.log_prior
+
+        # Expressions for all neurons at once are built on first use
+        self.batched = None
+
+    def get_batched_expressions(self):
+        """ Get expressions for the log likelihood and log prior of all N
+            neurons at once. The per-neuron variables are replaced by stacked
+            variables with one row per neuron. Returns a dictionary with the
+            stacked variables ('syms'), and the length-N vectors of log
+            likelihoods ('ll') and log priors ('log_prior').
+        """
+        if self.batched is None:
+            syms = self.get_variables()
+            del syms[str(self.n)]
+            stacked = {}
+            ssyms = _stack_variables(syms, stacked)
+
+            # The log priors do not depend on the data. Map the single neuron
+            # expression over the rows of the stacked variables.
+            log_priors = self._map_over_neurons(self.log_prior, stacked)
+
+            # If every component can compute its currents for all neurons at
+            # once, contract the filtered spike trains against all the weights
+            # in a single pass. Otherwise map the single neuron expression.
+            if hasattr(self.bkgd_model, 'batched_I_stim') and \
+               hasattr(self.imp_model, 'batched_I_imp'):
+                if self.network is not None:
+                    W_eff = self.network.graph.A * self.network.weights.W
+                else:
+                    W_eff = T.ones((self.N, self.N))
+
+                I_bias = self.bias_model.batched_I_bias(ssyms['bias'])
+                I_stim = self.bkgd_model.batched_I_stim(ssyms['bkgd'])
+                I_net = self.imp_model.batched_I_imp(ssyms['imp'], W_eff)
+                lam = self.nlin_model.nlin(I_bias + I_stim + I_net)
+                # Gather the log rates at the nonzero entries of the spike
+                # matrix and sum them for each neuron
+                log_lam_spk = T.log(T.flatten(lam)[self.spk_t*self.N + self.spk_n])
+                lls = T.sum(-self.dt*lam*self.mask.dimshuffle(0,'x'), axis=0) + \
+                      T.inc_subtensor(T.zeros((self.N,), dtype=lam.dtype)[self.spk_n],
+                                      log_lam_spk * self.spk_c)
+            else:
+                lls = self._map_over_neurons(self.ll, stacked)
 
+            self.batched = {'syms' : ssyms,
+                            'll' : lls,
+                            'log_prior' : log_priors}
+        return self.batched
+
+    def _map_over_neurons(self, expr, stacked):
+        """ Evaluate the single neuron expression for each row of the
+            stacked variables.
+        """
+        leaves = stacked.keys()
+        stacked_leaves = [stacked[v] for v in leaves]
+        def _expr_n(n, *vs):
+            return theano.clone(expr, replace=dict(zip([self.n] + leaves,
+                                                       [n] + list(vs))))
+        exprs,_ = theano.map(_expr_n,
+                             sequences=[T.arange(self.N)] + stacked_leaves)
+        return exprs
 
     def get_variables(self):
         """ Get a list of all variables
@@ -87,15 +194,53 @@ class Glm:
         """ Update the shared memory where the data is stored
         """
         if "S" in data.keys():
-            self.S.set_value(data["S"])
+            S = data["S"]
         else:
-            self.S.set_value(np.zeros_like(data["stim"]))
+            S = np.zeros((data["stim"].shape[0], self.N))
+
+        (t, n, c, ptr) = spike_indices(S)
+        self.T_bins = S.shape[0]
+
+        # Remove the held out bins from the likelihood
+        mask = np.ones(self.T_bins)
+        self.holdout = data.get('holdout', None)
+        if self.holdout is not None:
+            (h_start, h_stop) = self.holdout
+            mask[h_start:h_stop] = 0
+            keep = (t < h_start) | (t >= h_stop)
+            (t, n, c) = (t[keep], n[keep], c[keep])
+            ptr = np.concatenate(([0], np.cumsum(np.bincount(n, minlength=self.N))))
+            ptr = ptr.astype(np.int64)
+        self.mask.set_value(mask)
+
+        self.spk_t.set_value(t)
+        self.spk_n.set_value(n)
+        self.spk_c.set_value(c.astype(self.spk_c.dtype))
+        self.spk_ptr.set_value(ptr)
 
         self.dt.set_value(data["dt"])
 
         self.bkgd_model.set_data(data)
         self.imp_model.set_data(data)
 
+    def bin_widths(self):
+        """ Get the width of the time bins in the likelihood: dt, or a vector
+            which is zero in the held out bins
+        """
+        if self.holdout is None:
+            return self.dt.get_value()
+        return self.dt.get_value() * self.mask.get_value(borrow=True)
+
+    def spike_counts(self, n):
+        """ Get the spike counts of the n-th neuron in every time bin
+        """
+        ptr = self.spk_ptr.get_value(borrow=True)
+        (start, stop) = (ptr[n], ptr[n+1])
+        S_n = np.zeros(self.T_bins)
+        S_n[self.spk_t.get_value(borrow=True)[start:stop]] = \
+            self.spk_c.get_value(borrow=True)[start:stop]
+        return S_n
+
     def set_hyperparameters(self, model):
         """ Set the hyperparameters of the model
         """
@@ -9,11 +9,12 @@ import numpy as np
 
 import scipy.optimize as opt
 
-from utils.theano_func_wrapper import seval, _flatten
+from utils.theano_func_wrapper import seval, compile_expr, _flatten
 from utils.packvec import *
 from utils.grads import *
 
 from components.graph import CompleteGraphModel
+import analytic_glm
 
 from smart_init import initialize_with_data
 
@@ -39,7 +40,7 @@ def prep_network_inference(population,
     # TODO: Replace this with a function that just gets the shapes?
     x0 = population.sample()
     net_vars = get_vars(net_syms, x0['net'])
-    _,net_shapes = packdict(net_vars)
+    net_layout = ParameterLayout.from_vars(net_vars)
     
     # Get the likelihood of the GLM wrt the net variables
     glm_logp = glm.log_p
@@ -52,7 +53,7 @@ def prep_network_inference(population,
         """ Compute the negative log probability (or gradients and Hessians thereof)
         of the given network variables
         """
-        x_net = unpackdict(x_net_vec, net_shapes)
+        x_net = net_layout.unpack(x_net_vec)
         set_vars(net_syms, x['net'], x_net)
         lp = seval(net_expr,
                    syms['net'],
@@ -104,76 +105,107 @@ def prep_glm_inference(population,
     network = population.network
     glm = population.glm
     syms = population.get_variables()
-    
-    # Compute gradients of the log prob wrt the GLM parameters
-    print "Computing log probabilities, gradients, and Hessians for GLM variables"
     glm_syms = differentiable(syms['glm'])
-    glm_logp = glm.log_p
-    g_glm_logp_wrt_glm, g_list = grad_wrt_list(glm_logp, _flatten(glm_syms))
-    if use_hessian:
-        H_glm_logp_wrt_glm = hessian_wrt_list(glm_logp, _flatten(glm_syms), g_list)
 
-    elif use_rop:
-        # Alternatively, we could just use an Rop to compute Hessian-vector prod       
-        v = T.dvector()
-        H_glm_logp_wrt_glm = hessian_rop_wrt_list(glm_logp,
-                                                  _flatten(glm_syms),
-                                                  v,
-                                                  g_vec=g_glm_logp_wrt_glm)
+    if population.analytic is not None:
+        # The log prob and its derivatives are computed in closed form
+        print "Using closed form log probabilities, gradients, and Hessians for GLM variables"
+        f_glm_logp = population.analytic.log_p
+        f_g_glm_logp = population.analytic.grad_log_p
+        f_glm_logp_and_grad = population.analytic.log_p_and_grad
+        f_H_glm_logp = population.analytic.hessian_log_p
+        f_Hv_glm_logp = population.analytic.hessian_vector_product
+
+    else:
+        # Compute gradients of the log prob wrt the GLM parameters
+        print "Computing log probabilities, gradients, and Hessians for GLM variables"
+        glm_logp = glm.log_p
+        g_glm_logp_wrt_glm, g_list = grad_wrt_list(glm_logp, _flatten(glm_syms))
+
+        # Compute the log prob and its gradient with a single function so that
+        # the firing rate is only computed once per evaluation
+        f_glm_logp_and_grad = compile_expr([glm_logp, g_glm_logp_wrt_glm], syms)
+        f_glm_logp = lambda x: seval(glm_logp, syms, x)
+        f_g_glm_logp = lambda x: seval(g_glm_logp_wrt_glm, syms, x)
+
+        if (use_hessian or use_rop) and analytic_glm.supports(glm):
+            # The Hessian of the GLM is assembled block by block from weighted
+            # Gram products rather than differentiated one row at a time
+            print "Using closed form Hessians for GLM variables"
+            hess_provider = analytic_glm.AnalyticGlm(population)
+            f_H_glm_logp = hess_provider.hessian_log_p
+            f_Hv_glm_logp = hess_provider.hessian_vector_product
+
+        elif use_hessian:
+            H_glm_logp_wrt_glm = hessian_wrt_list(glm_logp, _flatten(glm_syms), g_list)
+            f_H_glm_logp = lambda x: seval(H_glm_logp_wrt_glm, syms, x)
+
+        elif use_rop:
+            # Alternatively, we could just use an Rop to compute Hessian-vector prod       
+            v = T.dvector()
+            H_glm_logp_wrt_glm = hessian_rop_wrt_list(glm_logp,
+                                                      _flatten(glm_syms),
+                                                      v,
+                                                      g_vec=g_glm_logp_wrt_glm)
+            rop_syms = copy.copy(syms)
+            rop_syms['v'] = v
+            f_Hv_glm_logp = lambda x, v_vec: seval(H_glm_logp_wrt_glm,
+                                                   rop_syms,
+                                                   x,
+                                                   {'v' : v_vec})
 
     # TODO: Replace this with a function that just gets the shapes?
     x0 = population.sample()
     nvars = population.extract_vars(x0, 0)
     dnvars = get_vars(glm_syms, nvars['glm'])
-    _,glm_shapes = packdict(dnvars)
+    glm_layout = ParameterLayout.from_vars(dnvars)
 
     # Private function to compute the log probability (or grads and Hessians thereof)
     # of the log probability given new network variables
-    def glm_helper(x_glm_vec, x, glm_expr):
+    def glm_helper(x_glm_vec, x, f_glm):
         """ Compute the negative log probability (or gradients and Hessians thereof)
         of the given glm variables
         """
-        x_glm = unpackdict(x_glm_vec, glm_shapes)
+        x_glm = glm_layout.unpack(x_glm_vec)
         set_vars(glm_syms, x['glm'], x_glm)
-        lp = seval(glm_expr,
-                    syms,
-                    x)
+        lp = f_glm(x)
         return -1.0*lp
 
+    def glm_fused_helper(x_glm_vec, x):
+        """ Compute the negative log probability and its gradient
+        """
+        x_glm = glm_layout.unpack(x_glm_vec)
+        set_vars(glm_syms, x['glm'], x_glm)
+        lp, glp = f_glm_logp_and_grad(x)
+        return -1.0*lp, -1.0*glp
+
     if use_rop:
-        rop_syms = copy.copy(syms)
-        rop_syms['v'] = v
-        def glm_rop_helper(x_glm_vec, v_vec, x, glm_expr):
+        def glm_rop_helper(x_glm_vec, v_vec, x):
             """ Compute the Hessian vector product for the GLM
             """
-            import pdb
-            pdb.set_trace()
-            x_glm = unpackdict(x_glm_vec, glm_shapes)
+            x_glm = glm_layout.unpack(x_glm_vec)
             set_vars(glm_syms, x['glm'], x_glm)
-            defaults = {'v' : v_vec}
-            Hv = seval(glm_expr,
-                       rop_syms,
-                       x,
-                       defaults)
+            Hv = f_Hv_glm_logp(x, v_vec)
             return -1.0*Hv
     
     nll = lambda x_glm_vec, x: glm_helper(x_glm_vec, 
                                           x, 
-                                          glm_logp)
+                                          f_glm_logp)
     grad_nll = lambda x_glm_vec, x: glm_helper(x_glm_vec, 
                                                x, 
-                                               g_glm_logp_wrt_glm)
+                                               f_g_glm_logp)
     if use_rop:
         hess_nll = lambda x_glm_vec, v_vec, x: glm_rop_helper(x_glm_vec, 
                                                               v_vec, 
-                                                              x, 
-                                                              H_glm_logp_wrt_glm)
-    else:
+                                                              x)
+    elif use_hessian or population.analytic is not None:
         hess_nll = lambda x_glm_vec, x: glm_helper(x_glm_vec, 
                                                    x, 
-                                                   H_glm_logp_wrt_glm)        
+                                                   f_H_glm_logp)
+    else:
+        hess_nll = None
 
-    return glm_syms, nll, grad_nll, hess_nll
+    return glm_syms, nll, grad_nll, hess_nll, glm_fused_helper
 
 def fit_network(x, 
                 (net_syms, net_nll, g_net_nll, H_net_nll),
@@ -182,7 +214,8 @@ def fit_network(x,
     """ Fit the GLM parameters in state dict x
     """
     dx_net = get_vars(net_syms, x['net'])
-    x_net_0, shapes = packdict(dx_net)
+    layout = ParameterLayout.from_vars(dx_net)
+    x_net_0 = layout.pack(dx_net)
     
     if x_net_0.size > 0:
         nll = lambda x_net_vec: net_nll(x_net_vec, x)
@@ -203,18 +236,21 @@ def fit_network(x,
                                  fhess=hess_nll,
                                  disp=True,
                                  callback=cbk)
-        x_net = unpackdict(x_net_opt, shapes)
+        x_net = layout.unpack(x_net_opt)
         set_vars(net_syms, x['net'], x_net)
 
 def fit_glm(xn, n, 
-            (glm_syms, glm_nll, g_glm_nll, H_glm_nll),
+            (glm_syms, glm_nll, g_glm_nll, H_glm_nll, glm_nll_and_grad),
             use_hessian,
             use_rop):
-    """ Fit the GLM parameters in state dict x
+    """ Fit the GLM parameters in state dict x. If glm_nll_and_grad is
+        given, BFGS evaluates the nll and its gradient together.
+        Return the number of optimizer iterations.
     """
     # Get the differentiable variables for the n-th GLM
     dnvars = get_vars(glm_syms, xn['glm'])
-    x_glm_0, shapes = packdict(dnvars)
+    layout = ParameterLayout.from_vars(dnvars)
+    x_glm_0 = layout.pack(dnvars)
     
     # Create lambda functions to compute the nll and its gradient and Hessian
     def nll(x_glm_vec):
@@ -231,6 +267,20 @@ def fit_glm(xn, n,
 
         return g
 
+    # Remember the last fused evaluation so that the progress report
+    # does not need another pass over the data
+    last_eval = [None, None]
+    def nll_and_grad(x_glm_vec):
+        y, g = glm_nll_and_grad(x_glm_vec, xn)
+        if np.isnan(y):
+            y = 1e16
+        if np.any(np.isnan(g)):
+            g = np.zeros_like(g)
+
+        last_eval[0] = np.copy(x_glm_vec)
+        last_eval[1] = y
+        return y, g
+
     if use_rop:
         hess_nll = lambda x_glm_vec, v_vec: H_glm_nll(x_glm_vec, v_vec, xn)
     elif use_hessian:
@@ -245,7 +295,10 @@ def fit_glm(xn, n,
     # pass the current iteration via a list
     ncg_iter_ls = [0]
     def progress_report(x_curr, ncg_iter_ls):
-        ll = -1.0*nll(x_curr)
+        if last_eval[0] is not None and np.array_equal(x_curr, last_eval[0]):
+            ll = -1.0*last_eval[1]
+        else:
+            ll = -1.0*nll(x_curr)
         print "Newton iter %d.\tNeuron %d. LL: %.1f" % (ncg_iter_ls[0],n,ll)
         ncg_iter_ls[0] += 1
     cbk = lambda x_curr: progress_report(x_curr, ncg_iter_ls)
@@ -276,17 +329,26 @@ def fit_glm(xn, n,
         #                       disp=True,
         #                       callback=cbk)
 
-        res =    opt.minimize(nll, x_glm_0,
-                              method="bfgs",
-                              jac=grad_nll,
-                              options={'disp': True,
-                                       'maxiter' : 225},
-                              callback=cbk)
+        if glm_nll_and_grad is not None:
+            res = opt.minimize(nll_and_grad, x_glm_0,
+                               method="bfgs",
+                               jac=True,
+                               options={'disp': True,
+                                        'maxiter' : 225},
+                               callback=cbk)
+        else:
+            res = opt.minimize(nll, x_glm_0,
+                               method="bfgs",
+                               jac=grad_nll,
+                               options={'disp': True,
+                                        'maxiter' : 225},
+                               callback=cbk)
         xn_opt = res.x
 
     # Unpack the optimized parameters back into the state dict
-    x_glm_n = unpackdict(xn_opt, shapes)
+    x_glm_n = layout.unpack(xn_opt)
     set_vars(glm_syms, xn['glm'], x_glm_n)
+    return ncg_iter_ls[0]
 
 def coord_descent(population, 
                   data,
@@ -4,8 +4,9 @@
 
 import copy
 
-from utils.theano_func_wrapper import seval, _flatten
+from utils.theano_func_wrapper import seval, compile_expr, AccessorPlan, _flatten
 from utils.packvec import *
+from utils.population_state import as_population_state
 from utils.grads import *
 
 from hmc import hmc
@@ -77,13 +78,29 @@ class HmcGlmUpdate(ParallelMetropolisHastingsUpdate):
         self.syms = population.get_variables()
         self.glm_syms = differentiable(self.syms['glm'])
 
-        # Compute gradients of the log prob wrt the GLM parameters
-        self.glm_logp = self.glm.log_p
-        self.g_glm_logp_wrt_glm, _ = grad_wrt_list(self.glm_logp,
-                                                   _flatten(self.glm_syms))
+        if population.analytic is not None:
+            # The log prob and its gradient are computed in closed form
+            self.f_glm_logp = population.analytic.log_p
+            self.f_g_glm_logp = population.analytic.grad_log_p
+            self.f_glm_logp_and_grad = population.analytic.log_p_and_grad
 
-        # Get the shape of the parameters from a sample of variables
-        self.glm_shapes = get_shapes(self.population.extract_vars(self.population.sample(),0)['glm'],
+        else:
+            # Compute gradients of the log prob wrt the GLM parameters
+            self.glm_logp = self.glm.log_p
+            self.g_glm_logp_wrt_glm, _ = grad_wrt_list(self.glm_logp,
+                                                       _flatten(self.glm_syms))
+
+            # Compile the log prob and its gradient once and hold onto the
+            # handles. The fused function shares the linear predictor and
+            # firing rate between the value and the gradient.
+            self.f_glm_logp = compile_expr(self.glm_logp, self.syms)
+            self.f_g_glm_logp = compile_expr(self.g_glm_logp_wrt_glm, self.syms)
+            self.f_glm_logp_and_grad = compile_expr([self.glm_logp,
+                                                     self.g_glm_logp_wrt_glm],
+                                                    self.syms)
+
+        # Get the layout of the parameters from a sample of variables
+        self.glm_layout = get_layout(self.population.extract_vars(self.population.sample(),0)['glm'],
                                      self.glm_syms)
 
     def _glm_logp(self, x_vec, x_all):
@@ -94,11 +111,9 @@ class HmcGlmUpdate(ParallelMetropolisHastingsUpdate):
         probability.
         """
         # Extract the glm parameters
-        x_glm = unpackdict(x_vec, self.glm_shapes)
+        x_glm = self.glm_layout.unpack(x_vec)
         set_vars(self.glm_syms, x_all['glm'], x_glm)
-        lp = seval(self.glm_logp,
-                   self.syms,
-                   x_all)
+        lp = self.f_glm_logp(x_all)
         return lp
 
     def _grad_glm_logp(self, x_vec, x_all):
@@ -109,13 +124,21 @@ class HmcGlmUpdate(ParallelMetropolisHastingsUpdate):
         probability.
         """
         # Extract the glm parameters
-        x_glm = unpackdict(x_vec, self.glm_shapes)
+        x_glm = self.glm_layout.unpack(x_vec)
         set_vars(self.glm_syms, x_all['glm'], x_glm)
-        glp = seval(self.g_glm_logp_wrt_glm,
-                    self.syms,
-                    x_all)
+        glp = self.f_g_glm_logp(x_all)
         return glp
 
+    def _glm_logp_and_grad(self, x_vec, x_all):
+        """
+        Compute the log probability and its gradient in a single pass.
+        """
+        # Extract the glm parameters
+        x_glm = self.glm_layout.unpack(x_vec)
+        set_vars(self.glm_syms, x_all['glm'], x_glm)
+        lp, glp = self.f_glm_logp_and_grad(x_all)
+        return lp, glp
+
     def update(self, x, n):
         """ Gibbs sample the GLM parameters. These are mostly differentiable
             so we use HMC wherever possible.
@@ -125,11 +148,14 @@ class HmcGlmUpdate(ParallelMetropolisHastingsUpdate):
 
         # Get the differentiable variables suitable for HMC
         dxn = get_vars(self.glm_syms, xn['glm'])
-        x_glm_0, shapes = packdict(dxn)
+        x_glm_0 = self.glm_layout.pack(dxn)
 
         # Create lambda functions to compute the nll and its gradient
         nll = lambda x_glm_vec: -1.0*self._glm_logp(x_glm_vec, xn)
         grad_nll = lambda x_glm_vec: -1.0*self._grad_glm_logp(x_glm_vec, xn)
+        def nll_and_grad(x_glm_vec):
+            lp, glp = self._glm_logp_and_grad(x_glm_vec, xn)
+            return -1.0*lp, -1.0*glp
 
         # HMC with automatic parameter tuning
         n_steps = 2
@@ -139,7 +165,8 @@ class HmcGlmUpdate(ParallelMetropolisHastingsUpdate):
                                                   n_steps,
                                                   x_glm_0,
                                                   adaptive_step_sz=True,
-                                                  avg_accept_rate=self.avg_accept_rate)
+                                                  avg_accept_rate=self.avg_accept_rate,
+                                                  U_and_grad_U=nll_and_grad)
 
         # Update step size and accept rate
         self.step_sz = new_step_sz
@@ -148,7 +175,7 @@ class HmcGlmUpdate(ParallelMetropolisHastingsUpdate):
 
 
         # Unpack the optimized parameters back into the state dict
-        x_glm_n = unpackdict(x_glm, shapes)
+        x_glm_n = self.glm_layout.unpack(x_glm)
         set_vars(self.glm_syms, xn['glm'], x_glm_n)
 
 
@@ -193,26 +220,38 @@ class CollapsedGibbsNetworkColumnUpdate(ParallelMetropolisHastingsUpdate):
             self.mu_w_ref = self.mu_w
             self.sigma_w_ref = self.sigma_w
 
+        # Compile the currents once and hold onto the handles
+        self.f_I_bias = compile_expr(self.glm.bias_model.I_bias, self.syms)
+        self.f_I_stim = compile_expr(self.glm.bkgd_model.I_stim, self.syms)
+        self.f_I_imp = compile_expr(self.glm.imp_model.I_imp, self.syms)
+        self.f_p_A = compile_expr(self.network.graph.pA, self.syms['net'])
+        self.f_net_logp = compile_expr(self.network.log_p, self.syms['net'])
+
+        # The GLM log likelihood is evaluated given the precomputed currents.
+        # The inputs are always passed in the same order, so compile a single
+        # function and call it positionally.
+        s = [self.network.graph.A] + \
+             _flatten(self.syms['net']['weights']) + \
+            [self.glm.n,
+             self.glm.bias_model.I_bias,
+             self.glm.bkgd_model.I_stim,
+             self.glm.imp_model.I_imp] + \
+            _flatten(self.syms['glm']['nlin'])
+        self.f_glm_ll = compile_expr(self.glm.ll, dict(zip(range(len(s)), s)))
+
+        # Plans to extract the remaining positional arguments from the state
+        self.weights_plan = AccessorPlan(self.syms['net']['weights'])
+        self.nlin_plan = AccessorPlan(self.syms['glm']['nlin'])
+
     def _precompute_vars(self, x, n_post):
         """ Precompute currents for sampling A and W
         """
         nvars = self.population.extract_vars(x, n_post)
 
-        I_bias = seval(self.glm.bias_model.I_bias,
-                       self.syms,
-                       nvars)
-
-        I_stim = seval(self.glm.bkgd_model.I_stim,
-                       self.syms,
-                       nvars)
-
-        I_imp = seval(self.glm.imp_model.I_imp,
-                      self.syms,
-                      nvars)
-
-        p_A = seval(self.network.graph.pA,
-                    self.syms['net'],
-                    x['net'])
+        I_bias = self.f_I_bias(nvars)
+        I_stim = self.f_I_stim(nvars)
+        I_imp = self.f_I_imp(nvars)
+        p_A = self.f_p_A(x['net'])
 
         return I_bias, I_stim, I_imp, p_A
 
@@ -225,9 +264,7 @@ class CollapsedGibbsNetworkColumnUpdate(ParallelMetropolisHastingsUpdate):
         A[n_pre, n_post] = v
 
         # Get the prior probability of A
-        lp = seval(self.network.log_p,
-                   self.syms['net'],
-                   x['net'])
+        lp = self.f_net_logp(x['net'])
         return lp
 
     def _glm_ll_A(self, n_pre, n_post, w, x, I_bias, I_stim, I_imp):
@@ -244,23 +281,15 @@ class CollapsedGibbsNetworkColumnUpdate(ParallelMetropolisHastingsUpdate):
         W[n_pre, n_post] = w
 
         # Get the likelihood of the GLM under A and W
-        s = [self.network.graph.A] + \
-             _flatten(self.syms['net']['weights']) + \
-            [self.glm.n,
-             self.glm.bias_model.I_bias,
-             self.glm.bkgd_model.I_stim,
-             self.glm.imp_model.I_imp] + \
-            _flatten(self.syms['glm']['nlin'])
-
         xv = [A] + \
              [W.ravel()] + \
              [n_post,
               I_bias,
               I_stim,
               I_imp] + \
-            _flatten(x['glms'][n_post]['nlin'])
+             self.nlin_plan.extract(x['glms'][n_post]['nlin'])
 
-        ll = self.glm.ll.eval(dict(zip(s, xv)))
+        ll = self.f_glm_ll.f(*xv)
         # Reset A and W
         A[n_pre, n_post] = A_init
         W[n_pre, n_post] = W_init
@@ -275,23 +304,15 @@ class CollapsedGibbsNetworkColumnUpdate(ParallelMetropolisHastingsUpdate):
         A[n_pre, n_post] = 0
 
         # Get the likelihood of the GLM under A and W
-        s = [self.network.graph.A] + \
-             _flatten(self.syms['net']['weights']) + \
-            [self.glm.n,
-             self.glm.bias_model.I_bias,
-             self.glm.bkgd_model.I_stim,
-             self.glm.imp_model.I_imp] + \
-            _flatten(self.syms['glm']['nlin'])
-
         xv = [A] + \
-             _flatten(x['net']['weights']) + \
+             self.weights_plan.extract(x['net']['weights']) + \
              [n_post,
               I_bias,
               I_stim,
               I_imp] + \
-            _flatten(x['glms'][n_post]['nlin'])
+             self.nlin_plan.extract(x['glms'][n_post]['nlin'])
 
-        ll = self.glm.ll.eval(dict(zip(s, xv)))
+        ll = self.f_glm_ll.f(*xv)
         A[n_pre, n_post] = A_init
 
         return ll
@@ -914,8 +935,13 @@ def gibbs_sample(population,
     pr = cProfile.Profile()
     pr.enable()
 
-    # Alternate fitting the network and fitting the GLMs
-    x_smpls = [x0]
+    # Keep the GLM parameters in a single matrix so that each sample is
+    # saved with one array copy
+    x0 = as_population_state(x0)
+
+    # Alternate fitting the network and fitting the GLMs. The first sample
+    # is a copy since x0 is updated in place.
+    x_smpls = [x0.snapshot()]
     x = x0
 
     import time
@@ -944,7 +970,7 @@ def gibbs_sample(population,
         for serial_update in serial_updates:
             serial_update.update(x)
 
-        x_smpls.append(copy.deepcopy(x))
+        x_smpls.append(x.snapshot())
 
     pr.disable()
     s = StringIO.StringIO()
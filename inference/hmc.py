@@ -16,7 +16,8 @@ def hmc(U,
         avg_accept_time_const=0.95,
         avg_accept_rate=0.9,
         min_step_sz=0.001,
-        max_step_sz=1.0):
+        max_step_sz=1.0,
+        U_and_grad_U=None):
     """
     U       - function handle to compute log probability we are sampling
     grad_U  - function handle to compute the gradient of the density with respect 
@@ -24,8 +25,17 @@ def hmc(U,
     step_sz - step size
     n_steps       - number of steps to take
     q_curr  - current state
+    U_and_grad_U - optional function handle that computes the potential and
+                   its gradient together. It is used at the start and end of
+                   the trajectory where both are needed. U and grad_U may
+                   be None if it is given.
     
     """
+    if U_and_grad_U is None:
+        U_and_grad_U = lambda q: (U(q), grad_U(q))
+    if grad_U is None:
+        grad_U = lambda q: U_and_grad_U(q)[1]
+
     # Start at current state
     q = np.copy(q_curr)
     # Moment is simplest for a normal rv
@@ -33,13 +43,14 @@ def hmc(U,
     p_curr = p
     
     # Evaluate potential and kinetic energies at start of trajectory
-    U_curr = U(q_curr)
+    U_curr, g = U_and_grad_U(q)
     K_curr = np.sum(p_curr**2)/2
     
     # Make a half step in the momentum variable
-    p -= step_sz*grad_U(q)/2
+    p -= step_sz*g/2
     
     # Alternate L full steps for position and momentum
+    U_prop = U_curr
     for i in np.arange(n_steps):
         q += step_sz*p
         
@@ -47,13 +58,14 @@ def hmc(U,
         if i < n_steps-1:
             p -= step_sz*grad_U(q)
         else:
-            p -= step_sz*grad_U(q)/2
+            # Evaluate the potential at the end of the trajectory too
+            U_prop, g = U_and_grad_U(q)
+            p -= step_sz*g/2
     
     # Negate the momentum at the end of the trajectory to make proposal symmetric?
     p = -p
     
-    # Evaluate potential and kinetic energies at end of trajectory
-    U_prop = U(q)
+    # Evaluate kinetic energy at end of trajectory
     K_prop = np.sum(p**2)/2
     
     # Accept or reject new state with probability proportional to change in energy.
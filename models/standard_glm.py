@@ -5,6 +5,10 @@ StandardGlm = \
 {
     # Number of neurons (parametric model!)
     'N' : 2,
+
+    # Store the filtered spike trains and stimulus in 'single' or 'double'
+    # precision. The likelihood is always summed in double precision.
+    #'precision' : 'double',
     
     # Parameters of the nonlinearity
     'nonlinearity' :
@@ -27,6 +31,13 @@ StandardGlm = \
             'type' : 'none',
             'D_stim' : 1,       # Dimensionality of the stimulus
             'dt_max' : 0.3,
+            # Upsample the stimulus to the time bins by 'linear' or
+            # piecewise 'constant' interpolation
+            #'interp' : 'linear',
+            # Filter the stimulus at the resolution of the time bins ('data')
+            # or of the stimulus frames ('stim'), which requires a whole
+            # number of bins per frame
+            #'resolution' : 'data',
             'prior' : 
                 {
                     'type' : 'spherical_gaussian',
@@ -50,6 +61,11 @@ StandardGlm = \
         {
             'type' : 'basis',
             'dt_max' : 0.2,
+            # Memory map the filtered spike trains in this directory and
+            # compute them in chunks of this many time bins. This bounds
+            # the memory of Population(model, engine='analytic') only.
+            # 'memmap_dir' : '/tmp',
+            # 'chunk_sz' : 10000,
             'prior' :
                 {
                     'type' : 'group_lasso',
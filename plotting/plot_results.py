@@ -492,7 +492,7 @@ def plot_results(population,
                 plot_firing_rate(s_true['glms'][n], color='k', T_lim=T_lim)
             
             # Plot the spike times
-            St = np.nonzero(population.glm.S.get_value()[T_lim,n])[0]
+            St = np.nonzero(population.glm.spike_counts(n)[T_lim])[0]
             plt.plot(St,s_avg['glms'][n]['lam'][T_lim][St],'ko')
             
             plt.title('Firing rate %d' % n)
@@ -504,7 +504,7 @@ def plot_results(population,
         print "Plotting KS test results"
         for n in range(N):
             f = plt.figure()
-            St = np.nonzero(population.glm.S.get_value()[:,n])[0]
+            St = np.nonzero(population.glm.spike_counts(n))[0]
             plot_ks(s_avg['glms'][n], St, population.glm.dt.get_value())
             f.savefig(os.path.join(resdir, 'ks_%d.pdf' %n))
             plt.close(f)
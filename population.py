@@ -1,17 +1,27 @@
+import copy
 import numpy as np
+import scipy.sparse
 
 from glm import Glm
+from analytic_glm import AnalyticGlm
+from simulator import EventSimulator, SpikeCountCheck
 from components.network import Network
 
-from utils.theano_func_wrapper import seval
+from utils.theano_func_wrapper import seval, compile_expr
+from utils.io import segment_data
+from utils.population_state import PopulationState
 
 class Population:
     """
     Population connected GLMs.
     """
-    def __init__(self, model):
+    def __init__(self, model, engine='theano'):
         """
         Initialize the population of GLMs connected by a network.
+        The log probability of the GLMs and its derivatives are evaluated
+        with compiled Theano functions (engine='theano'), or in closed form
+        with NumPy (engine='analytic') for the models supported by
+        analytic_glm.
         """
         self.model = model
         self.N = model['N']
@@ -28,6 +38,26 @@ class Population:
         # can manually leverage conditional independencies among GLMs
         self.glm = Glm(model, self.network)
 
+        # The data the population is conditioned on
+        self.data = None
+
+        self.engine = engine.lower()
+        if self.engine == 'analytic':
+            self.analytic = AnalyticGlm(self)
+        elif self.engine == 'theano':
+            self.analytic = None
+        else:
+            raise Exception("Unrecognized engine: %s" % engine)
+
+        # Memory mapping the filtered spike trains only bounds the memory of
+        # the closed form engine, which reduces over chunks of time bins.
+        # The Theano graphs make TxNxB temporaries from all of them.
+        if self.engine != 'analytic' and \
+           model['impulse'].get('memmap_dir', None) is not None:
+            print "WARNING: The filtered spike trains are memory mapped, but " \
+                  "only engine='analytic' evaluates them a chunk at a time. " \
+                  "The Theano engine still reads them into memory at once."
+
     def compute_log_p(self, vars):
         """ Compute the log joint probability under a given set of variables
         """
@@ -35,33 +65,54 @@ class Population:
 
         # Get set of symbolic variables
         syms = self.get_variables()
-
         lp += seval(self.network.log_p,
                     syms['net'],
                     vars['net'])
-        for n in range(self.N):
-            nvars = self.extract_vars(vars, n)
-            lp += seval(self.glm.log_p,
-                        syms,
-                        nvars)
+
+        if self.analytic is not None:
+            for n in np.arange(self.N):
+                lp += self.analytic.log_p(self.extract_vars(vars, n))
+        else:
+            # Evaluate the log probability of all GLMs at once
+            lls, lps = self._eval_batched(vars)
+            lp += np.sum(lls) + np.sum(lps)
 
         return lp
 
     def compute_ll(self, vars):
         """ Compute the log likelihood under a given set of variables
         """
-        ll = 0.0
+        return np.sum(self.compute_lls(vars))
 
-        # Get set of symbolic variables
-        syms = self.get_variables()
+    def compute_lls(self, vars):
+        """ Compute the length-N vector of log likelihoods of each GLM
+            under a given set of variables
+        """
+        if self.analytic is not None:
+            return np.array([self.analytic.ll(self.extract_vars(vars, n))
+                             for n in np.arange(self.N)])
 
-        for n in range(self.N):
-            nvars = self.extract_vars(vars, n)
-            ll += seval(self.glm.ll,
-                        syms,
-                        nvars)
+        lls, _ = self._eval_batched(vars)
+        return lls
 
-        return ll
+    def _eval_batched(self, vars):
+        """ Evaluate the log likelihoods and log priors of all GLMs
+            with a single function call
+        """
+        batched = self.glm.get_batched_expressions()
+        syms = {'net' : self.network.get_variables(),
+                'glm' : batched['syms']}
+        f = compile_expr([batched['ll'], batched['log_prior']], syms)
+
+        if isinstance(vars, PopulationState):
+            # The stacked values are views of the parameter matrix
+            sglm = _stack_state_values(batched['syms'], vars)
+        else:
+            sglm = _stack_values(batched['syms'], vars['glms'])
+        svars = {'net' : vars['net'],
+                 'glm' : sglm}
+        lls, lps = f(svars)
+        return lls, lps
 
     def eval_state(self, vars):
         """ Evaluate the population state expressions given the parameters, 
@@ -117,7 +168,8 @@ class Population:
 
     def sample(self):
         """
-        Sample parameters of the GLM from the prior
+        Sample parameters of the GLM from the prior. The GLM parameters of
+        all neurons are stored in a single matrix of a PopulationState.
         """
         v = {}
         v['net'] = self.network.sample()
@@ -127,7 +179,7 @@ class Population:
             xn['n'] = n
             v['glms'].append(xn)
 
-        return v
+        return PopulationState(v)
 
     def extract_vars(self, vals, n):
         """ Hacky helper function to extract the variables for only the
@@ -155,14 +207,21 @@ class Population:
         """
         Condition on the data
         """
+        self.data = data
         self.network.set_data(data)
         self.glm.set_data(data)
 
-    def simulate(self, vars,  (T_start,T_stop), dt):
+    def simulate(self, vars,  (T_start,T_stop), dt, sparse=False,
+                 method='event'):
         """ Simulate spikes from a network of coupled GLMs
         :param vars - the variables corresponding to each GLM
         :type vars    list of N variable vectors
         :param dt    - time steps to simulate
+        :param sparse - return the spike counts as a sparse CSR matrix
+        :param method - 'event' to skip from spike to spike with the
+                        event-driven simulator in simulator.py, or 'step' to
+                        step through every time bin. Both give the same
+                        spikes.
 
         :rtype TxN matrix of spike counts in each bin
         """
@@ -173,7 +232,130 @@ class Population:
         assert len(t) == len(t_ind)
         nT = len(t)
 
-        # Get set of symbolic variables
+        # Initialize the background rate
+        X = self._background_currents(vars, nT)
+
+        print "Max background rate: %s" % str(self.glm.nlin_model.f_nlin(np.amax(X)))
+
+        # Generate the spikes. Only the nonzero counts are recorded.
+        thr = -np.log(np.random.rand(N))
+        if method == 'event':
+            (pre, post, K) = self._connection_kernels(vars)
+            simulator = EventSimulator(N, pre, post, K,
+                                       self.glm.nlin_model.f_nlin, dt)
+            (spk_t, spk_n, spk_c, n_exceptions) = simulator.simulate(X, thr)
+        elif method == 'step':
+            (spk_t, spk_n, spk_c, n_exceptions) = \
+                self._simulate_steps(vars, X, thr, dt)
+        else:
+            raise Exception("Unrecognized simulation method: %s" % method)
+
+        S = scipy.sparse.coo_matrix((spk_c, (spk_t, spk_n)), shape=(nT,N)).tocsr()
+                
+        # DEBUG:
+        check = SpikeCountCheck(N, self.glm.nlin_model.f_nlin, dt)
+        check.update(X, np.asarray(S.sum(0)).ravel())
+        check.report(n_exceptions)
+
+        if not sparse:
+            S = S.toarray()
+        return S,X
+
+    def simulate_chunks(self, vars, data, T_chunk, currents=False):
+        """ Simulate spikes from a network of coupled GLMs a chunk of time at
+            a time, so that recordings too long to hold in memory can be
+            simulated and passed to a consumer or written to disk (see
+            utils.dataset.save_dataset_chunks). Only the currents of the
+            T_imp bins after a chunk are carried over to the next one, and
+            the spikes are identical to those of simulate() with
+            method='event'.
+
+            The background currents of each chunk are computed from a
+            segment of data (see utils.io.segment_data). The filtered
+            stimulus is still computed for the whole recording, so long
+            recordings are best simulated with the stimulus filtered at the
+            resolution of its frames ('resolution' : 'stim'). The data the
+            population was set to before the call is restored when the
+            generator is exhausted or closed.
+
+        :param vars    the variables corresponding to each GLM
+        :param data    the data to simulate, with the stimulus, 'dt_stim',
+                       'dt', 'N' and the length 'T'. Spike counts 'S' are
+                       not needed.
+        :param T_chunk length of each chunk (sec)
+        :param currents include the currents of each chunk
+
+        :rtype generator of a dictionary for each chunk, with the first and
+               last time bins 'start' and 'stop', the sparse CSR matrix of
+               spike counts 'S' and, if currents is True, the currents 'X'
+        """
+        N = self.model['N']
+        dt = data['dt']
+        if 'S' not in data:
+            data = dict(data)
+            data['S'] = scipy.sparse.csr_matrix((int(data['T']/dt), N))
+        nT = data['S'].shape[0]
+        chunk_sz = max(1, int(np.round(T_chunk/dt)))
+
+        # Restore the data of the population once the chunks are done, or
+        # if the consumer stops early and the generator is closed
+        prev = self.data
+        try:
+            # Set the data of the first chunk, on its own, so that the impulse
+            # responses are evaluated at the resolution of the data
+            first = segment_data(data, (0, min(chunk_sz*dt, data['T'])))
+            del first['segment']
+            self.set_data(first)
+
+            (pre, post, K) = self._connection_kernels(vars)
+            T_imp = K.shape[1]
+            f_nlin = self.glm.nlin_model.f_nlin
+            simulator = EventSimulator(N, pre, post, K, f_nlin, dt)
+            check = SpikeCountCheck(N, f_nlin, dt)
+
+            acc = np.zeros(N)
+            thr = -np.log(np.random.rand(N))
+            n_exceptions = 0
+            max_bkgd = -np.inf
+
+            # The currents of the bins after the last chunk, including the
+            # responses to its spikes
+            X_next = np.zeros((0,N))
+            for start in np.arange(0, nT, chunk_sz):
+                stop = min(start + chunk_sz, nT)
+
+                # Compute the background currents of the chunk and of the T_imp
+                # bins after it which are not carried over
+                end = min(stop + T_imp, nT)
+                X_bkgd = self._segment_currents(vars, data, start + len(X_next), end)
+                if len(X_bkgd) > 0:
+                    max_bkgd = max(max_bkgd, np.amax(X_bkgd))
+                X = np.vstack((X_next, X_bkgd))
+
+                (spk_t, spk_n, spk_c, n_exc) = \
+                    simulator.advance(X, stop-start, acc, thr)
+                n_exceptions += n_exc
+                X_next = X[stop-start:].copy()
+
+                S = scipy.sparse.coo_matrix((spk_c, (spk_t, spk_n)),
+                                            shape=(stop-start,N)).tocsr()
+                check.update(X[:stop-start], np.bincount(spk_n, spk_c, minlength=N))
+
+                chunk = {'start' : start, 'stop' : stop, 'S' : S}
+                if currents:
+                    chunk['X'] = X[:stop-start]
+                yield chunk
+
+            print "Max background rate: %s" % str(f_nlin(max_bkgd))
+            check.report(n_exceptions)
+        finally:
+            if prev is not None:
+                self.set_data(prev)
+
+    def _background_currents(self, vars, nT):
+        """ Compute the nTxN bias and stimulus currents of the data
+        """
+        N = self.model['N']
         syms = self.get_variables()
 
         # Initialize the background rate
@@ -190,8 +372,65 @@ class Population:
             X[:,n] += seval(self.glm.bkgd_model.I_stim,
                             syms,
                             nvars)
+        return X
 
-        print "Max background rate: %s" % str(self.glm.nlin_model.f_nlin(np.amax(X)))
+    def _segment_currents(self, vars, data, start, stop):
+        """ Compute the background currents of the time bins start:stop of
+            data by setting the stimulus to that segment of the data
+        """
+        if stop <= start:
+            return np.zeros((0, self.model['N']))
+        dt = data['dt']
+        seg = segment_data(data, (start*dt, min(stop*dt, data['T'])))
+        self.glm.bkgd_model.set_data(seg)
+        return self._background_currents(vars, stop-start)
+
+    def _connection_kernels(self, vars):
+        """ Get the weighted impulse responses of the connections with
+            nonzero weight. The connections are found from the nonzero
+            pattern of A*W, and for each postsynaptic neuron only the impulse
+            responses of its presynaptic neurons are evaluated, so the cost
+            of the impulse responses is proportional to the number of
+            connections rather than to NxNxT_imp. A and W themselves are
+            still evaluated as dense NxN matrices.
+
+        :rtype the presynaptic and postsynaptic neurons of the connections,
+               and the CxT_imp matrix of their weighted impulse responses
+        """
+        N = self.model['N']
+        syms = self.get_variables()
+        A = seval(self.network.graph.A, syms['net'], vars['net'])
+        W = seval(self.network.weights.W, syms['net'], vars['net'])
+
+        # The connections ordered by postsynaptic neuron
+        (post, pre) = np.nonzero((A * W).T)
+        if len(pre) == 0:
+            return pre, post, np.zeros((0,0))
+        ptr = np.concatenate(([0], np.cumsum(np.bincount(post, minlength=N))))
+
+        # Evaluate the impulse responses of the presynaptic neurons of each
+        # GLM only, binding their indices as in coord_descent
+        imp_model = self.glm.imp_model
+        imp_syms = copy.copy(syms)
+        imp_syms['n_pre'] = imp_model.n_pre
+        K = []
+        for n_post in np.unique(post):
+            n_pre = pre[ptr[n_post]:ptr[n_post+1]]
+            nvars = self.extract_vars(vars, n_post)
+            imp = seval(imp_model.impulse_pre, imp_syms, nvars,
+                        {'n_pre' : n_pre})
+            K.append(np.reshape(A[n_pre,n_post] * W[n_pre,n_post], [-1,1]) *
+                     imp)
+        return pre, post, np.vstack(K)
+
+    def _simulate_steps(self, vars, X, thr, dt):
+        """ Simulate spikes by stepping through every time bin. Only the
+            counts of the current bin are kept densely, the nonzero counts
+            are recorded.
+        """
+        N = self.model['N']
+        (nT,_) = X.shape
+        syms = self.get_variables()
 
         # Get the impulse response functions
         imps = []
@@ -209,10 +448,11 @@ class Population:
         # print "Effective impulse weights: "
         # print Weff
 
-        # Iterate over each time step and generate spikes
-        S = np.zeros((nT,N))
+        S_t = np.zeros(N)
+        spk_t = []
+        spk_n = []
+        spk_c = []
         acc = np.zeros(N)
-        thr = -np.log(np.random.rand(N))
 
         # TODO: Handle time-varying weights appropriately
         time_varying_weights = False
@@ -242,8 +482,9 @@ class Population:
             acc = acc + lam*dt
 
             # Spike if accumulator exceeds threshold
+            S_t[:] = 0
             i_spk = acc > thr
-            S[t,i_spk] += 1
+            S_t[i_spk] += 1
             n_spk = np.sum(i_spk)
 
             # Compute the length of the impulse response
@@ -268,7 +509,7 @@ class Population:
             # Cap the number of spikes in a time bin
             max_spks_per_bin = 10
             while n_spk > 0:
-                if np.any(S[t,:] >= max_spks_per_bin):
+                if np.any(S_t >= max_spks_per_bin):
                     #print "Limiting to at most %d spikes in time bin %d" % \
                     #      (max_spks_per_bin, t)
                     n_exceptions += 1
@@ -286,32 +527,46 @@ class Population:
                 thr[i_spk] = -np.log(np.random.rand(n_spk))
 
                 i_spk = acc > thr
-                S[t,i_spk] += 1
+                S_t[i_spk] += 1
                 n_spk = np.sum(i_spk)
 
                 #if np.any(S[t,:]>10):
                 #    import pdb
                 #    pdb.set_trace()
                 #    raise Exception("More than 10 spikes in a bin! Decrease variance on impulse weights or decrease simulation bin width.")
-                
-        # DEBUG:
-        tt = dt * np.arange(nT)
-        lam = np.zeros_like(X)
-        for n in np.arange(N):
-            lam[:,n] = self.glm.nlin_model.f_nlin(X[:,n])
-            
-        print "Max firing rate (post sim): %f" % np.max(lam)
-        E_nS = np.trapz(lam,tt,axis=0)
-        nS = np.sum(S,0)
-
-        print "Sampled %s spikes." % str(nS)
-        print "Expected %s spikes." % str(E_nS)
-        # import pdb; pdb.set_trace()
 
-        if np.any(np.abs(nS-E_nS) > 3*np.sqrt(E_nS)):
-            print "ERROR: Actual num spikes (%s) differs from expected (%s) by >3 std." % (str(nS),str(E_nS))
+            n_nz = np.nonzero(S_t)[0]
+            if len(n_nz) > 0:
+                spk_t.append(t*np.ones(len(n_nz), dtype=np.int64))
+                spk_n.append(n_nz)
+                spk_c.append(S_t[n_nz])
 
-        print "Number of exceptions arising from multiple spikes per bin: %d" % n_exceptions
+        # Collect the recorded spikes into a matrix
+        if len(spk_t) > 0:
+            (spk_t, spk_n, spk_c) = map(np.concatenate, (spk_t, spk_n, spk_c))
+        return spk_t, spk_n, spk_c, n_exceptions
 
-        return S,X
+def _stack_values(ssyms, vals_list):
+    """ Stack the values of each variable in ssyms across a list of
+        per-neuron dictionaries
+    """
+    svals = {}
+    for (k,v) in ssyms.items():
+        if isinstance(v, dict):
+            svals[k] = _stack_values(v, [vals[k] for vals in vals_list])
+        else:
+            svals[k] = np.array([vals[k] for vals in vals_list])
+    return svals
+
+def _stack_state_values(ssyms, state, prefix=()):
+    """ Stack the values of each variable in ssyms across the neurons of a
+        PopulationState
+    """
+    svals = {}
+    for (k,v) in ssyms.items():
+        if isinstance(v, dict):
+            svals[k] = _stack_state_values(v, state, prefix + (k,))
+        else:
+            svals[k] = state.glm_values(prefix + (k,))
+    return svals
 
@@ -0,0 +1,250 @@
+""" Event-driven simulation of a network of coupled GLMs. The time bins
+    between spikes are simulated a block at a time: the rates in a block
+    only depend on currents that are already known, so the accumulators of
+    all neurons are advanced with one cumulative sum, and the first bin in
+    which an accumulator exceeds its threshold is the next spike. Only the
+    spike bins are processed one at a time, and each spike only adds its
+    impulse responses to the postsynaptic neurons it is connected to. The
+    impulse responses of the nonzero connections are stored by presynaptic
+    neuron, like the rows of a CSR matrix, so a spike costs
+    O(out-degree * T_imp) and sparse networks of many neurons never need an
+    NxNxT_imp array.
+
+    The accumulators, thresholds and currents are updated with the same
+    floating point operations, in the same order, as stepping through every
+    bin, and the random thresholds are drawn in the same order, so the
+    simulated spikes are identical under a fixed seed. The same holds when a
+    long simulation is advanced a chunk of bins at a time, carrying the
+    accumulators, thresholds and the currents of the next T_imp bins over
+    from one chunk to the next (see Population.simulate_chunks).
+"""
+import numpy as np
+
+class EventSimulator:
+    """ Simulate spikes given the background currents of every neuron and
+        the weighted impulse responses of every connection.
+    """
+    def __init__(self, N, pre, post, K, f_nlin, dt, max_spks_per_bin=10,
+                 min_block=8, max_block=4096):
+        """
+        :param N      number of neurons
+        :param pre    presynaptic neurons of the nonzero connections
+        :param post   postsynaptic neurons of the nonzero connections
+        :param K      CxT_imp weighted impulse responses of the C
+                      connections. The response to a spike in bin t starts
+                      in bin t+1.
+        :param f_nlin the nonlinearity mapping currents to rates
+        :param max_spks_per_bin cap on the number of spikes of a neuron in
+                      one bin
+        """
+        self.N = N
+        self.T_imp = K.shape[1]
+        self.f_nlin = f_nlin
+        self.dt = dt
+        self.max_spks_per_bin = max_spks_per_bin
+        self.min_block = min_block
+        self.max_block = max_block
+
+        # Sort the connections by presynaptic and then postsynaptic neuron.
+        # The connections of neuron n are ptr[n]:ptr[n+1].
+        order = np.lexsort((post, pre))
+        self.post = np.asarray(post, dtype=np.int64)[order]
+        self.K = K[order]
+        self.ptr = np.concatenate(([0], np.cumsum(np.bincount(pre, minlength=N))))
+
+        # If every pair is connected, store the responses as (pre, lag, post)
+        # so that the response of a spike is a contiguous block of future
+        # bins
+        self.dense = len(self.post) == N*N
+        if self.dense:
+            self.K = np.ascontiguousarray(
+                np.transpose(np.reshape(self.K, (N,N,self.T_imp)), (0,2,1)))
+
+    def simulate(self, X, thr):
+        """ Simulate spikes. The impulse responses of the spikes are added to
+            the TxN currents X in place.
+        :param X      TxN background currents
+        :param thr    length N vector of initial thresholds
+
+        :rtype the time bins, neurons and counts of the nonzero spike counts,
+               ordered by time bin, and the number of bins in which a
+               neuron reached max_spks_per_bin
+        """
+        return self.advance(X, X.shape[0], np.zeros(X.shape[1]), thr.copy())
+
+    def advance(self, X, nT, acc, thr):
+        """ Simulate the first nT bins of the currents X, starting from the
+            accumulators acc and thresholds thr, which are updated in place.
+            The impulse responses of the spikes are added to all rows of X,
+            so the rows after nT receive the responses that extend past the
+            simulated bins.
+
+        :rtype as for simulate
+        """
+        acc_out = acc
+        spk_t = []
+        spk_n = []
+        spk_c = []
+        n_exceptions = 0
+
+        t = 0
+        L = self.min_block
+        while t < nT:
+            # Advance the accumulators through a block of bins. The first
+            # row of cumsum is the current accumulator, so each row is the
+            # accumulator of the previous bin plus lam*dt.
+            stop = min(t + L, nT)
+            lam = self.f_nlin(X[t:stop,:])
+            acc_blk = np.cumsum(np.vstack((acc[None,:], lam*self.dt)), axis=0)[1:]
+            crossed = np.nonzero(np.any(acc_blk > thr, axis=1))[0]
+            if len(crossed) == 0:
+                acc = acc_blk[-1]
+                t = stop
+                L = min(2*L, self.max_block)
+                continue
+
+            # Simulate the bin of the next spike
+            i = crossed[0]
+            acc = acc_blk[i].copy()
+            t += i
+            (S_t, acc, thr, exception) = self._spike_bin(X, t, acc, thr)
+            n_exceptions += exception
+
+            n_nz = np.nonzero(S_t)[0]
+            spk_t.append(t*np.ones(len(n_nz), dtype=np.int64))
+            spk_n.append(n_nz)
+            spk_c.append(S_t[n_nz])
+
+            # Spikes tend to be followed by more spikes, so look a little
+            # further ahead than the last one
+            L = max(self.min_block, 2*(i+1))
+            t += 1
+
+        acc_out[:] = acc
+        if len(spk_t) > 0:
+            (spk_t, spk_n, spk_c) = map(np.concatenate, (spk_t, spk_n, spk_c))
+        else:
+            (spk_t, spk_n, spk_c) = (np.zeros(0, dtype=np.int64),
+                                     np.zeros(0, dtype=np.int64),
+                                     np.zeros(0))
+        return spk_t, spk_n, spk_c, n_exceptions
+
+    def _spike_bin(self, X, t, acc, thr):
+        """ Generate the spikes in bin t, given the accumulators after adding
+            the rate in bin t. Each spike resets the accumulator of its neuron
+            and draws a new threshold, and spikes are generated until no
+            accumulator exceeds its threshold.
+        """
+        (nT,N) = X.shape
+        S_t = np.zeros(N)
+        i_spk = acc > thr
+        S_t[i_spk] += 1
+        n_spk = np.sum(i_spk)
+
+        # Compute the length of the impulse response
+        t_imp = np.minimum(nT-t-1, self.T_imp)
+
+        exception = 0
+        while n_spk > 0:
+            if np.any(S_t >= self.max_spks_per_bin):
+                exception = 1
+                break
+
+            # Add the weighted impulse responses to the currents of the
+            # connected postsynaptic neurons
+            if t_imp > 0:
+                self._add_responses(X, t, t_imp, np.nonzero(i_spk)[0])
+
+            # Subtract threshold from the accumulator
+            acc -= thr*i_spk
+            acc[acc<0] = 0
+
+            # Set new threshold after spike
+            thr[i_spk] = -np.log(np.random.rand(n_spk))
+
+            i_spk = acc > thr
+            S_t[i_spk] += 1
+            n_spk = np.sum(i_spk)
+
+        return S_t, acc, thr, exception
+
+    def _add_responses(self, X, t, t_imp, pre):
+        """ Add the responses to spikes of the neurons pre in bin t to the
+            currents in bins t+1:t+t_imp+1. The responses of simultaneous
+            spikes are summed before they are added to the currents.
+        """
+        if self.dense:
+            if len(pre) == 1:
+                X[t+1:t+t_imp+1] += self.K[pre[0], :t_imp]
+            else:
+                X[t+1:t+t_imp+1] += np.sum(self.K[pre, :t_imp], 0)
+            return
+
+        if len(pre) == 1:
+            (start, stop) = (self.ptr[pre[0]], self.ptr[pre[0]+1])
+            if stop > start:
+                X[t+1:t+t_imp+1, self.post[start:stop]] += \
+                    self.K[start:stop, :t_imp].T
+            return
+
+        # Sum the responses of the connected postsynaptic neurons in order
+        # of the presynaptic neuron, as np.sum over the presynaptic neurons
+        # would, and add them to the currents at once
+        conns = [np.arange(self.ptr[n], self.ptr[n+1]) for n in pre]
+        post = np.unique(self.post[np.concatenate(conns)])
+        if len(post) == 0:
+            return
+        resp = np.zeros((len(post), t_imp))
+        for c in conns:
+            resp[np.searchsorted(post, self.post[c])] += self.K[c, :t_imp]
+        X[t+1:t+t_imp+1, post] += resp.T
+
+class SpikeCountCheck:
+    """ Compare the number of spikes of each neuron with the number expected
+        from its firing rate, accumulating both a chunk of bins at a time so
+        that the rates of a long simulation are never held at once. The
+        expected number is the trapezoidal integral of the rate, as np.trapz
+        over all bins would compute it.
+    """
+    def __init__(self, N, f_nlin, dt):
+        self.f_nlin = f_nlin
+        self.dt = dt
+        self.nS = np.zeros(N)
+        self.sum_lam = np.zeros(N)
+        self.lam_first = None
+        self.lam_last = None
+        self.max_lam = -np.inf
+
+    def update(self, X, nS):
+        """ Add the TxN currents of the next chunk of bins, after the
+            simulation, and the number of spikes of each neuron in them
+        """
+        self.nS += nS
+        if X.shape[0] == 0:
+            return
+        lam = self.f_nlin(X)
+        self.sum_lam += np.sum(lam, axis=0)
+        if self.lam_first is None:
+            self.lam_first = lam[0].copy()
+        self.lam_last = lam[-1].copy()
+        self.max_lam = max(self.max_lam, np.max(lam))
+
+    def expected(self):
+        """ Expected number of spikes of each neuron
+        """
+        if self.lam_first is None:
+            return np.zeros_like(self.nS)
+        return self.dt * (self.sum_lam - 0.5*(self.lam_first + self.lam_last))
+
+    def report(self, n_exceptions):
+        """ Print the actual and expected numbers of spikes
+        """
+        E_nS = self.expected()
+        print "Max firing rate (post sim): %f" % self.max_lam
+        print "Sampled %s spikes." % str(self.nS)
+        print "Expected %s spikes." % str(E_nS)
+
+        if np.any(np.abs(self.nS-E_nS) > 3*np.sqrt(E_nS)):
+            print "ERROR: Actual num spikes (%s) differs from expected (%s) by >3 std." % (str(self.nS),str(E_nS))
+
+        print "Number of exceptions arising from multiple spikes per bin: %d" % n_exceptions
@@ -0,0 +1,81 @@
+# Run as script using 'python -m test.benchmark_convolution'
+import time
+import numpy as np
+
+from utils.basis import create_basis, convolve_with_basis, \
+                        choose_convolution_method
+
+def parse_cmd_line_args():
+    """
+    Parse command line parameters
+    """
+    from optparse import OptionParser
+
+    parser = OptionParser()
+    parser.add_option("-N", "--N", dest="N", default=10,
+                      help="Number of neurons.")
+
+    parser.add_option("-T", "--T_stop", dest="T_stop", default=100.0,
+                      help="Length of the spike trains (sec).")
+
+    parser.add_option("-r", "--rates", dest="rates", default='1,5,20,100,500',
+                      help="Comma separated list of firing rates (Hz).")
+
+    parser.add_option("-d", "--dt_max", dest="dt_max", default=0.2,
+                      help="Length of the impulse responses (sec).")
+
+    (options, args) = parser.parse_args()
+
+    options.N = int(options.N)
+    options.T_stop = float(options.T_stop)
+    options.dt_max = float(options.dt_max)
+    options.rates = map(float, options.rates.split(','))
+    return (options, args)
+
+def interpolated_basis(dt, dt_max):
+    """ Create the cosine basis of the standard GLM at the resolution of
+        the data, as the impulse response components do.
+    """
+    basis = create_basis({'type' : 'cosine',
+                          'n_eye' : 0,
+                          'n_cos' : 5,
+                          'a' : 1.0/120,
+                          'b' : 0.5,
+                          'orth' : False,
+                          'norm' : True})
+    (L,B) = basis.shape
+    t_int = np.arange(0.0, dt_max, step=dt)
+    t_bas = np.linspace(0.0, dt_max, L)
+    ibasis = np.zeros((len(t_int), B))
+    for b in np.arange(B):
+        ibasis[:,b] = np.interp(t_int, t_bas, basis[:,b])
+    return ibasis
+
+def run_benchmark():
+    """ Time the FFT and the event-driven convolution of spike trains with
+        an impulse response basis, from sparse to dense firing.
+    """
+    options, args = parse_cmd_line_args()
+    dt = 0.001
+    nT = int(options.T_stop/dt)
+    ibasis = interpolated_basis(dt, options.dt_max)
+
+    print "N=%d, T=%d bins, R=%d, B=%d" % ((options.N, nT) + ibasis.shape)
+    for rate in options.rates:
+        S = np.random.poisson(rate*dt, size=(nT, options.N)).astype(np.float)
+
+        times = {}
+        results = {}
+        for method in ['fft', 'sparse']:
+            start = time.time()
+            results[method] = convolve_with_basis(S, ibasis, method=method)
+            times[method] = time.time() - start
+
+        err = np.max(np.abs(results['fft'] - results['sparse']))
+        print "%6.1f Hz (%.2f%% nonzero):\tfft %.3fs\tsparse %.3fs\t" \
+              "auto chooses %s\tmax error %.1e" % \
+              (rate, 100.0*np.count_nonzero(S)/S.size, times['fft'],
+               times['sparse'], choose_convolution_method(S, ibasis), err)
+
+if __name__ == "__main__":
+    run_benchmark()
@@ -0,0 +1,86 @@
+# Run as script using 'python -m test.benchmark_fused_grad'
+import copy
+import time
+import numpy as np
+
+from population import Population
+from models.model_factory import make_model
+from inference.coord_descent import prep_glm_inference, fit_glm
+from check_harness import simulate_data
+
+def parse_cmd_line_args():
+    """
+    Parse command line parameters
+    """
+    from optparse import OptionParser
+
+    parser = OptionParser()
+    parser.add_option("-m", "--model", dest="model", default='standard_glm',
+                      help="Type of model to use. See model_factory.py for available types.")
+
+    parser.add_option("-N", "--N", dest="N", default=2,
+                      help="Number of neurons.")
+
+    parser.add_option("-T", "--T_stop", dest="T_stop", default=30.0,
+                      help="Length of the synthetic dataset (sec).")
+
+    (options, args) = parser.parse_args()
+
+    options.N = int(options.N)
+    options.T_stop = float(options.T_stop)
+    return (options, args)
+
+def count_calls(f, counts):
+    """ Wrap f so that each call counts as one pass over all T time bins
+    """
+    def counted(*args):
+        counts[0] += 1
+        return f(*args)
+    return counted
+
+def run_benchmark():
+    """ Count the number of full passes over the data per BFGS iteration
+        with separate and with fused log prob and gradient functions.
+    """
+    options, args = parse_cmd_line_args()
+    N = options.N
+
+    model = make_model(options.model, N=N)
+    popn = Population(model)
+
+    # Simulate a dataset to fit
+    data, x_true = simulate_data(popn, options.T_stop)
+    popn.set_data(data)
+
+    glm_syms, nll, grad_nll, hess_nll, nll_and_grad = prep_glm_inference(popn)
+    x0 = popn.sample()
+
+    # The separate functions are compiled lazily on first use. Compile them
+    # before timing.
+    fit_glm(popn.extract_vars(copy.deepcopy(x0), 0), 0,
+            (glm_syms, nll, grad_nll, hess_nll, None), False, False)
+
+    results = {}
+    for (name, fused) in [('separate', False), ('fused', True)]:
+        counts = [0]
+        prms = (glm_syms,
+                count_calls(nll, counts),
+                count_calls(grad_nll, counts),
+                hess_nll,
+                count_calls(nll_and_grad, counts) if fused else None)
+
+        n_iters = 0
+        start = time.time()
+        for n in np.arange(N):
+            nvars = popn.extract_vars(copy.deepcopy(x0), n)
+            n_iters += fit_glm(nvars, n, prms, False, False)
+        results[name] = (counts[0], n_iters, time.time()-start)
+
+    for name in ['separate', 'fused']:
+        (n_passes, n_iters, elapsed) = results[name]
+        print "%s:\t%d passes over T in %d BFGS iterations " \
+              "(%.2f passes/iter, %.2fs)" % \
+              (name, n_passes, n_iters, float(n_passes)/max(n_iters,1), elapsed)
+
+if __name__ == "__main__":
+    run_benchmark()
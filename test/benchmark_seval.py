@@ -0,0 +1,115 @@
+# Run as script using 'python -m test.benchmark_seval'
+import time
+import hashlib
+import numpy as np
+import theano
+
+from population import Population
+from models.model_factory import make_model
+from utils.theano_func_wrapper import seval, compile_expr, get_registry, \
+                                      _flatten, _extract_vals
+
+def parse_cmd_line_args():
+    """
+    Parse command line parameters
+    """
+    from optparse import OptionParser
+
+    parser = OptionParser()
+    parser.add_option("-m", "--model", dest="model", default='standard_glm',
+                      help="Type of model to use. See model_factory.py for available types.")
+
+    parser.add_option("-N", "--N", dest="N", default=2,
+                      help="Number of neurons.")
+
+    parser.add_option("-T", "--T_stop", dest="T_stop", default=1.0,
+                      help="Length of the synthetic dataset (sec).")
+
+    parser.add_option("-n", "--n_calls", dest="n_calls", default=2000,
+                      help="Number of evaluations to time.")
+
+    (options, args) = parser.parse_args()
+
+    options.N = int(options.N)
+    options.T_stop = float(options.T_stop)
+    options.n_calls = int(options.n_calls)
+    return (options, args)
+
+# The previous implementation of seval, kept here as the baseline.
+_sha1_func_cache = {}
+def sha1_seval(expr, syms, vals, defaults=None, givens=[]):
+    hash_value = lambda v: hashlib.sha1(v).hexdigest() if \
+                           isinstance(v, np.ndarray) else v
+    hashable_givens = tuple(map(lambda (k,v): (k, hash_value(v)), givens))
+    hashable_syms = tuple(map(lambda v: hash_value(v), _flatten(syms)))
+    key = (expr, hashable_syms, hashable_givens)
+    if key in _sha1_func_cache.keys():
+        f = _sha1_func_cache[key]
+    else:
+        f = theano.function(_flatten(syms), expr, on_unused_input='ignore')
+        _sha1_func_cache[key] = f
+
+    args = _extract_vals(syms,vals,defaults)
+    return f(*args)
+
+def time_calls(fn, n_calls):
+    """ Time n_calls evaluations of fn and return the time per call
+    """
+    fn()
+    start = time.time()
+    for _ in np.arange(n_calls):
+        fn()
+    return (time.time() - start) / n_calls
+
+def run_benchmark():
+    """ Compare the cost of evaluating the GLM log probability with the
+        SHA1-keyed cache, with seval, and with a handle from the registry.
+    """
+    options, args = parse_cmd_line_args()
+
+    model = make_model(options.model, N=options.N)
+    popn = Population(model)
+
+    dt = 0.001
+    dt_stim = 0.1
+    nT = int(options.T_stop/dt)
+    data = {"S": np.random.poisson(0.01, size=(nT, options.N)).astype(np.float),
+            "N": options.N,
+            "dt": dt,
+            "T": options.T_stop,
+            "stim": np.random.randn(int(options.T_stop/dt_stim), 1),
+            "dt_stim": dt_stim}
+    popn.set_data(data)
+
+    x = popn.sample()
+    syms = popn.get_variables()
+    nvars = popn.extract_vars(x, 0)
+
+    # Populate the caches before timing
+    f = compile_expr(popn.glm.log_p, syms)
+    assert np.allclose(f(nvars), sha1_seval(popn.glm.log_p, syms, nvars))
+
+    print "Timing %d evaluations of the GLM log probability (N=%d, T=%d bins)" % \
+          (options.n_calls, options.N, nT)
+    t_sha1 = time_calls(lambda: sha1_seval(popn.glm.log_p, syms, nvars),
+                        options.n_calls)
+    t_seval = time_calls(lambda: seval(popn.glm.log_p, syms, nvars),
+                         options.n_calls)
+    t_handle = time_calls(lambda: f(nvars), options.n_calls)
+    t_kernel = time_calls(lambda: f.f(*f.plan.extract(nvars)),
+                          options.n_calls)
+    t_extract = time_calls(lambda: _extract_vals(syms, nvars),
+                           options.n_calls)
+    t_plan = time_calls(lambda: f.plan.extract(nvars),
+                        options.n_calls)
+
+    print "SHA1 keyed seval:\t%.1f us/call" % (1e6*t_sha1)
+    print "Registry seval:  \t%.1f us/call" % (1e6*t_seval)
+    print "Registry handle: \t%.1f us/call" % (1e6*t_handle)
+    print "Theano function: \t%.1f us/call" % (1e6*t_kernel)
+    print "Recursive extraction:\t%.1f us/call" % (1e6*t_extract)
+    print "Accessor plan:   \t%.1f us/call" % (1e6*t_plan)
+    print get_registry()
+
+if __name__ == "__main__":
+    run_benchmark()
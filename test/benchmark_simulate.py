@@ -0,0 +1,104 @@
+# Run as script using 'python -m test.benchmark_simulate'
+import time
+import numpy as np
+import scipy.sparse
+
+from population import Population
+from models.model_factory import make_model
+from check_harness import synth_data
+
+def parse_cmd_line_args():
+    """
+    Parse command line parameters
+    """
+    from optparse import OptionParser
+
+    parser = OptionParser()
+    parser.add_option("-m", "--model", dest="model", default='standard_glm',
+                      help="Type of model to use. See model_factory.py for available types.")
+
+    parser.add_option("-N", "--N", dest="N", default=10,
+                      help="Number of neurons.")
+
+    parser.add_option("-T", "--T_stop", dest="T_stop", default=60.0,
+                      help="Length of the simulation (sec).")
+
+    parser.add_option("-r", "--rho", dest="rho", default=None,
+                      help="Connection probability of the graph, for models "
+                           "with an Erdos-Renyi graph. Large sparse networks "
+                           "are best timed with '-M event'.")
+
+    parser.add_option("-M", "--methods", dest="methods", default='step,event',
+                      help="Comma separated list of simulation methods to "
+                           "time. The spikes of all methods must be identical. "
+                           "'stream' simulates a chunk of time at a time with "
+                           "Population.simulate_chunks.")
+
+    parser.add_option("-c", "--T_chunk", dest="T_chunk", default=10.0,
+                      help="Length of the chunks of the 'stream' method (sec).")
+
+    parser.add_option("-s", "--seed", dest="seed", default=0,
+                      help="Random seed.")
+
+    (options, args) = parser.parse_args()
+
+    options.N = int(options.N)
+    options.T_stop = float(options.T_stop)
+    options.seed = int(options.seed)
+    options.T_chunk = float(options.T_chunk)
+    if options.rho is not None:
+        options.rho = float(options.rho)
+    options.methods = options.methods.split(',')
+    return (options, args)
+
+def run_benchmark():
+    """ Time the simulation of a population with each method and check that
+        they generate the same spikes under the same seed.
+    """
+    options, args = parse_cmd_line_args()
+    N = options.N
+
+    model = make_model(options.model, N=N)
+    if options.rho is not None:
+        model['network']['graph']['rho'] = options.rho
+    popn = Population(model)
+
+    data = synth_data(N, options.T_stop)
+    dt = data['dt']
+    popn.set_data(data)
+    np.random.seed(options.seed)
+    x_true = popn.sample()
+
+    results = {}
+    times = {}
+    for method in options.methods:
+        np.random.seed(options.seed)
+        start = time.time()
+        if method == 'stream':
+            chunks = list(popn.simulate_chunks(x_true, data, options.T_chunk,
+                                               currents=True))
+            results[method] = (
+                scipy.sparse.vstack([c['S'] for c in chunks]).tocsr(),
+                np.vstack([c['X'] for c in chunks]))
+        else:
+            results[method] = popn.simulate(x_true, (0, options.T_stop), dt,
+                                            sparse=True, method=method)
+        times[method] = time.time() - start
+
+    ref = options.methods[0]
+    ok = True
+    for method in options.methods:
+        (S,X) = results[method]
+        same = (S != results[ref][0]).nnz == 0 and \
+               np.array_equal(X, results[ref][1])
+        ok = ok and same
+        print "%s:\t%d spikes in %.2fs, %.1f simulated sec per sec\t" \
+              "identical to %s: %s" % \
+              (method, S.sum(), times[method], options.T_stop/times[method],
+               ref, same)
+
+    if not ok:
+        raise Exception("The simulation methods generated different spikes!")
+
+if __name__ == "__main__":
+    run_benchmark()
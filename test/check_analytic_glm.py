@@ -0,0 +1,133 @@
+# Run as script using 'python -m test.check_analytic_glm'
+import time
+import numpy as np
+
+from population import Population
+from models.model_factory import make_model
+from utils.theano_func_wrapper import seval, _flatten
+from utils.packvec import packdict, get_vars
+from utils.grads import differentiable, grad_wrt_list, hessian_wrt_list
+from check_harness import rel_err, simulate_data
+
+def parse_cmd_line_args():
+    """
+    Parse command line parameters
+    """
+    from optparse import OptionParser
+
+    parser = OptionParser()
+    parser.add_option("-m", "--model", dest="model",
+                      default='standard_glm,standard_glm_exp_stim,'
+                              'standard_glm_exp_stim_frames,'
+                              'sparse_weighted_model,distance_weighted_model',
+                      help="Comma separated list of model types to check. "
+                           "standard_glm_exp_stim is the standard GLM with "
+                           "an exponential nonlinearity and a stimulus, and "
+                           "standard_glm_exp_stim_frames filters the "
+                           "stimulus at the resolution of its frames.")
+
+    parser.add_option("-N", "--N", dest="N", default=3,
+                      help="Number of neurons.")
+
+    parser.add_option("-T", "--T_stop", dest="T_stop", default=10.0,
+                      help="Length of the synthetic dataset (sec).")
+
+    (options, args) = parser.parse_args()
+
+    options.N = int(options.N)
+    options.T_stop = float(options.T_stop)
+    return (options, args)
+
+def make_check_model(template, N):
+    """ Make a model from a template, or from the standard GLM with an
+        exponential nonlinearity and a filtered stimulus.
+    """
+    if template in ['standard_glm_exp_stim', 'standard_glm_exp_stim_frames']:
+        model = make_model('standard_glm', N=N)
+        model['nonlinearity']['type'] = 'exp'
+        model['bias']['mu'] = 2.0
+        model['bkgd']['type'] = 'basis'
+        if template == 'standard_glm_exp_stim_frames':
+            model['bkgd']['resolution'] = 'stim'
+        return model
+    return make_model(template, N=N)
+
+def check_model(template, N, T_stop):
+    """ Compare the closed form log likelihood, log probability, gradient and
+        Hessian of each GLM to the Theano expressions.
+    """
+    model = make_check_model(template, N)
+    popn = Population(model)
+    popn_analytic = Population(model, engine='analytic')
+
+    data, x = simulate_data(popn, T_stop, model['bkgd'].get('D_stim', 1))
+    popn.set_data(data)
+    popn_analytic.set_data(data)
+
+    syms = popn.get_variables()
+    glm_syms = differentiable(syms['glm'])
+    g_glm_logp, g_list = grad_wrt_list(popn.glm.log_p, _flatten(glm_syms))
+    H_glm_logp = hessian_wrt_list(popn.glm.log_p, _flatten(glm_syms), g_list)
+
+    errs = np.zeros(6)
+    for n in np.arange(N):
+        xn = popn.extract_vars(x, n)
+        ll = seval(popn.glm.ll, syms, xn)
+        lp = seval(popn.glm.log_p, syms, xn)
+        g = seval(g_glm_logp, syms, xn)
+        H = seval(H_glm_logp, syms, xn)
+
+        # The gradient must be ordered like the packed parameters
+        assert len(packdict(get_vars(glm_syms, xn['glm']))[0]) == len(g)
+
+        analytic = popn_analytic.analytic
+        v = np.random.randn(len(g))
+        errs = np.maximum(errs, [rel_err(analytic.ll(xn), ll),
+                                 rel_err(analytic.log_p(xn), lp),
+                                 rel_err(analytic.grad_log_p(xn), g),
+                                 rel_err(analytic.hessian_log_p(xn), H),
+                                 rel_err(analytic.hessian_vector_product(xn, v),
+                                         np.dot(H, v)),
+                                 rel_err(popn_analytic.compute_lls(x)[n], ll)])
+
+    # Time one evaluation of the gradient with each engine
+    xn = popn.extract_vars(x, 0)
+    start = time.time()
+    seval(g_glm_logp, syms, xn)
+    t_theano = time.time() - start
+    start = time.time()
+    popn_analytic.analytic.grad_log_p(xn)
+    t_analytic = time.time() - start
+
+    # Time one evaluation of the Hessian with each engine
+    start = time.time()
+    seval(H_glm_logp, syms, xn)
+    t_H_theano = time.time() - start
+    start = time.time()
+    popn_analytic.analytic.hessian_log_p(xn)
+    t_H_analytic = time.time() - start
+
+    print "%s:\tll %.1e\tlog_p %.1e\tgrad %.1e\tHessian %.1e\tHv %.1e\t" \
+          "compute_lls %.1e" % ((template,) + tuple(errs))
+    print "\tgradient: %.3fs with Theano, %.3fs in closed form" % \
+          (t_theano, t_analytic)
+    print "\tHessian: %.3fs with Theano, %.3fs in closed form" % \
+          (t_H_theano, t_H_analytic)
+    return np.all(errs < 1e-6)
+
+def run_check():
+    """ Cross check the closed form GLM engine against Theano
+    """
+    options, args = parse_cmd_line_args()
+    np.random.seed(0)
+
+    ok = True
+    for template in options.model.split(','):
+        ok = check_model(template, options.N, options.T_stop) and ok
+
+    if not ok:
+        raise Exception("Closed form and Theano GLM engines disagree!")
+    print "Closed form and Theano GLM engines agree."
+
+if __name__ == "__main__":
+    run_check()
@@ -0,0 +1,33 @@
+""" Helpers shared by the check and benchmark scripts, which compare the
+    engines and options of a population on a small synthetic dataset.
+"""
+import numpy as np
+
+def rel_err(a, b):
+    """ Maximum error relative to the largest magnitude of b
+    """
+    return np.max(np.abs(np.asarray(a)-np.asarray(b))) / \
+           max(np.max(np.abs(b)), 1e-12)
+
+def synth_data(N, T_stop, D_stim=1, dt=0.001, dt_stim=0.1):
+    """ Make a dataset of N neurons without spikes and a white noise
+        stimulus of dimension D_stim, T_stop seconds long
+    """
+    return {"S": np.zeros((int(T_stop/dt), N)),
+            "N": N,
+            "dt": dt,
+            "T": T_stop,
+            "stim": np.random.randn(int(T_stop/dt_stim), D_stim),
+            "dt_stim": dt_stim}
+
+def simulate_data(popn, T_stop, D_stim=1, dt=0.001, dt_stim=0.1):
+    """ Sample parameters of the population and simulate a synthetic dataset
+        from them. The population is left set to the data without spikes.
+
+    :rtype the dataset and the parameters
+    """
+    data = synth_data(popn.N, T_stop, D_stim, dt, dt_stim)
+    popn.set_data(data)
+    x = popn.sample()
+    data['S'],_ = popn.simulate(x, (0, T_stop), dt)
+    return data, x
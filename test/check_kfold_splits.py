@@ -0,0 +1,130 @@
+# Run as script using 'python -m test.check_kfold_splits'
+import copy
+import numpy as np
+
+from population import Population
+from models.model_factory import make_model
+from inference.smart_init import initialize_with_data
+from utils.io import kfold_splits, blocked_splits
+from utils.spikes import as_dense_spikes
+from check_harness import simulate_data
+
+def parse_cmd_line_args():
+    """
+    Parse command line parameters
+    """
+    from optparse import OptionParser
+
+    parser = OptionParser()
+    parser.add_option("-m", "--model", dest="model", default='standard_glm',
+                      help="Type of model to use. See model_factory.py for available types.")
+
+    parser.add_option("-N", "--N", dest="N", default=3,
+                      help="Number of neurons.")
+
+    parser.add_option("-T", "--T_stop", dest="T_stop", default=20.0,
+                      help="Length of the synthetic dataset (sec).")
+
+    parser.add_option("-k", "--n_folds", dest="n_folds", default=4,
+                      help="Number of folds.")
+
+    (options, args) = parser.parse_args()
+
+    options.N = int(options.N)
+    options.T_stop = float(options.T_stop)
+    options.n_folds = int(options.n_folds)
+    return (options, args)
+
+def run_check():
+    """ Check that the training data of each fold of kfold_splits leaves its
+        block out of the likelihood: the log likelihood of the training data
+        and of the test segment add up to that of the full data, with both
+        the Theano and the closed form engines. The blocked splits are
+        checked the same way. The STA initialization of the training data
+        must not see the spikes of the held out block either.
+    """
+    options, args = parse_cmd_line_args()
+    np.random.seed(0)
+    N = options.N
+    T_stop = options.T_stop
+
+    model = make_model(options.model, N=N)
+    popn = Population(model)
+    popn_analytic = Population(model, engine='analytic')
+
+    data, x = simulate_data(popn, T_stop)
+    dt = data['dt']
+
+    ok = True
+    for (name, p) in [('theano', popn), ('analytic', popn_analytic)]:
+        p.set_data(data)
+        ll_full = p.compute_lls(x)
+
+        for (k, (train, test)) in enumerate(kfold_splits(data, options.n_folds)):
+            p.set_data(train)
+            ll_train = p.compute_lls(x)
+            p.set_data(test)
+            ll_test = p.compute_lls(x)
+            err = np.max(np.abs(ll_train + ll_test - ll_full))
+            ok = ok and err < 1e-6 * np.max(np.abs(ll_full))
+            print "%s k-fold %d:\ttrain %s\ttest %s\terror %.1e" % \
+                  (name, k, str(np.round(ll_train, 1)),
+                   str(np.round(ll_test, 1)), err)
+
+        for (k, (train, test)) in enumerate(blocked_splits(data, options.n_folds)):
+            # The training blocks and the test block cover the data up to
+            # the end of the test block
+            end = int(round((k+2)*data['T']/options.n_folds/dt))
+            prefix = dict(data)
+            prefix['holdout'] = (end, data['S'].shape[0])
+            p.set_data(prefix)
+            ll_prefix = p.compute_lls(x)
+            p.set_data(train)
+            ll_train = p.compute_lls(x)
+            p.set_data(test)
+            ll_test = p.compute_lls(x)
+            err = np.max(np.abs(ll_train + ll_test - ll_prefix))
+            ok = ok and err < 1e-6 * np.max(np.abs(ll_prefix))
+            print "%s blocked %d:\ttrain %s\ttest %s\terror %.1e" % \
+                  (name, k, str(np.round(ll_train, 1)),
+                   str(np.round(ll_test, 1)), err)
+
+    # Initialize a model with a stimulus filter from the training data
+    # and from the data with the spikes of the held out block removed
+    model_stim = copy.deepcopy(model)
+    model_stim['bkgd'] = {'type' : 'basis',
+                          'D_stim' : 1,
+                          'dt_max' : 0.1,
+                          'mu' : 0,
+                          'sigma' : 0.5,
+                          'basis' : {'type' : 'cosine',
+                                     'n_eye' : 0,
+                                     'n_cos' : 3,
+                                     'a' : 1.0/120,
+                                     'b' : 0.5,
+                                     'orth' : False,
+                                     'norm' : True}}
+    popn_stim = Population(model_stim)
+    S = as_dense_spikes(data['S'])
+    for (k, (train, test)) in enumerate(kfold_splits(data, options.n_folds)):
+        (h_start, h_stop) = train['holdout']
+        dropped = dict(data)
+        dropped['S'] = S.copy()
+        dropped['S'][h_start:h_stop] = 0
+
+        w_stims = []
+        for d in [train, dropped]:
+            x0 = copy.deepcopy(x)
+            popn_stim.set_data(d)
+            initialize_with_data(popn_stim, d, x0)
+            w_stims.append(np.array([g['bkgd']['w_stim'] for g in x0['glms']]))
+        err = np.max(np.abs(w_stims[0] - w_stims[1]))
+        ok = ok and err < 1e-8 * np.max(np.abs(w_stims[1]))
+        print "STA k-fold %d:\terror %.1e" % (k, err)
+
+    if not ok:
+        raise Exception("The held out blocks are not left out of the fit!")
+    print "The splits leave the held out blocks out of the likelihood and the initialization."
+
+if __name__ == "__main__":
+    run_check()
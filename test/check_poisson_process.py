@@ -0,0 +1,173 @@
+# Run as script using 'python -m test.check_poisson_process'
+import time
+import numpy as np
+import scipy.stats
+
+from utils.poisson_process import sampleInhomogeneousPoissonProc, \
+                                  sampleInhomogeneousPoissonProcs
+
+def parse_cmd_line_args():
+    """
+    Parse command line parameters
+    """
+    from optparse import OptionParser
+
+    parser = OptionParser()
+    parser.add_option("-N", "--N", dest="N", default=20,
+                      help="Number of neurons.")
+
+    parser.add_option("-T", "--T_stop", dest="T_stop", default=20.0,
+                      help="Length of the rates (sec).")
+
+    parser.add_option("-R", "--n_repeats", dest="n_repeats", default=20,
+                      help="Number of samples of the rates drawn with each "
+                           "sampler.")
+
+    parser.add_option("-b", "--T_bench", dest="T_bench", default=100.0,
+                      help="Length of the rates timed with each sampler (sec).")
+
+    parser.add_option("-n", "--N_bench", dest="N_bench", default=100,
+                      help="Number of neurons timed with each sampler.")
+
+    parser.add_option("-s", "--seed", dest="seed", default=0,
+                      help="Random seed.")
+
+    (options, args) = parser.parse_args()
+
+    options.N = int(options.N)
+    options.T_stop = float(options.T_stop)
+    options.n_repeats = int(options.n_repeats)
+    options.T_bench = float(options.T_bench)
+    options.N_bench = int(options.N_bench)
+    options.seed = int(options.seed)
+    return (options, args)
+
+def make_rates(tt, N):
+    """ Make a TxN matrix of rates with different frequencies. The first
+        neuron fires at a high rate, so that the others lie behind a large
+        offset in the batched sampler. The second neuron never fires and the
+        third is silent for the middle of the interval.
+    """
+    lam = 20 + 15*np.sin(2*np.pi*np.outer(tt, np.linspace(0.2, 3, N)) +
+                         np.arange(N))
+    lam[:,0] *= 50
+    if N > 1:
+        lam[:,1] = 0
+    if N > 2:
+        lam[(tt > 0.25*tt[-1]) & (tt < 0.75*tt[-1]), 2] = 0
+    return lam
+
+def cumulative_rates(tt, lam):
+    """ Integrate the rates with the trapezoidal rule, as the samplers do
+    """
+    dt = np.reshape(np.diff(tt), [-1,1])
+    return np.vstack((np.zeros((1,lam.shape[1])),
+                      np.cumsum(0.5*dt*(lam[1:]+lam[:-1]), axis=0)))
+
+def rescaled_intervals(tt, cumLam, samples):
+    """ Map a list of spike time samples of one neuron through its cumulative
+        rate. By the time rescaling theorem the intervals between the
+        rescaled spike times are exponential with rate one.
+    """
+    tau = []
+    for S in samples:
+        Q = np.interp(S, tt, cumLam)
+        tau.append(np.diff(np.concatenate(([0.0], Q))))
+    return np.concatenate(tau)
+
+def check_samplers(tt, lam, n_repeats):
+    """ Compare the spike counts and the time rescaling KS statistics of each
+        column of the batched sampler to those of the single rate sampler.
+    """
+    lam = np.reshape(lam, (len(tt), -1))
+    N = lam.shape[1]
+    cumLam = cumulative_rates(tt, lam)
+
+    batched = [[] for n in np.arange(N)]
+    single = [[] for n in np.arange(N)]
+    for r in np.arange(n_repeats):
+        (S, ptr) = sampleInhomogeneousPoissonProcs(tt, lam)
+        for n in np.arange(N):
+            Sn = S[ptr[n]:ptr[n+1]]
+            if np.any(np.diff(Sn) < 0) or np.any(Sn < tt[0]) or \
+               np.any(Sn > tt[-1]):
+                raise Exception("Spike times of neuron %d are out of order "
+                                "or out of range!" % n)
+            batched[n].append(Sn)
+            single[n].append(np.atleast_1d(
+                sampleInhomogeneousPoissonProc(tt, lam[:,n])))
+
+    ok = True
+    for n in np.arange(N):
+        E = cumLam[-1,n]
+        nb = np.mean([len(Sn) for Sn in batched[n]])
+        ns = np.mean([len(Sn) for Sn in single[n]])
+        # The mean count of the repeats has standard deviation sqrt(E/R)
+        sd = np.sqrt(max(E, 1.0)/n_repeats)
+        ok_n = np.abs(nb - E) < 4*sd
+
+        if E == 0:
+            ok_n = ok_n and nb == 0
+            print "neuron %d:\tcount %.1f (single %.1f, expected %.1f)" % \
+                  (n, nb, ns, E)
+        else:
+            # Silent stretches of rate must have no spikes
+            silent = np.concatenate([Sn[(lam[np.searchsorted(tt, Sn)-1,n] == 0) &
+                                        (lam[np.searchsorted(tt, Sn),n] == 0)]
+                                     for Sn in batched[n]])
+            ok_n = ok_n and len(silent) == 0
+
+            ks_b = scipy.stats.kstest(rescaled_intervals(tt, cumLam[:,n],
+                                                         batched[n]), 'expon')
+            ks_s = scipy.stats.kstest(rescaled_intervals(tt, cumLam[:,n],
+                                                         single[n]), 'expon')
+            ok_n = ok_n and ks_b[1] > 1e-4
+            print "neuron %d:\tcount %.1f (single %.1f, expected %.1f)" \
+                  "\tKS %.4f p %.2f (single %.4f p %.2f)" % \
+                  (n, nb, ns, E, ks_b[0], ks_b[1], ks_s[0], ks_s[1])
+        ok = ok and ok_n
+    return ok
+
+def run_check():
+    """ Check that the batched Poisson process sampler draws spikes with the
+        same distribution as the single rate sampler, column by column, and
+        time both samplers on a large matrix of rates.
+    """
+    options, args = parse_cmd_line_args()
+    np.random.seed(options.seed)
+    dt = 0.001
+    tt = np.arange(0, options.T_stop, dt)
+    lam = make_rates(tt, options.N)
+
+    ok = check_samplers(tt, lam, options.n_repeats)
+
+    # A single neuron, given as a Tx1 matrix and as a vector
+    print "One neuron, Tx1 rates:"
+    ok = check_samplers(tt, lam[:,-1:], options.n_repeats) and ok
+    print "One neuron, 1-D rates:"
+    ok = check_samplers(tt, lam[:,-1], options.n_repeats) and ok
+
+    (S, ptr) = sampleInhomogeneousPoissonProcs(tt, np.zeros((len(tt), 3)))
+    ok = ok and len(S) == 0 and np.array_equal(ptr, np.zeros(4))
+
+    # Time both samplers
+    tt = np.arange(0, options.T_bench, dt)
+    lam = make_rates(tt, options.N_bench)
+    start = time.time()
+    (S, ptr) = sampleInhomogeneousPoissonProcs(tt, lam)
+    t_batched = time.time() - start
+    start = time.time()
+    nS = 0
+    for n in np.arange(options.N_bench):
+        nS += np.size(sampleInhomogeneousPoissonProc(tt, lam[:,n]))
+    t_single = time.time() - start
+    print "%dx%d rates:\tbatched %d spikes in %.2fs\tsingle %d spikes in " \
+          "%.2fs" % (len(tt), options.N_bench, len(S), t_batched, nS, t_single)
+
+    if not ok:
+        raise Exception("The batched sampler does not match the single rate "
+                        "sampler!")
+    print "The batched sampler matches the single rate sampler."
+
+if __name__ == "__main__":
+    run_check()
@@ -0,0 +1,101 @@
+# Run as script using 'python -m test.check_precision'
+import numpy as np
+
+from population import Population
+from models.model_factory import make_model
+from utils.theano_func_wrapper import seval, _flatten
+from utils.grads import differentiable, grad_wrt_list
+from check_harness import rel_err, simulate_data
+
+def parse_cmd_line_args():
+    """
+    Parse command line parameters
+    """
+    from optparse import OptionParser
+
+    parser = OptionParser()
+    parser.add_option("-m", "--model", dest="model",
+                      default='standard_glm,sparse_weighted_model',
+                      help="Comma separated list of model types to check.")
+
+    parser.add_option("-N", "--N", dest="N", default=5,
+                      help="Number of neurons.")
+
+    parser.add_option("-T", "--T_stop", dest="T_stop", default=100.0,
+                      help="Length of the synthetic dataset (sec).")
+
+    parser.add_option("-t", "--tol", dest="tol", default=1e-7,
+                      help="Largest acceptable relative error.")
+
+    (options, args) = parser.parse_args()
+
+    options.N = int(options.N)
+    options.T_stop = float(options.T_stop)
+    options.tol = float(options.tol)
+    return (options, args)
+
+def make_precision_model(template, N, precision):
+    """ Make a model with a filtered stimulus and the given precision
+    """
+    model = make_model(template, N=N)
+    model['bkgd']['type'] = 'basis'
+    model['precision'] = precision
+    return model
+
+def check_model(template, N, T_stop, tol):
+    """ Compare the log likelihoods, log probabilities and gradients of a
+        model stored in single precision to those in double precision.
+    """
+    popns = {}
+    for precision in ['double', 'single']:
+        popns[precision] = Population(make_precision_model(template, N,
+                                                           precision))
+
+    D_stim = popns['double'].glm.bkgd_model.prms['D_stim']
+    data, x = simulate_data(popns['double'], T_stop, D_stim)
+
+    results = {}
+    for (precision, popn) in popns.items():
+        popn.set_data(data)
+        syms = popn.get_variables()
+        glm_syms = differentiable(syms['glm'])
+        g_glm_logp,_ = grad_wrt_list(popn.glm.log_p, _flatten(glm_syms))
+
+        results[precision] = []
+        for n in np.arange(N):
+            xn = popn.extract_vars(x, n)
+            results[precision].append((seval(popn.glm.ll, syms, xn),
+                                       seval(popn.glm.log_p, syms, xn),
+                                       seval(g_glm_logp, syms, xn)))
+        results[precision].append(popn.compute_lls(x))
+        ir = popn.glm.imp_model.ir.get_value(borrow=True)
+        stim = popn.glm.bkgd_model.stim.get_value(borrow=True)
+        print "%s:\t%s precision: ir and stim take %.1fMB" % \
+              (template, precision, (ir.nbytes + stim.nbytes)/2.0**20)
+
+    errs = np.zeros(4)
+    for n in np.arange(N):
+        (d, s) = (results['double'][n], results['single'][n])
+        errs[:3] = np.maximum(errs[:3], [rel_err(s[i], d[i]) for i in range(3)])
+    errs[3] = rel_err(results['single'][N], results['double'][N])
+
+    print "%s:\tll %.1e\tlog_p %.1e\tgrad %.1e\tcompute_lls %.1e" % \
+          ((template,) + tuple(errs))
+    return np.all(errs < tol)
+
+def run_check():
+    """ Bound the drift of single precision storage from double precision
+    """
+    options, args = parse_cmd_line_args()
+    np.random.seed(0)
+
+    ok = True
+    for template in options.model.split(','):
+        ok = check_model(template, options.N, options.T_stop, options.tol) and ok
+
+    if not ok:
+        raise Exception("Single precision differs from double precision by more than %.1e!" % options.tol)
+    print "Single precision agrees with double precision."
+
+if __name__ == "__main__":
+    run_check()
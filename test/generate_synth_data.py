@@ -1,4 +1,4 @@
-# Run as script using 'python -m test.synth_map'
+# Run as script using 'python -m test.generate_synth_data'
 import cPickle
 import os
 import scipy.io
@@ -8,8 +8,8 @@ from population import Population
 from models.model_factory import make_model, \
                                  stabilize_sparsity, \
                                  check_stability
-from plotting.plot_results import plot_results
 from utils.io import create_unique_results_folder
+from utils import startup_profile
 
 def parse_cmd_line_args():
     """
@@ -33,6 +33,14 @@ def parse_cmd_line_args():
     parser.add_option("-u", "--unique_result", dest="unique_results", default="true",
                       help="Whether or not to create a unique results directory.")
 
+    parser.add_option("--sparse", dest="sparse",
+                      action="store_true", default=False,
+                      help="Save the spike trains as a sparse matrix.")
+
+    parser.add_option("--profile-startup", dest="profile_startup",
+                      action="store_true", default=False,
+                      help="Print the time spent importing modules, building the model, and compiling functions.")
+
     (options, args) = parser.parse_args()
     
     # Make sure parameters are of the correct type
@@ -55,6 +63,7 @@ def gen_synth_data():
     """ Run a test with synthetic data and MCMC inference
     """
     options, args = parse_cmd_line_args()
+    startup_profile.mark('imports')
     
     # Create the model
     model = make_model(options.model, N=options.N)
@@ -80,19 +89,21 @@ def gen_synth_data():
     assert check_stability(model, x_true, options.N), "ERROR: Sampled network is unstable!"
         
     # Generate random white noise stimulus
-    stim = np.random.randn(options.T_stop/dt_stim,D_stim)
+    stim = np.random.randn(int(options.T_stop/dt_stim),D_stim)
 
     # Initialize the GLMs with just the stimulus
-    temp_data = {"S": np.zeros((options.T_stop/dt, options.N)),
+    temp_data = {"S": np.zeros((int(options.T_stop/dt), options.N)),
                  "N": options.N,
                  "dt": dt,
                  "T": np.float(options.T_stop),
                  "stim": stim,
                  'dt_stim': dt_stim}
     popn.set_data(temp_data)
+    startup_profile.mark('graph build')
 
     # Simulate spikes
-    S,X = popn.simulate(x_true, (0, options.T_stop), dt)
+    S,X = popn.simulate(x_true, (0, options.T_stop), dt, sparse=options.sparse)
+    startup_profile.mark('simulate')
 
     # Save the model so it can be loaded alongside the data
     fname_model = os.path.join(options.resultsDir, 'model.pkl')
@@ -132,7 +143,11 @@ def gen_synth_data():
     with open(fname_pkl,'w') as f:
         cPickle.dump(data, f, protocol=-1)
 
+    if options.profile_startup:
+        startup_profile.report()
+
     # Plot firing rates, stimulus responses, etc
+    from plotting.plot_results import plot_results
     plot_results(popn, data['vars'],
                  resdir=options.resultsDir,
                  do_plot_stim_resp=False,
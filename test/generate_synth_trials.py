@@ -0,0 +1,87 @@
+# Run as script using 'python -m test.generate_synth_trials'
+import os
+import time
+import numpy as np
+
+from batch_simulation import simulate_trials
+from models.model_factory import make_model, stabilize_sparsity
+from utils.io import create_unique_results_folder
+
+def parse_cmd_line_args():
+    """
+    Parse command line parameters
+    """
+    from optparse import OptionParser
+
+    parser = OptionParser()
+    parser.add_option("-m", "--model", dest="model", default='standard_glm',
+                      help="Type of model to use. See model_factory.py for available types.")
+
+    parser.add_option("-r", "--resultsDir", dest="resultsDir", default='.',
+                      help="Save the results to this directory.")
+
+    parser.add_option("-N", "--N", dest="N", default=1,
+                      help="Number of neurons.")
+
+    parser.add_option("-T", "--T_stop", dest="T_stop", default=60.0,
+                      help="Length of each trial (sec).")
+
+    parser.add_option("-n", "--n_trials", dest="n_trials", default=10,
+                      help="Number of trials.")
+
+    parser.add_option("--resample", dest="resample",
+                      action="store_true", default=False,
+                      help="Sample a new network for every trial.")
+
+    parser.add_option("-s", "--seed", dest="seed", default=0,
+                      help="Random seed. Trial k uses the stream seeded with [seed, 0, k].")
+
+    parser.add_option("-w", "--workers", dest="workers", default=None,
+                      help="Number of processes. Defaults to the number of CPUs.")
+
+    parser.add_option("--currents", dest="currents",
+                      action="store_true", default=False,
+                      help="Save the currents X of each trial.")
+
+    parser.add_option("-u", "--unique_result", dest="unique_results", default="true",
+                      help="Whether or not to create a unique results directory.")
+
+    (options, args) = parser.parse_args()
+
+    options.N = int(options.N)
+    options.T_stop = float(options.T_stop)
+    options.n_trials = int(options.n_trials)
+    options.seed = int(options.seed)
+    if options.workers is not None:
+        options.workers = int(options.workers)
+
+    # Check if specified files exist
+    if not options.resultsDir is None and not os.path.exists(options.resultsDir):
+        raise Exception("Invalid results folder specified: %s" % options.resultsDir)
+
+    if not( options.unique_results == "0" or \
+            options.unique_results.lower() == "false"):
+        options.resultsDir = create_unique_results_folder(options.resultsDir)
+    return (options, args)
+
+def gen_synth_trials():
+    """ Simulate many trials of a synthetic network into a dataset of trials
+    """
+    options, args = parse_cmd_line_args()
+
+    model = make_model(options.model, N=options.N)
+    # Set the sparsity level to minimize the risk of unstable networks
+    stabilize_sparsity(model)
+
+    print "Generating %d trials with %d neurons and %.2f seconds." % \
+          (options.n_trials, options.N, options.T_stop)
+    start = time.time()
+    nS = simulate_trials(model, options.T_stop, options.resultsDir,
+                         options.n_trials, resample=options.resample,
+                         seed=options.seed, n_workers=options.workers,
+                         save_currents=options.currents)
+    print "Simulated %d trials in %.1fs. Mean spike counts: %s" % \
+          (options.n_trials, time.time() - start, str(np.mean(nS, axis=0)))
+
+if __name__ == "__main__":
+    gen_synth_trials()
@@ -5,6 +5,9 @@ import os
 import cPickle
 
 from utils.io import parse_cmd_line_args, load_data
+from utils.theano_func_wrapper import enable_disk_cache
+from utils.data_cache import enable_data_cache
+from utils import startup_profile
 from population import Population
 from models.model_factory import *
 
@@ -82,13 +85,24 @@ def parallel_compute_log_p(dview,
     return lp_tot
 
 
+def print_compile_times(dview):
+    """ Print the time each engine spent compiling and loading functions
+    """
+    @interactive
+    def _get_compile_times():
+        return str(get_registry())
+
+    for (i,s) in enumerate(dview.apply_sync(_get_compile_times)):
+        print "Engine %d: %s" % (i, s)
+
 def initialize_imports(dview):
     """ Import required model code on the clients.
         Initialize global variable for each client's local population obj
     """
     dview.execute('from population import Population')
     dview.execute('from models.model_factory import make_model')
-    dview.execute('from utils.theano_func_wrapper import seval')
+    dview.execute('from utils.theano_func_wrapper import seval, enable_disk_cache, get_registry')
+    dview.execute('from utils.data_cache import enable_data_cache')
     dview.execute('import cPickle')
 
 def set_data_on_engines(dview, d):
@@ -133,7 +147,8 @@ def set_hyperparameters_on_engines(dview, m):
 
 def create_population_on_engines(dview,
                                  data,
-                                 model_type
+                                 model_type,
+                                 cache_dir=None
                                  ):
     """ Initialize a model with N neurons. Use the data if specified on the
         command line, otherwise sample new data from the model.
@@ -150,6 +165,12 @@ def create_population_on_engines(dview,
         raise Exception("Create_population_on_engines requires model to be either str type or dict")
     dview['model'] = m
 
+    # Load compiled functions and filtered data from disk rather than
+    # computing them on every engine
+    if cache_dir is not None:
+        dview['cache_dir'] = cache_dir
+        dview.execute('enable_disk_cache(cache_dir, model)', block=True)
+        dview.execute('enable_data_cache(cache_dir)', block=True)
 
     # Create a population object on each engine
     #@interactive
@@ -168,14 +189,21 @@ def create_population_on_engines(dview,
 def initialize_parallel_test_harness():
     # Parse command line args
     (options, args) = parse_cmd_line_args()
+    startup_profile.mark('imports')
     
     # Load data from file or create synthetic test dataset
     data = load_data(options)
+    startup_profile.mark('load data')
     
     print "Creating master population object"
     model = make_model(options.model, N=data['N'])
+    if options.cacheDir is not None:
+        print "Using compiled function and data cache in %s" % options.cacheDir
+        enable_disk_cache(options.cacheDir, model)
+        enable_data_cache(options.cacheDir)
     popn = Population(model)
     popn.set_data(data) 
+    startup_profile.mark('graph build')
     
     # Initialize the GLM with the data
     popn_true = None
@@ -220,6 +248,10 @@ def initialize_parallel_test_harness():
     initialize_imports(dview)
 
     print "Creating population objects on each engine"
-    create_population_on_engines(dview, data, options.model)
+    create_population_on_engines(dview, data, options.model, options.cacheDir)
+    startup_profile.mark('engines')
+
+    if options.profile_startup:
+        startup_profile.report()
 
     return options, popn, data, client, popn_true, x_true
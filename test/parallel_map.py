@@ -5,7 +5,6 @@ import scipy.io
 
 from synth_harness import parse_cmd_line_args
 from inference.coord_descent import coord_descent
-from plotting.plot_results import plot_results
 from models.model_factory import make_model
 from population import Population
 
@@ -9,7 +9,6 @@ from parallel_harness import initialize_parallel_test_harness, \
                              set_data_on_engines, \
                              set_hyperparameters_on_engines, \
                              parallel_compute_ll
-from plotting.plot_results import plot_results
 from models.model_factory import make_model
 from synth_harness import get_xv_models
 
@@ -121,6 +120,7 @@ def run_parallel_map():
         cPickle.dump(best_x, f, protocol=-1)
 
     # Plot results
+    from plotting.plot_results import plot_results
     plot_results(popn, best_x,
                  popn_true, x_true,
                  do_plot_imp_responses=(model['N']<64),
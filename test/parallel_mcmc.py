@@ -6,7 +6,6 @@ from models.model_factory import make_model, convert_model
 from population import Population
 from inference.parallel_gibbs import parallel_gibbs_sample
 from parallel_harness import initialize_parallel_test_harness
-from plotting.plot_results import plot_results
 
 def run_synth_test():
     """ Run a test with synthetic data and MCMC inference
@@ -63,6 +62,7 @@ def run_synth_test():
     do_plot_imp_responses = data['N'] < 30
 
     if do_plot:
+        from plotting.plot_results import plot_results
         plot_results(popn,
                     x_smpls[-1*int(smpl_frac*N_samples):],
                     popn_true,
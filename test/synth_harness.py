@@ -5,9 +5,10 @@ import os
 
 from population import Population
 from models.model_factory import *
-from plotting.plot_results import plot_results
-from utils.theano_func_wrapper import seval
+from utils.theano_func_wrapper import seval, enable_disk_cache
+from utils.data_cache import enable_data_cache
 from utils.io import parse_cmd_line_args, load_data
+from utils import startup_profile
 
 
 def initialize_test_harness():
@@ -18,14 +19,21 @@ def initialize_test_harness():
     """
     # Parse command line args
     (options, args) = parse_cmd_line_args()
+    startup_profile.mark('imports')
 
     # Load data from file or create synthetic test dataset
     data = load_data(options)
+    startup_profile.mark('load data')
     
     print "Creating master population object"
     model = make_model(options.model, N=data['N'])
+    if options.cacheDir is not None:
+        print "Using compiled function and data cache in %s" % options.cacheDir
+        enable_disk_cache(options.cacheDir, model)
+        enable_data_cache(options.cacheDir)
     popn = Population(model)
     popn.set_data(data) 
+    startup_profile.mark('graph build')
     
     # Initialize the GLM with the data
     popn_true = None
@@ -58,6 +66,9 @@ def initialize_test_harness():
             ll_true = popn_true.compute_log_p(x_true)
             print "true LL: %f" % ll_true
 
+    if options.profile_startup:
+        startup_profile.report()
+
     return options, popn, data, popn_true, x_true
 
 def get_xv_models(model):
@@ -4,8 +4,8 @@ import os
 import scipy.io
 
 from inference.coord_descent import coord_descent
-from plotting.plot_results import plot_results
 from synth_harness import initialize_test_harness
+from utils.theano_func_wrapper import get_registry
 
 def run_synth_test():
     """ Run a test with synthetic data and MCMC inference
@@ -23,6 +23,7 @@ def run_synth_test():
                           use_rop=False)
     ll_inf = popn.compute_log_p(x_inf)
     print "LL_inf: %f" % ll_inf
+    print get_registry()
 
     # Save results
     results_file = os.path.join(options.resultsDir, 'results.pkl')
@@ -31,6 +32,7 @@ def run_synth_test():
         cPickle.dump(x_inf, f, protocol=-1)
 
     # Plot results
+    from plotting.plot_results import plot_results
     plot_results(popn, x_inf, popn_true, x_true, resdir=options.resultsDir)
 
 if __name__ == "__main__":
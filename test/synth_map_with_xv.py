@@ -6,7 +6,6 @@ import copy
 
 from population import Population
 from inference.coord_descent import coord_descent
-from plotting.plot_results import plot_results
 from synth_harness import initialize_test_harness, get_xv_models
 from models.model_factory import make_model
 from utils.io import segment_data
@@ -98,6 +97,7 @@ def run_synth_test():
         cPickle.dump(best_x, f)
 
     # Plot results
+    from plotting.plot_results import plot_results
     plot_results(popn, best_x, popn_true, x_true, resdir=options.resultsDir)
 
 if __name__ == "__main__":
@@ -7,8 +7,8 @@ from models.model_factory import *
 from inference.gibbs import gibbs_sample
 from utils.avg_dicts import average_list_of_dicts
 from synth_harness import initialize_test_harness
-from plotting.plot_results import plot_results
 from population import Population
+from utils.theano_func_wrapper import get_registry
 
 def run_synth_test():
     """ Run a test with synthetic data and MCMC inference
@@ -32,6 +32,7 @@ def run_synth_test():
     # Perform inference
     N_samples = 100
     x_smpls = gibbs_sample(popn, data, x0=x0, N_samples=N_samples)
+    print get_registry()
 
     # Save results
     results_file = os.path.join(options.resultsDir, 'results.pkl')
@@ -41,6 +42,7 @@ def run_synth_test():
 
     # Plot average of last 20% of samples
     smpl_frac = 0.2
+    from plotting.plot_results import plot_results
     plot_results(popn, 
                  x_smpls[-1*int(smpl_frac*N_samples):],
                  popn_true=popn_true,
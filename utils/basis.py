@@ -1,5 +1,7 @@
 import numpy as np
 import scipy
+import scipy.sparse
+from numpy.lib.stride_tricks import as_strided
 import os
 
 def create_basis(prms):
@@ -194,19 +196,188 @@ def create_identity_basis(prms):
 
     return basis
 
-def convolve_with_basis(stim, basis):
+def interpolate_columns(x, xp, fp):
+    """ Linearly interpolate each column of fp, sampled at the increasing
+        points xp, at the points x. This is np.interp applied to every column
+        at once, and values outside of xp are clamped in the same way.
+    :param x      length M vector of points
+    :param xp     length K vector of sample points
+    :param fp     KxD matrix of samples
+
+    :rtype MxD matrix of interpolated values
+    """
+    x = np.asarray(x, dtype=np.float64)
+    xp = np.asarray(xp, dtype=np.float64)
+    fp = np.asarray(fp)
+    if len(xp) == 1:
+        return np.tile(fp[:1], (len(x),1))
+
+    i = np.clip(np.searchsorted(xp, x, side='right') - 1, 0, len(xp)-2)
+    w = np.clip((x - xp[i]) / (xp[i+1] - xp[i]), 0.0, 1.0)[:,None]
+    return fp[i] + w*(fp[i+1] - fp[i])
+
+def interpolate_basis(basis, L_int):
+    """ Interpolate an LxB basis at L_int evenly spaced points
+    """
+    (L,B) = basis.shape
+    return interpolate_columns(np.linspace(0,1,int(L_int)),
+                               np.linspace(0,1,L),
+                               basis)
+
+def resample_stimulus(stim, dt_stim, t, method='linear'):
+    """ Resample a stimulus whose frames are dt_stim apart at the times t.
+        'linear' interpolates between frames, as np.interp does, and
+        'constant' holds each frame until the next.
+    :param stim   T_stim x D matrix of stimulus frames
+    :param t      length T vector of times
+
+    :rtype TxD matrix of resampled stimuli
+    """
+    if method == 'constant':
+        return stim[frame_index(t, dt_stim, stim.shape[0])]
+    elif method != 'linear':
+        raise Exception("Unrecognized stimulus interpolation: %s" % method)
+    return interpolate_columns(t, dt_stim*np.arange(stim.shape[0]), stim)
+
+def frame_index(t, dt_stim, T_stim):
+    """ Index of the stimulus frame, of T_stim frames dt_stim apart, which is
+        shown at each of the times t
+    """
+    # Guard against frame times that are rounded down, e.g. 0.3/0.1
+    i = np.floor(np.asarray(t)/dt_stim + 1e-9).astype(np.int64)
+    return np.clip(i, 0, T_stim-1)
+
+def downsample_basis(basis, m):
+    """ Sum an RxB basis over blocks of m consecutive lags. Convolving a
+        piecewise constant input whose values change every m bins with the
+        result, at the resolution of the input, gives the convolution with
+        the original basis at the first bin of each input value.
+
+    :rtype ceil(R/m)xB basis
+    """
+    (R,B) = basis.shape
+    K = int(np.ceil(float(R)/m))
+    padded = np.zeros((K*m,B))
+    padded[:R] = basis
+    return np.sum(np.reshape(padded, (K,m,B)), axis=1)
+
+# Approximate costs (sec) of the event-driven convolution per scattered basis
+# entry and per entry of the output, and of the FFT convolution per time bin,
+# input dimension, basis function and log2(T). Measured with
+# test.benchmark_convolution.
+EVENT_COST_PER_ENTRY = 5e-9
+EVENT_COST_PER_OUTPUT = 1.5e-8
+FFT_COST = 1e-8
+
+def choose_convolution_method(stim, basis):
+    """ Choose between the event-driven ('sparse') and the FFT ('fft')
+        convolution of stim with basis. The event-driven convolution costs
+        O(nnz*R*B + T*D*B) and the FFT costs O(T*D*B*log T), so the
+        event-driven method wins for sparse inputs like spike trains.
+    """
+    (T,D) = stim.shape
+    (R,B) = basis.shape
+    if scipy.sparse.issparse(stim):
+        nnz = stim.nnz
+    else:
+        nnz = np.count_nonzero(stim)
+    sparse_cost = EVENT_COST_PER_ENTRY*nnz*R*B + EVENT_COST_PER_OUTPUT*T*D*B
+    fft_cost = FFT_COST * T * D * B * np.log2(T+R)
+    if sparse_cost < fft_cost:
+        return 'sparse'
+    return 'fft'
+
+def convolve_events_with_basis(stim, basis):
+    """ Project a sparse input, e.g. a spike train, onto a basis by
+        scattering a copy of the basis, scaled by the input, after each
+        nonzero entry. The result is the same as convolve_with_basis.
+    :param stim   TxD matrix of inputs, dense or scipy.sparse
+    :param basis  RxB basis matrix
+
+    :rtype TxDxB tensor of stimuli convolved with bases
+    """
+    (T,D) = stim.shape
+    (R,B) = basis.shape
+
+    # Get the events of each input dimension d in order of time, at
+    # ptr[d]:ptr[d+1]
+    if scipy.sparse.issparse(stim):
+        stim = stim.tocsc()
+        stim.sum_duplicates()
+        (t_evt, w_evt, ptr) = (stim.indices, stim.data, stim.indptr)
+    else:
+        (d_evt, t_evt) = np.nonzero(np.transpose(stim))
+        w_evt = stim[t_evt, d_evt]
+        ptr = np.searchsorted(d_evt, np.arange(D+1))
+
+    fstim = np.empty((T,D,B))
+
+    # Accumulate the output of one input dimension at a time. By convention,
+    # the impulse responses apply to times (t+1:t+R), which are the
+    # contiguous window t of R*B entries of the buffer.
+    buf = np.zeros((T+R+1,B))
+    win = as_strided(buf[1:], shape=(T,R*B),
+                     strides=(buf.strides[0], buf.strides[1]))
+    flat_basis = np.ravel(basis)
+    for d in np.arange(D):
+        t = t_evt[ptr[d]:ptr[d+1]]
+        w = np.asarray(w_evt[ptr[d]:ptr[d+1]], dtype=np.float64)
+        if len(t) == 0:
+            fstim[:,d,:] = 0
+            continue
+
+        # If at most L events fall in any R consecutive bins, events L apart
+        # are at least R bins apart and their windows do not overlap. Every
+        # L-th event is then scattered at once.
+        L = np.max(np.arange(len(t)) - np.searchsorted(t, t-R+1) + 1)
+        for l in np.arange(L):
+            win[t[l::L]] += w[l::L,None] * flat_basis
+
+        fstim[:,d,:] = buf[:T]
+        win[t] = 0
+
+    return fstim
+
+def convolve_with_basis(stim, basis, method='auto', out=None, chunk_sz=None):
     """ Project stimulus onto a basis. 
-    :param stim   TxD matrix of inputs. 
+    :param stim   TxD matrix of inputs, dense or scipy.sparse.
                   T is the number of time bins 
                   D is the number of stimulus dimensions.
     :param basis  RxB basis matrix
                   R is the length of the impulse response
                   B is the number of bases
+    :param method 'fft', 'sparse' for the event-driven convolution, or 'auto'
+                  to choose based on the fraction of nonzero inputs
+    :param out    Optional TxDxB array, e.g. a np.memmap, to hold the result
+    :param chunk_sz Optional number of time bins to convolve at once. Only
+                  one chunk of the result is held in memory at a time.
     
     :rtype TxDxB tensor of stimuli convolved with bases
     """
     (T,D) = stim.shape
     (R,B) = basis.shape
+
+    if out is not None or chunk_sz is not None:
+        if out is None:
+            out = np.empty((T,D,B))
+        if chunk_sz is None:
+            chunk_sz = T
+        for start in np.arange(0, T, chunk_sz):
+            stop = min(start + chunk_sz, T)
+            # The output at time t depends on the inputs at times t-R:t-1
+            pad = min(start, R)
+            out[start:stop] = convolve_with_basis(stim[start-pad:stop], basis,
+                                                  method)[pad:]
+        return out
+
+    if method == 'auto':
+        method = choose_convolution_method(stim, basis)
+    if method == 'sparse':
+        return convolve_events_with_basis(stim, basis)
+    elif method != 'fft':
+        raise Exception("Unrecognized convolution method: %s" % method)
+    if scipy.sparse.issparse(stim):
+        stim = stim.toarray()
     
     import scipy.signal as sig
     
@@ -231,6 +402,18 @@ def convolve_with_basis(stim, basis):
     
     return fstim
 
+def convolve_with_basis_as(stim, basis, dtype, chunk_sz=10000):
+    """ Project stimulus onto a basis and store the result with the given
+        dtype. Other than in double precision, the convolution is computed a
+        chunk of time bins at a time into an array of that dtype, so the
+        full result is never held in double precision.
+    """
+    if np.dtype(dtype) == np.float64:
+        return convolve_with_basis(stim, basis)
+    (T,D) = stim.shape
+    out = np.empty((T,D,basis.shape[1]), dtype=dtype)
+    return convolve_with_basis(stim, basis, out=out, chunk_sz=chunk_sz)
+
 def convolve_with_low_rank_2d_basis(stim, basis_x, basis_t):
     """ Convolution with a low-rank 2D basis can be performed 
         by first convolving with the spatial basis (basis_x) 
@@ -244,32 +427,48 @@ def convolve_with_low_rank_2d_basis(stim, basis_x, basis_t):
     # be equal to the "width" of the stimulus.
     assert Rx==D, "ERROR: Spatial basis must be the same size as the stimulus"
 
-    import scipy.signal as sig
-    
     # First convolve with each stimulus filter
     # Since the spatial stimulus filters are the same width as the spatial
     # stimulus, we can just take the dot product to get the valid portion
     fstimx = np.dot(stim, basis_x)
 
     # Now convolve with the temporal basis.  
+    return convolve_projection_with_basis(fstimx, basis_t)
+
+def convolve_projection_with_basis(fstimx, basis_t, out=None):
+    """ Convolve each column of a stimulus that has been projected onto a
+        spatial basis with each of the temporal bases.
+    :param fstimx TxBx matrix of projected stimuli
+    :param basis_t RtxBt temporal basis
+    :param out    Optional TxBxxBt array, e.g. of lower precision, to hold
+                  the result
+
+    :rtype TxBxxBt tensor of filtered stimuli
+    """
+    (T,Bx) = fstimx.shape
+    (Rt,Bt) = basis_t.shape
+
+    import fftconv
+
     # By convention, the impulse responses are apply to times
     # (t-R:t-1). That means we need to prepend a row of zeros to make
     # sure the basis remains causal
     basis_t = np.vstack((np.zeros((1,Bt)),basis_t))
 
     # Initialize array for the completely filtered stimulus
-    fstim = np.empty((T,Bx,Bt))
+    fstim = out if out is not None else np.empty((T,Bx,Bt))
     
-    # Compute convolutions of the TxBx fstimx with each of the temporal bases
+    # Compute convolutions of the TxBx fstimx with each of the temporal bases.
+    # The FFT of fstimx is computed once and shared by all the bases.
+    fsize = fftconv.fft_size(fstimx.shape, (Rt+1,1))
+    fft_fstimx = fftconv.get_fft_cache().rfftn(fstimx, fsize)
     for b in np.arange(Bt):
-        fstim[:,:,b] = sig.fftconvolve(fstimx, 
-                                       np.reshape(basis_t[:,b],[Rt+1,1]), 
-                                       'full')[:T,:]
+        fstim[:,:,b] = fftconv.fftconvolve(fstimx, 
+                                           np.reshape(basis_t[:,b],[Rt+1,1]), 
+                                           'full', fft_in1=fft_fstimx)[0][:T,:]
     
     return fstim
 
-_fft_cache = []
-
 def convolve_with_2d_basis(stim, basis):
     """ Project stimulus onto a basis.
     :param stim   TxD matrix of inputs.
@@ -301,20 +500,10 @@ def convolve_with_2d_basis(stim, basis):
     # Compute convolution
     # TODO Performance can be improved for rank 2 filters
 #     fstim = sig.convolve2d(stim,basis,'full')
-    # Look for fft_stim in _fft_cache
-    fft_stim = None
-    for (cache_stim, cache_fft_stim) in _fft_cache:
-        if np.allclose(stim[-128:],cache_stim[-128:]) and \
-           np.allclose(stim[:128],cache_stim[:128]):
-            fft_stim = cache_fft_stim
-            break
-
-    if not fft_stim is None:
-        fstim,_ = fftconv.fftconvolve(stim, basis, 'full',
-                                      fft_in1=fft_stim)
-    else:
-        fstim,fft_stim,_ = fftconv.fftconvolve(stim, basis, 'full')
-        _fft_cache.append((stim,fft_stim))
+    # The FFT of the stimulus is shared by convolutions with each basis
+    fsize = fftconv.fft_size(stim.shape, basis.shape)
+    fft_stim = fftconv.get_fft_cache().rfftn(stim, fsize)
+    fstim,_ = fftconv.fftconvolve(stim, basis, 'full', fft_in1=fft_stim)
 
     # Only keep the first T time bins and the D-th spatial vector
     # This is the only vector for which the filter and stimulus completely overlap
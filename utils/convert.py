@@ -0,0 +1,37 @@
+# Run as script using 'python -m utils.convert'
+""" Convert a .pkl or .mat data file into a dataset directory, which
+    load_data opens memory mapped. The spike counts are stored sparsely
+    unless --dense is given.
+"""
+from utils.io import read_data_file
+from utils.dataset import save_dataset
+from utils.spikes import as_sparse_spikes
+
+def parse_cmd_line_args():
+    """
+    Parse command line parameters
+    """
+    from optparse import OptionParser
+
+    parser = OptionParser(usage="usage: %prog [options] INPUT OUTPUT_DIR")
+    parser.add_option("--dense", dest="dense",
+                      action="store_true", default=False,
+                      help="Store the spike counts as a dense matrix.")
+
+    (options, args) = parser.parse_args()
+    if len(args) != 2:
+        parser.error("An input file and an output directory must be given")
+    return (options, args)
+
+def convert():
+    options, (fin, fout) = parse_cmd_line_args()
+
+    data = read_data_file(fin)
+    if not options.dense:
+        data['S'] = as_sparse_spikes(data['S'])
+
+    print "Saving dataset to %s" % fout
+    save_dataset(data, fout)
+
+if __name__ == "__main__":
+    convert()
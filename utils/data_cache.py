@@ -0,0 +1,250 @@
+""" A persistent, content addressed cache of the tensors that the components
+    derive from the data in set_data, e.g. the spike trains filtered with the
+    impulse response basis and the stimulus filtered with the background
+    basis. Each tensor is stored as a .npy file named for a digest of
+    everything it is computed from (the spike or stimulus arrays, the time
+    resolution and the interpolated basis), and is loaded memory mapped.
+    Cross validation sets the data of the same segments many times, and
+    every parallel engine sets the same data, so only the first call pays
+    for the convolutions.
+
+    Each component also keeps the tensors derived from the most recent full
+    dataset in memory, and the tensors of a segment of that dataset (see
+    utils.io.segment_data) are views of them. The arrays of a dataset are
+    recognized by identity, so they are only hashed if the disk cache is
+    enabled or a segment is sent without its full dataset. The arrays of
+    the data must therefore not be changed in place.
+"""
+import os
+import time
+import hashlib
+
+import numpy as np
+import scipy.sparse
+
+class DiskDataCache(object):
+    """ Cache of derived data tensors in cache_dir.
+    """
+    def __init__(self, cache_dir):
+        self.cache_dir = os.path.join(cache_dir, 'data')
+        if not os.path.exists(self.cache_dir):
+            try:
+                os.makedirs(self.cache_dir)
+            except OSError:
+                # Another process may have created it concurrently
+                if not os.path.isdir(self.cache_dir):
+                    raise
+
+        self.hits = 0
+        self.misses = 0
+        self.compute_time = 0.0
+        self.load_time = 0.0
+
+    def get(self, name, digest, compute):
+        """ Get the tensor called name which compute() derives from inputs
+            with the given digest, loading it from disk if possible.
+        """
+        path = os.path.join(self.cache_dir, "%s-%s.npy" % (name, digest))
+
+        if os.path.exists(path):
+            start = time.time()
+            x = self._load(path)
+            if x is not None:
+                self.hits += 1
+                self.load_time += time.time() - start
+                print "Data cache hit: loaded %s %s from %s" % \
+                      (name, str(x.shape), path)
+                return x
+
+        start = time.time()
+        x = compute()
+        self.misses += 1
+        self.compute_time += time.time() - start
+        print "Data cache miss: computed %s %s in %.2fs" % \
+              (name, str(x.shape), time.time() - start)
+
+        # Use the memory mapped copy so that the computed tensor can be freed
+        if self._save(path, x):
+            y = self._load(path)
+            if y is not None:
+                return y
+        return x
+
+    def _load(self, path):
+        """ Load a tensor memory mapped. Return None if the file cannot be
+            used.
+        """
+        try:
+            return np.load(path, mmap_mode='r')
+        except Exception as e:
+            print "Warning: could not load cached data %s (%s)" % (path, e)
+            return None
+
+    def _save(self, path, x):
+        """ Write the tensor to disk. Write to a temporary file first so that
+            concurrent processes never read a partial file.
+        """
+        tmp_path = '%s.%d.tmp' % (path, os.getpid())
+        try:
+            with open(tmp_path, 'wb') as fout:
+                np.save(fout, x)
+            os.rename(tmp_path, path)
+            return True
+        except Exception as e:
+            print "Warning: could not save cached data %s (%s)" % (path, e)
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            return False
+
+    def stats(self):
+        """ Get the hit and miss counts and times
+        """
+        return {'hits' : self.hits,
+                'misses' : self.misses,
+                'compute_time' : self.compute_time,
+                'load_time' : self.load_time}
+
+    def __str__(self):
+        return "DiskDataCache(%s): %d hits loaded in %.2fs, " \
+               "%d misses computed in %.2fs" % \
+               (self.cache_dir, self.hits, self.load_time,
+                self.misses, self.compute_time)
+
+# The cache used by the components, if any
+_cache = None
+
+def enable_data_cache(cache_dir):
+    """ Load the tensors derived from the data from cache_dir, and save newly
+        computed tensors there.
+    """
+    global _cache
+    _cache = DiskDataCache(cache_dir)
+    return _cache
+
+def get_data_cache():
+    """ Get the data cache, or None if it is not enabled
+    """
+    return _cache
+
+def cached_tensor(name, inputs, compute):
+    """ Get the tensor which compute() derives from inputs, from the data
+        cache if it is enabled.
+    """
+    if _cache is None:
+        return compute()
+    return _cache.get(name, _digest(inputs), compute)
+
+def data_tensor(name, data, key, params, compute, recent):
+    """ Get the tensor called name which compute(data) derives from the
+        array data[key] and the values in params. The first dimension of the
+        tensor must be the time bins of data['S']. recent is a dictionary
+        owned by the component, in which the tensors derived from the most
+        recent full data are kept.
+
+        If data is a segment made by segment_data, the tensor of the full
+        data is computed, or taken from recent or the data cache, and the
+        rows of the segment are returned as a view. The tensor of a segment
+        therefore includes the history before the segment.
+    """
+    seg = data.get('segment', None)
+    if seg is None:
+        entry = recent.get(name, None)
+        if entry is not None and entry.matches(data[key], _n_bins(data),
+                                               data['T'], params):
+            return entry.x
+
+        entry = RecentTensor(data[key], _n_bins(data), data['T'], params)
+        if _cache is None:
+            entry.x = compute(data)
+        else:
+            entry.x = _cache.get(name, entry.digest(), lambda: compute(data))
+        recent[name] = entry
+        return entry.x
+
+    if seg.data is not None:
+        x = data_tensor(name, seg.data, key, params, compute, recent)
+        return x[seg.start:seg.stop]
+
+    # The full data was not sent along with the segment, so it is matched
+    # to the most recent full data by digest
+    entry = recent.get(name, None)
+    if entry is not None and entry.matches_digest(seg.digest(key), seg.n_bins,
+                                                  seg.T, params):
+        return entry.x[seg.start:seg.stop]
+
+    print "Warning: the full data of the segment is not available. " \
+          "Computing %s without the history before the segment." % name
+    return cached_tensor(name, [array_digest(data[key]),
+                                _n_bins(data), data['T']] + params,
+                         lambda: compute(data))
+
+class RecentTensor(object):
+    """ A tensor x derived from the array of a full dataset with n_bins time
+        bins of total length T, and from params. The array is kept to
+        recognize the same dataset by identity and is only hashed if a
+        digest is needed.
+    """
+    def __init__(self, array, n_bins, T, params):
+        self.array = array
+        self.n_bins = n_bins
+        self.T = T
+        self.params = params
+        self.params_digest = _digest(params)
+        self.array_digest = None
+        self.x = None
+
+    def matches(self, array, n_bins, T, params):
+        return array is self.array and n_bins == self.n_bins and \
+               T == self.T and _digest(params) == self.params_digest
+
+    def matches_digest(self, array_dgst, n_bins, T, params):
+        return n_bins == self.n_bins and T == self.T and \
+               _digest(params) == self.params_digest and \
+               array_dgst == self.get_array_digest()
+
+    def get_array_digest(self):
+        if self.array_digest is None:
+            self.array_digest = array_digest(self.array)
+        return self.array_digest
+
+    def digest(self):
+        """ Digest of everything the tensor is derived from
+        """
+        return _digest([self.get_array_digest(), self.n_bins, self.T] +
+                       self.params)
+
+def _n_bins(data):
+    if 'S' in data:
+        return data['S'].shape[0]
+    return None
+
+def array_digest(x):
+    """ Digest of the contents of an array or sparse matrix
+    """
+    return _digest([x])
+
+def _digest(inputs):
+    """ Digest of a list of arrays and scalars. Arrays are hashed by their
+        dtype, shape and contents, and sparse matrices by their shape and
+        CSR arrays.
+    """
+    h = hashlib.sha1()
+    for x in inputs:
+        if scipy.sparse.issparse(x):
+            x = x.tocsr()
+            x.sum_duplicates()
+            h.update(repr(('csr', x.shape)))
+            h.update(_digest([x.indptr, x.indices, x.data]))
+        elif isinstance(x, np.ndarray):
+            h.update(repr((x.dtype.str, x.shape)))
+            if x.ndim == 0:
+                h.update(repr(x.item()))
+                continue
+            # Hash large arrays a block of rows at a time so that a memory
+            # mapped input is not read into memory at once
+            step = max(1, (1<<24) / max(1, x.nbytes / max(1, x.shape[0])))
+            for start in np.arange(0, x.shape[0], step):
+                h.update(np.ascontiguousarray(x[start:start+step]).data)
+        else:
+            h.update(repr(x))
+    return h.hexdigest()
@@ -0,0 +1,205 @@
+""" A columnar, on-disk format for datasets. A dataset is a directory with
+    one .npy file for each top-level array of the data dictionary (the spike
+    counts S, the stimulus, ...) and a pickle, meta.pkl, of everything else
+    (N, dt, T, the true parameters of synthetic data, ...) and of the total
+    number of spikes in S. Sparse spike count matrices are stored as their
+    three CSR arrays. The arrays are
+    opened memory mapped, so opening a dataset takes constant time
+    regardless of the length of the recording, and only the parts that are
+    used are ever read from disk.
+
+    A long simulation, e.g. from Population.simulate_chunks, is written a
+    chunk of time bins at a time by save_dataset_chunks.
+
+    A dataset of many trials, e.g. from batch_simulation.simulate_trials,
+    stores the entries shared by all trials at the top level and each trial
+    in a subdirectory, which is itself a dataset. Trials are written and
+    read one at a time.
+"""
+import os
+import cPickle
+
+import numpy as np
+import scipy.sparse
+
+META_FILE = 'meta.pkl'
+TRIAL_DIR = 'trial_%06d'
+
+def is_dataset(path):
+    """ Check whether path is a dataset directory
+    """
+    return os.path.isdir(path) and \
+           os.path.exists(os.path.join(path, META_FILE))
+
+def save_dataset(data, path):
+    """ Write the data dictionary to a dataset directory
+    """
+    if not os.path.exists(path):
+        os.makedirs(path)
+
+    (meta, arrays) = _save_arrays(data, path)
+    n_spikes = float(data['S'].sum()) if 'S' in data else None
+    _save_meta(meta, arrays, path, n_spikes)
+
+def _save_arrays(data, path):
+    """ Write the arrays of the data dictionary and get the remaining
+        entries and the formats of the arrays
+    """
+    meta = {}
+    arrays = {}
+    for (k,v) in data.items():
+        if scipy.sparse.issparse(v):
+            v = v.tocsr()
+            v.sum_duplicates()
+            for part in ['data', 'indices', 'indptr']:
+                np.save(os.path.join(path, '%s.%s.npy' % (k, part)),
+                        getattr(v, part))
+            arrays[k] = ('csr', v.shape)
+        elif isinstance(v, np.ndarray) and v.ndim > 0 and \
+             v.dtype != np.object:
+            np.save(os.path.join(path, '%s.npy' % k), v)
+            arrays[k] = ('dense', v.shape)
+        else:
+            meta[k] = v
+    return meta, arrays
+
+def _save_meta(meta, arrays, path, n_spikes):
+    """ Write the metadata. This is done last so that a partially written
+        dataset is not recognized.
+    """
+    with open(os.path.join(path, META_FILE), 'wb') as f:
+        cPickle.dump({'meta' : meta,
+                      'arrays' : arrays,
+                      'n_spikes' : n_spikes},
+                     f, protocol=-1)
+
+def dataset_spike_count(path):
+    """ Get the number of spikes in a dataset without reading its spike
+        counts. Returns None for datasets written without the count.
+    """
+    with open(os.path.join(path, META_FILE), 'rb') as f:
+        contents = cPickle.load(f)
+    return contents.get('n_spikes', None)
+
+def save_dataset_chunks(chunks, data, path):
+    """ Write a dataset whose spike counts S, and currents X if the chunks
+        have them, are given by a sequence of consecutive chunks of time
+        bins, e.g. from Population.simulate_chunks, so that they are never
+        held in memory at once. Each chunk is appended to a raw file as it
+        arrives, and the raw files are copied to .npy files at the end. The
+        other entries of the dataset are taken from data.
+
+    :rtype the number of spikes of each neuron
+    """
+    if not os.path.exists(path):
+        os.makedirs(path)
+
+    dtypes = {'S.data' : np.float64,
+              'S.indices' : np.int64,
+              'S.indptr' : np.int64,
+              'X' : np.float64}
+    raw = dict([(k, open(os.path.join(path, '%s.raw' % k), 'wb'))
+                for k in dtypes.keys()])
+    try:
+        np.zeros(1, dtype=np.int64).tofile(raw['S.indptr'])
+        (nT, N, nnz) = (0, data['N'], 0)
+        nS = np.zeros(N)
+        has_X = False
+        for chunk in chunks:
+            S = chunk['S'].tocsr()
+            S.sum_duplicates()
+            S.data.astype(np.float64).tofile(raw['S.data'])
+            S.indices.astype(np.int64).tofile(raw['S.indices'])
+            (S.indptr[1:].astype(np.int64) + nnz).tofile(raw['S.indptr'])
+            if 'X' in chunk:
+                np.ascontiguousarray(chunk['X'], dtype=np.float64).tofile(raw['X'])
+                has_X = True
+            nT += S.shape[0]
+            nnz += S.nnz
+            nS += np.asarray(S.sum(0)).ravel()
+    finally:
+        for f in raw.values():
+            f.close()
+
+    shapes = {'S.data' : (nnz,),
+              'S.indices' : (nnz,),
+              'S.indptr' : (nT+1,),
+              'X' : (nT, N)}
+    for (k, dtype) in dtypes.items():
+        raw_path = os.path.join(path, '%s.raw' % k)
+        if k != 'X' or has_X:
+            _raw_to_npy(raw_path, dtype, shapes[k],
+                        os.path.join(path, '%s.npy' % k))
+        os.remove(raw_path)
+
+    data = dict([(k,v) for (k,v) in data.items() if k not in ['S', 'X']])
+    (meta, arrays) = _save_arrays(data, path)
+    arrays['S'] = ('csr', (nT, N))
+    if has_X:
+        arrays['X'] = ('dense', (nT, N))
+    _save_meta(meta, arrays, path, float(np.sum(nS)))
+    return nS
+
+def _raw_to_npy(raw_path, dtype, shape, npy_path):
+    """ Copy a raw array file to a .npy file a block of rows at a time
+    """
+    if np.prod(shape) == 0:
+        np.save(npy_path, np.zeros(shape, dtype=dtype))
+        return
+    src = np.memmap(raw_path, dtype=dtype, mode='r', shape=shape)
+    dst = np.lib.format.open_memmap(npy_path, mode='w+', dtype=dtype,
+                                    shape=shape)
+    step = max(1, (1<<24) / max(1, src.nbytes / shape[0]))
+    for start in np.arange(0, shape[0], step):
+        dst[start:start+step] = src[start:start+step]
+    dst.flush()
+    del src, dst
+
+def load_dataset(path, mmap_mode='r'):
+    """ Open a dataset directory. The arrays are memory mapped unless
+        mmap_mode is None.
+    """
+    with open(os.path.join(path, META_FILE), 'rb') as f:
+        contents = cPickle.load(f)
+
+    data = dict(contents['meta'])
+    for (k, (fmt, shape)) in contents['arrays'].items():
+        if fmt == 'csr':
+            (d, i, p) = [np.load(os.path.join(path, '%s.%s.npy' % (k, part)),
+                                 mmap_mode=mmap_mode)
+                         for part in ['data', 'indices', 'indptr']]
+            data[k] = scipy.sparse.csr_matrix((d, i, p), shape=shape,
+                                              copy=False)
+        else:
+            data[k] = np.load(os.path.join(path, '%s.npy' % k),
+                              mmap_mode=mmap_mode)
+    return data
+
+def trial_path(path, k):
+    """ Path of the k-th trial of a dataset of trials
+    """
+    return os.path.join(path, TRIAL_DIR % k)
+
+def save_trial(path, k, data):
+    """ Write the k-th trial of a dataset of trials. Trials may be written
+        concurrently by different processes.
+    """
+    save_dataset(data, trial_path(path, k))
+
+def list_trials(path):
+    """ Get the sorted indices of the trials written to a dataset
+    """
+    prefix = TRIAL_DIR.split('%')[0]
+    trials = []
+    for name in os.listdir(path):
+        if name.startswith(prefix) and is_dataset(os.path.join(path, name)):
+            trials.append(int(name[len(prefix):]))
+    return sorted(trials)
+
+def load_trial(path, k, mmap_mode='r'):
+    """ Open the k-th trial of a dataset of trials. The entries of the trial
+        are added to the entries shared by all trials.
+    """
+    data = load_dataset(path, mmap_mode)
+    data.update(load_dataset(trial_path(path, k), mmap_mode))
+    return data
@@ -1,7 +1,96 @@
+import collections
+
 import numpy as np
 from numpy.fft import rfftn, irfftn
 from numpy.fft import fftn, ifftn
 
+class FFTCache(object):
+    """ A cache of the real FFTs of stimuli, keyed by a digest of the
+        contents of the stimulus and the FFT size. The total size of the
+        cached transforms is bounded by max_bytes, and the least recently
+        used transforms are evicted first.
+    """
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self._entries = collections.OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def rfftn(self, x, fsize):
+        """ Get rfftn(x, fsize), computing it if it is not in the cache
+        """
+        from utils.data_cache import array_digest
+        key = (array_digest(x), tuple(int(s) for s in fsize))
+
+        fft_x = self._entries.pop(key, None)
+        if fft_x is not None:
+            self.hits += 1
+            self._entries[key] = fft_x
+            return fft_x
+
+        self.misses += 1
+        fft_x = rfftn(x, fsize)
+        if fft_x.nbytes <= self.max_bytes:
+            self._entries[key] = fft_x
+            self.nbytes += fft_x.nbytes
+            self._evict()
+        return fft_x
+
+    def resize(self, max_bytes):
+        """ Set the memory budget, evicting transforms as necessary
+        """
+        self.max_bytes = max_bytes
+        self._evict()
+
+    def _evict(self):
+        while self.nbytes > self.max_bytes:
+            (_, old) = self._entries.popitem(last=False)
+            self.nbytes -= old.nbytes
+            self.evictions += 1
+
+    def clear(self):
+        self._entries.clear()
+        self.nbytes = 0
+
+    def stats(self):
+        """ Get the hit, miss and eviction counts
+        """
+        return {'hits' : self.hits,
+                'misses' : self.misses,
+                'evictions' : self.evictions,
+                'nbytes' : self.nbytes}
+
+    def __str__(self):
+        lookups = max(self.hits + self.misses, 1)
+        return "FFTCache: %d hits, %d misses (%.1f%% hit rate), " \
+               "%d evictions, %.1f/%.1fMB" % \
+               (self.hits, self.misses, 100.0*self.hits/lookups,
+                self.evictions, self.nbytes/2.0**20, self.max_bytes/2.0**20)
+
+# The cache shared by the stimulus convolutions
+_fft_cache = FFTCache(max_bytes=512 * 2**20)
+
+def get_fft_cache():
+    """ Get the cache of stimulus FFTs
+    """
+    return _fft_cache
+
+def set_fft_cache_size(max_bytes):
+    """ Set the memory budget of the cache of stimulus FFTs, evicting the
+        least recently used transforms as necessary.
+    """
+    _fft_cache.resize(max_bytes)
+
+def fft_size(s1, s2):
+    """ The power of two FFT size used by fftconvolve to convolve arrays of
+        shapes s1 and s2
+    """
+    size = np.array(s1) + np.array(s2) - 1
+    return 2 ** np.ceil(np.log2(size)).astype(int)
+
 def fftconvolve(in1, in2, mode="full", fft_in1=None, fft_in2=None):
     """Convolve two N-dimensional arrays using FFT.
 
@@ -90,7 +179,7 @@ def fftconvolve(in1, in2, mode="full", fft_in1=None, fft_in2=None):
 
 
     # Always use 2**n-sized FFT
-    fsize = 2 ** np.ceil(np.log2(size)).astype(int)
+    fsize = fft_size(s1, s2)
     fslice = tuple([slice(0, int(sz)) for sz in size])
     fft1_given = not (fft_in1 is None)
     fft2_given = not (fft_in2 is None)
@@ -0,0 +1,176 @@
+""" A persistent, on-disk cache of compiled Theano functions. Compiling the
+    log probabilities and gradients of a Population takes far longer than
+    evaluating them, and every process that builds the same model repeats
+    that work. The cache stores each compiled function under a directory
+    named for the backend versions and the model (template, N, basis sizes),
+    keyed by a digest of the expression graph, so a warm start simply
+    unpickles the optimized function.
+
+    Shared variables (the data, the basis, the hyperparameters) hold small
+    placeholders while a function is written to disk, and a loaded function
+    reads the shared variables of the current process.
+"""
+import os
+import sys
+import time
+import hashlib
+import cPickle
+
+import numpy as np
+import theano
+from theano.compile import SharedVariable
+
+class DiskFunctionCache(object):
+    """ Cache of compiled functions for one model. Functions are loaded from
+        cache_dir if present, otherwise compiled and written to cache_dir.
+    """
+    def __init__(self, cache_dir, model):
+        self.cache_dir = cache_dir
+        self.model_dir = os.path.join(cache_dir, _version_key(), _model_key(model))
+        if not os.path.exists(self.model_dir):
+            os.makedirs(self.model_dir)
+
+        self.n_compiled = 0
+        self.n_loaded = 0
+        self.compile_time = 0.0
+        self.load_time = 0.0
+
+    def function(self, sargs, expr):
+        """ Get a Theano function of the positional inputs sargs which
+            computes expr, loading it from disk if possible.
+        """
+        outputs = expr if isinstance(expr, list) else [expr]
+        shared = _shared_inputs(outputs)
+        path = os.path.join(self.model_dir, _graph_key(sargs, outputs) + '.pkl')
+
+        if os.path.exists(path):
+            start = time.time()
+            f = self._load(path, shared, not isinstance(expr, list))
+            if f is not None:
+                self.n_loaded += 1
+                self.load_time += time.time() - start
+                return f
+
+        start = time.time()
+        f = theano.function(sargs, expr, on_unused_input='ignore')
+        self.n_compiled += 1
+        self.compile_time += time.time() - start
+        self._save(path, f, shared)
+        return f
+
+    def _load(self, path, shared, unpack_single):
+        """ Load a function and bind it to the shared variables of this
+            process. Return None if the file cannot be used.
+        """
+        try:
+            with open(path, 'rb') as fin:
+                (f, indices) = cPickle.load(fin)
+            # Unpickled functions always return a list of outputs
+            f.unpack_single = unpack_single
+            containers = [f.input_storage[i] for (i,inp) in
+                          enumerate(f.maker.inputs) if inp.implicit]
+            bindings = [(c, shared[j].container) for (c,j) in
+                        zip(containers, indices)]
+            return BoundFunction(f, bindings)
+        except Exception as e:
+            print "Warning: could not load cached function %s (%s)" % (path, e)
+            return None
+
+    def _save(self, path, f, shared):
+        """ Write the function to disk along with the position of each of its
+            shared variables in the graph. The values of the shared variables
+            are temporarily replaced by small placeholders so that the data
+            is not written too. Write to a temporary file first so that
+            concurrent processes never read a partial file.
+        """
+        implicit = [inp.variable for inp in f.maker.inputs if inp.implicit]
+        values = [v.container.storage[0] for v in implicit]
+        try:
+            indices = [shared.index(v) for v in implicit]
+            for v in implicit:
+                v.container.storage[0] = np.zeros((1,)*v.ndim, dtype=v.dtype)
+            tmp_path = '%s.%d.tmp' % (path, os.getpid())
+            with open(tmp_path, 'wb') as fout:
+                cPickle.dump((f, indices), fout, protocol=-1)
+            os.rename(tmp_path, path)
+        except Exception as e:
+            print "Warning: could not save cached function %s (%s)" % (path, e)
+        finally:
+            for (v,value) in zip(implicit, values):
+                v.container.storage[0] = value
+
+    def stats(self):
+        """ Get the compile and load counts and times
+        """
+        return {'compiled' : self.n_compiled,
+                'loaded' : self.n_loaded,
+                'compile_time' : self.compile_time,
+                'load_time' : self.load_time}
+
+    def __str__(self):
+        return "DiskFunctionCache(%s): compiled %d functions in %.2fs, " \
+               "loaded %d functions in %.2fs" % \
+               (self.model_dir, self.n_compiled, self.compile_time,
+                self.n_loaded, self.load_time)
+
+class BoundFunction(object):
+    """ A function loaded from disk, whose shared inputs are bound to the
+        shared variables of this process. Before each call the current values
+        of the shared variables are passed by reference, so later calls to
+        set_value are seen by the function without copying any data.
+    """
+    def __init__(self, f, bindings):
+        self.f = f
+        self.bindings = bindings
+
+    def __call__(self, *args):
+        for (c, sc) in self.bindings:
+            c.storage[0] = sc.storage[0]
+        return self.f(*args)
+
+def _version_key():
+    """ Compiled functions are only valid for the same versions of Python,
+        NumPy and Theano.
+    """
+    return "py%d.%d-numpy%s-theano%s" % (sys.version_info[0],
+                                         sys.version_info[1],
+                                         np.__version__,
+                                         theano.__version__)
+
+def _model_key(model):
+    """ Name the directory for a model after its number of neurons and a
+        digest of the full template, which includes the basis sizes.
+    """
+    digest = hashlib.sha1(repr(_canonical(model))).hexdigest()
+    return "N%d-%s" % (model['N'], digest[:16])
+
+def _canonical(d):
+    """ Convert a hierarchical model dictionary into a representation whose
+        repr does not depend on dictionary ordering.
+    """
+    if isinstance(d, dict):
+        return tuple((k, _canonical(v)) for (k,v) in sorted(d.items()))
+    elif isinstance(d, (list, tuple)):
+        return tuple(map(_canonical, d))
+    elif isinstance(d, np.ndarray):
+        return (d.dtype.str, d.shape, d.tolist())
+    return d
+
+def _graph_key(sargs, outputs):
+    """ Digest of the expression graph and the order of its inputs. Only the
+        structure of the graph is printed, not the values of shared variables.
+    """
+    desc = theano.printing.debugprint(outputs, file='str')
+    desc += repr([(str(v), str(v.type)) for v in sargs])
+    return hashlib.sha1(desc).hexdigest()
+
+def _shared_inputs(outputs):
+    """ Get the shared variables the outputs depend upon, in the order they
+        are found in the graph. This order is the same in every process that
+        constructs the same model.
+    """
+    shared = []
+    for v in theano.gof.graph.inputs(outputs):
+        if isinstance(v, SharedVariable) and v not in shared:
+            shared.append(v)
+    return shared
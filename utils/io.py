@@ -27,6 +27,13 @@ def parse_cmd_line_args():
     parser.add_option("-u", "--unique_result", dest="unique_results", default="true",
                       help="Whether or not to create a unique results directory.")
 
+    parser.add_option("-c", "--cacheDir", dest="cacheDir", default=None,
+                      help="Load compiled functions and filtered data from, and save them to, this directory.")
+
+    parser.add_option("--profile-startup", dest="profile_startup",
+                      action="store_true", default=False,
+                      help="Print the time spent importing modules, building the model, and compiling functions.")
+
 
     # Parallel-specific options for loading IPython profiles
     parser.add_option("-p", "--profile", dest="profile", default='default',
@@ -79,68 +86,205 @@ def load_data(options):
     """
     # Load data
     if not options.dataFile is None:
-        if options.dataFile.endswith('.mat'):
-            print "Loading data from %s" % options.dataFile
-            print "WARNING: true parameters for synthetic data " \
-                  "will not be loaded properly"
-
-            import scipy.io
-            data = scipy.io.loadmat(options.dataFile,
-                                    squeeze_me=True)
-
-            # Scipy IO is a bit weird... ints like 'N' are saved as arrays
-            # and the dictionary of parameters doesn't get reloaded as a dictionary
-            # but rather as a record array. Do some cleanup here.
-            data['N'] = int(data['N'])
-            data['T'] = np.float(data['T'])
-            
-        elif options.dataFile.endswith('.pkl'):
-            print "Loading data from %s" % options.dataFile
-            with open(options.dataFile,'r') as f:
-                data = cPickle.load(f)
-
-                # Print data stats
-                N = data['N']
-                Ns = np.sum(data['S'])
-                T = data['S'].shape[0]
-                fr = 1.0/data['dt']
-                print "Data has %d neurons, %d spikes, " \
-                      "and %d time bins at %.3fHz sample rate" % \
-                      (N,Ns,T,fr)
-
-        else:
-            raise Exception("Unrecognized file type: %s" % options.dataFile)
-
+        data = read_data_file(options.dataFile)
     else:
-        raise Exception("Path to data file (.mat or .pkl) must be specified with the -d switch. "
+        raise Exception("Path to data file (.mat, .pkl or dataset directory) must be specified with the -d switch. "
                          "To generate synthetic data, run the test.generate_synth_data script.")
     
     return data
 
+def read_data_file(fname):
+    """ Read data from a .mat file, a .pkl file, or a dataset directory (see
+        utils.dataset). The arrays of a dataset directory are memory mapped.
+    """
+    from utils.spikes import load_spikes
+    from utils.dataset import is_dataset, load_dataset, dataset_spike_count
+
+    if is_dataset(fname):
+        print "Opening dataset %s" % fname
+        data = load_dataset(fname)
+
+        # Spike times are binned into a sparse matrix
+        load_spikes(data)
+
+        # Print data stats. The spikes are not counted, since that would
+        # read all of S from disk.
+        print_data_stats(data, dataset_spike_count(fname), count_spikes=False)
+
+    elif fname.endswith('.mat'):
+        print "Loading data from %s" % fname
+        print "WARNING: true parameters for synthetic data " \
+              "will not be loaded properly"
+
+        import scipy.io
+        data = scipy.io.loadmat(fname,
+                                squeeze_me=True)
+
+        # Scipy IO is a bit weird... ints like 'N' are saved as arrays
+        # and the dictionary of parameters doesn't get reloaded as a dictionary
+        # but rather as a record array. Do some cleanup here.
+        data['N'] = int(data['N'])
+        data['T'] = np.float(data['T'])
+
+        # Spike times are binned into a sparse matrix
+        load_spikes(data)
+        
+    elif fname.endswith('.pkl'):
+        print "Loading data from %s" % fname
+        with open(fname,'r') as f:
+            data = cPickle.load(f)
+
+            # Spike times are binned into a sparse matrix
+            load_spikes(data)
+
+            # Print data stats
+            print_data_stats(data)
+
+    else:
+        raise Exception("Unrecognized file type: %s" % fname)
+
+    return data
+
+def print_data_stats(data, n_spikes=None, count_spikes=True):
+    """ Print the number of neurons, spikes and time bins in the data. If
+        n_spikes is not given, the spikes are counted, unless count_spikes
+        is False.
+    """
+    N = data['N']
+    T = data['S'].shape[0]
+    fr = 1.0/data['dt']
+    if n_spikes is None and count_spikes:
+        n_spikes = data['S'].sum()
+    if n_spikes is None:
+        print "Data has %d neurons and %d time bins at %.3fHz sample rate" % \
+              (N,T,fr)
+    else:
+        print "Data has %d neurons, %d spikes, " \
+              "and %d time bins at %.3fHz sample rate" % \
+              (N,n_spikes,T,fr)
+
 def segment_data(data, (T_start, T_stop)):
-    """ Extract a segment of the data
+    """ Extract a segment of the data. The arrays of the segment are views of
+        the arrays of data and the other entries are shared with data, so
+        nothing is copied. The components slice the tensors they derive from
+        the full data, e.g. the filtered spike trains, rather than filtering
+        the segment, so the segment keeps the history before T_start.
     """
-    import copy
-    new_data = copy.deepcopy(data)
-    
+    from utils.spikes import slice_spikes
+
     # Check that T_start and T_stop are within the range of the data
     assert T_start >= 0 and T_start <= data['T']
     assert T_stop >= 0 and T_stop <= data['T']
     assert T_start < T_stop
 
+    new_data = dict(data)
+
     # Set the new T's
     new_data['T'] = T_stop - T_start
 
     # Get indices for start and stop of spike train
-    i_start = T_start // data['dt']
-    i_stop = T_stop // data['dt']
-    new_data['S'] = new_data['S'][i_start:i_stop, :]
+    i_start = _time_to_bin(T_start, data['dt'])
+    i_stop = _time_to_bin(T_stop, data['dt'])
+    new_data['S'] = slice_spikes(data['S'], i_start, i_stop)
+    if 'X' in data:
+        new_data['X'] = data['X'][i_start:i_stop, :]
     
     # Get indices for start and stop of stim
-    i_start = T_start // data['dt_stim']
-    i_stop = T_stop // data['dt_stim']
-    new_data['stim'] = new_data['stim'][i_start:i_stop, :]
+    j_start = _time_to_bin(T_start, data['dt_stim'])
+    j_stop = _time_to_bin(T_stop, data['dt_stim'])
+    new_data['stim'] = data['stim'][j_start:j_stop, :]
+
+    # Shift the bins held out of the likelihood to the segment
+    if data.get('holdout', None) is not None:
+        (h_start, h_stop) = data['holdout']
+        h_start = min(max(h_start - i_start, 0), i_stop - i_start)
+        h_stop = min(max(h_stop - i_start, 0), i_stop - i_start)
+        new_data['holdout'] = (h_start, h_stop) if h_stop > h_start else None
+
+    # Locate the segment in the full data
+    seg = data.get('segment', None)
+    if seg is None:
+        new_data['segment'] = DataSegment(data, i_start, i_stop)
+    elif seg.data is not None:
+        new_data['segment'] = DataSegment(seg.data, seg.start + i_start,
+                                          seg.start + i_stop)
+    else:
+        # A segment whose full data is not available is treated as full data
+        parent = dict(data)
+        del parent['segment']
+        new_data['segment'] = DataSegment(parent, i_start, i_stop)
     
     return new_data
 
+def blocked_splits(data, n_folds):
+    """ Split the data into n_folds consecutive blocks of time and yield a
+        training segment of blocks 0:k and a test segment of block k, for
+        k=1..n_folds-1. The model is always tested on the future.
+    """
+    T_edges = np.linspace(0, data['T'], n_folds+1)
+    for k in np.arange(1, n_folds):
+        yield (segment_data(data, (0, T_edges[k])),
+               segment_data(data, (T_edges[k], T_edges[k+1])))
+
+def kfold_splits(data, n_folds):
+    """ Split the data into n_folds consecutive blocks of time. For each
+        block, yield the training data, which is the full data with the bins
+        of the block held out of the likelihood, and a test segment of the
+        block. The training data shares the arrays of data, so it is fit
+        like any other data set, and the spikes of the held out block still
+        enter the history of the bins after it. Everything fit to the
+        training data leaves the spikes of the block out, i.e. the likelihood
+        (Glm.set_data) and the STA initialization (utils.sta).
+    """
+    T_edges = np.linspace(0, data['T'], n_folds+1)
+    for k in np.arange(n_folds):
+        train = dict(data)
+        train['holdout'] = (_time_to_bin(T_edges[k], data['dt']),
+                            _time_to_bin(T_edges[k+1], data['dt']))
+        yield (train, segment_data(data, (T_edges[k], T_edges[k+1])))
+
+def _time_to_bin(t, dt):
+    """ Index of the bin starting at time t. Round rather than floor so that
+        times which are multiples of dt are not truncated by rounding error.
+    """
+    return int(np.round(t / dt))
+
+class DataSegment(object):
+    """ The location of a segment made by segment_data in the full data: the
+        time bins start:stop. The full data is not pickled with the segment,
+        only the digests of its arrays, so a segment sent to another process
+        can still be matched to the full data set there.
+    """
+    def __init__(self, data, start, stop):
+        self.data = data
+        self.start = start
+        self.stop = stop
+        self.n_bins = data['S'].shape[0]
+        self.T = data['T']
+        self.digests = {}
+
+    def digest(self, key):
+        """ Digest of the array data[key] of the full data
+        """
+        from utils.data_cache import array_digest
+        if key not in self.digests:
+            self.digests[key] = array_digest(self.data[key])
+        return self.digests[key]
+
+    def __getstate__(self):
+        if self.data is not None:
+            for key in ['S', 'stim']:
+                if key in self.data:
+                    self.digest(key)
+        state = dict(self.__dict__)
+        state['data'] = None
+        return state
+
+    def __deepcopy__(self, memo):
+        # Copies of a segment refer to the same full data
+        seg = DataSegment.__new__(DataSegment)
+        seg.__dict__.update(self.__dict__)
+        seg.digests = dict(self.digests)
+        return seg
+
     
@@ -1,31 +1,111 @@
 import numpy as np
 
+class ParameterLayout(object):
+    """ The fixed position of each variable of a hierarchical dictionary in a
+        flat vector. The layout is computed once from the shapes returned by
+        packdict, so packing writes each variable straight into its slot of
+        the vector and unpacking returns views of the vector. Neither
+        requires sorting the keys or concatenating arrays.
+    """
+    def __init__(self, shapes):
+        self.shapes = shapes
+        # Key paths of the sub dictionaries, parents before children
+        self.dicts = []
+        # (key path, offset, size, shape) for each variable
+        self.leaves = []
+        self.size = _layout_helper(shapes, (), 0, self.dicts, self.leaves)
+
+    @staticmethod
+    def from_vars(var_dict):
+        """ Compute the layout of a dictionary of variables
+        """
+        _,shapes = packdict(var_dict)
+        return ParameterLayout(shapes)
+
+    def pack(self, var_dict, out=None):
+        """ Pack a dictionary of variables into a vector. If out is given the
+            variables are written into it, otherwise a new vector is
+            allocated.
+        """
+        if out is None:
+            out = np.empty((self.size,))
+        for (path, off, sz, _) in self.leaves:
+            val = var_dict
+            for k in path:
+                val = val[k]
+            out[off:off+sz] = np.ravel(val)
+        return out
+
+    def unpack(self, vec):
+        """ Unpack a vector into a dictionary of variables. The variables are
+            views of vec, not copies.
+        """
+        assert np.size(vec) == self.size, "Unpack was called with a vector of the wrong size!"
+        vars = {}
+        for path in self.dicts:
+            _get_parent(vars, path)[path[-1]] = {}
+        for (path, off, sz, shp) in self.leaves:
+            _get_parent(vars, path)[path[-1]] = np.reshape(vec[off:off+sz], shp)
+        return vars
+
+def _layout_helper(shapes, prefix, offset, dicts, leaves):
+    """ ParameterLayout recursion helper. Return the offset after the last
+        variable.
+    """
+    # This sorting is important!
+    for (var, shp) in sorted(shapes.items(), key=lambda t: t[0]):
+        path = prefix + (var,)
+        if isinstance(shp, dict):
+            dicts.append(path)
+            offset = _layout_helper(shp, path, offset, dicts, leaves)
+        elif isinstance(shp, tuple):
+            sz = int(np.prod(shp))
+            leaves.append((path, offset, sz, shp))
+            offset += sz
+        else:
+            raise Exception("Can only unpack shape tuples!")
+    return offset
+
+def _get_parent(d, path):
+    """ Get the dictionary containing the last key of the path
+    """
+    for k in path[:-1]:
+        d = d[k]
+    return d
+
 def pack(var_list):
     """ Pack a list of variables (as numpy arrays) into a single vector
     """
-    vec = np.zeros((0,))
+    vecs = []
     shapes = []
     for var in var_list:
-        assert isinstance(vec, np.ndarray), "Can only pack numpy arrays!"
+        assert isinstance(var, np.ndarray), "Can only pack numpy arrays!"
         sz = var.size
         shp = var.shape
         assert sz == np.prod(shp), "Just making sure the size matches the shape"
         shapes.append(shp)
-        vec = np.concatenate((vec, np.reshape(var, (sz,))))
+        vecs.append(np.reshape(var, (sz,)))
+    vec = np.concatenate(vecs) if len(vecs) > 0 else np.zeros((0,))
     return vec, shapes
 
 def packdict(var_dict, on_unpackable_type='raise'):
     """ Pack a dictionary of variables (as numpy arrays) into a single vector
     """
-    vec = np.zeros((0,))
+    vecs = []
+    shapes = _packdict_helper(var_dict, vecs, on_unpackable_type)
+    vec = np.concatenate(vecs) if len(vecs) > 0 else np.zeros((0,))
+    return vec, shapes
+
+def _packdict_helper(var_dict, vecs, on_unpackable_type):
+    """ Pack dictionary recursion helper. The flattened variables are
+        appended to vecs and concatenated once at the end.
+    """
     shapes = {}
     # This sorting is important!
     for (var, val) in sorted(var_dict.items(), key=lambda t: t[0]):
         if isinstance(val, dict):
             # Recurse on sub dictionary
-            svec, sshapes = packdict(val)
-            vec = np.concatenate((vec,svec))
-            shapes[var] = sshapes
+            shapes[var] = _packdict_helper(val, vecs, on_unpackable_type)
         elif val == []:
             continue
         else:
@@ -39,9 +119,9 @@ def packdict(var_dict, on_unpackable_type='raise'):
             sz = val.size
             shp = val.shape
             shapes[var] = shp
-            vec = np.concatenate((vec, np.reshape(val, (sz,))))
+            vecs.append(np.reshape(val, (sz,)))
         
-    return vec, shapes
+    return shapes
 
 def unpack(vec, shapes):
     """ Unpack a vector of variables into an array
@@ -115,4 +195,9 @@ def set_vars(syms, vars, vals):
 def get_shapes(x, syms):
     xv = get_vars(syms, x)
     _,shapes = packdict(xv)
-    return shapes
\ No newline at end of file
+    return shapes
+
+def get_layout(x, syms):
+    """ Get the ParameterLayout of the variables in x corresponding to syms
+    """
+    return ParameterLayout(get_shapes(x, syms))
\ No newline at end of file
@@ -58,6 +58,75 @@ def sampleInhomogeneousPoissonProc(tt, lam):
         
     return S
 
+def sampleInhomogeneousPoissonProcs(tt, lam):
+    """
+    Sample N independent inhomogeneous Poisson processes with the rates in the
+    columns of the TxN matrix lam at times tt, as sampleInhomogeneousPoissonProc
+    does for one rate. The cumulative rates of all neurons are laid end to end,
+    each offset by the total area of the previous ones, so that the transformed
+    spike times of all neurons are located with a single searchsorted.
+
+    Adding the offsets rounds the cumulative rates of the later neurons to the
+    precision of the total area of all neurons. The offset values are therefore
+    only used to find the time bin of each spike. The bin is then checked, and
+    the spike time interpolated, against the neuron's own cumulative rate, so
+    the spike times are as precise as those of sampleInhomogeneousPoissonProc.
+
+    Returns the spike times ordered by neuron and then by time, and an array of
+    N+1 offsets such that the spike times of neuron n are S[ptr[n]:ptr[n+1]].
+    np.split(S, ptr[1:-1]) gives the per-neuron spike times accepted by
+    utils.spikes.spike_times_to_sparse.
+    """
+    tt = np.asarray(tt, dtype=np.float64)
+    lam = np.reshape(lam, (len(tt), -1))
+    (N_t, N) = lam.shape
+    
+    # Integrate each rate with the trapezoidal rule, as for a single rate
+    dt = np.reshape(np.diff(tt), [-1,1])
+    dlam = np.diff(lam, axis=0)
+    trapLam = 0.5*dt*(2*lam[1:]-dlam)
+    cumLam = np.vstack((np.zeros((1,N)), np.cumsum(trapLam, axis=0)))
+    intLam = cumLam[-1]
+    
+    # Draw the number of spikes of each neuron and its transformed spike times
+    nS = np.random.poisson(intLam)
+    ptr = np.concatenate(([0], np.cumsum(nS))).astype(np.int64)
+    n = np.repeat(np.arange(N), nS)
+    Q = np.random.uniform(0, 1, size=ptr[-1]) * intLam[n]
+    
+    # Sort the spike times within each neuron
+    Q = Q[np.lexsort((Q, n))]
+    
+    # Find the first time at which the cumulative rate reaches each spike by
+    # offsetting the spikes and the cumulative rates by the areas of the
+    # previous neurons. A spike is never placed before the second time of
+    # its neuron.
+    offset = np.concatenate(([0.0], np.cumsum(intLam)[:-1]))
+    cumLam_off = np.ravel((cumLam + offset).T)
+    t_ub = np.searchsorted(cumLam_off, Q + offset[n], side='left') - n*N_t
+    t_ub = np.clip(t_ub, 1, N_t-1)
+    
+    # The offsets may have rounded a spike into a neighbouring bin. Move it
+    # until it lies in (cumLam[t_ub-1], cumLam[t_ub]] of its own neuron.
+    cumLam_flat = np.ravel(cumLam.T)
+    start = n*N_t
+    while True:
+        up = (Q > cumLam_flat[start+t_ub]) & (t_ub < N_t-1)
+        down = (Q <= cumLam_flat[start+t_ub-1]) & (t_ub > 1)
+        if not np.any(up) and not np.any(down):
+            break
+        t_ub += up
+        t_ub -= down
+    
+    # Linearly interpolate between the times on either side
+    q_lb = cumLam_flat[start+t_ub-1]
+    q_ub = cumLam_flat[start+t_ub]
+    dq = q_ub - q_lb
+    q_frac = np.clip((Q - q_lb) / np.where(dq > 0, dq, 1.0), 0.0, 1.0)
+    
+    S = tt[t_ub-1] + q_frac*(tt[t_ub]-tt[t_ub-1])
+    return S, ptr
+
 def approximateFiringRate(S,(T_start,T_stop),N_bins):
     """
     Approximate the firing rate of a set of spikes by binning into equispaced
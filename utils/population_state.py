@@ -0,0 +1,126 @@
+""" A compact container for the state of a Population. The state is the
+    usual dictionary with a 'net' dictionary and a 'glms' list of per-neuron
+    dictionaries, but the floating point GLM parameters of all neurons are
+    stored in one contiguous N x P matrix and the per-neuron entries are
+    views of its rows. Snapshotting a sample is then a single array copy.
+"""
+import copy
+import numpy as np
+
+from utils.packvec import ParameterLayout, _get_parent
+
+class PopulationState(dict):
+    """ The state of a population of GLMs, with the same keys as the
+        dictionary returned by Population.sample. The floating point arrays
+        of glms[n] are views of row n of the matrix params, so modifying them
+        in place modifies the matrix. Entries that are rebound instead, e.g.
+        by set_vars, are copied into the matrix by sync, which is called
+        before the matrix is read.
+    """
+    def __init__(self, x, layout=None, params=None):
+        glms = x['glms']
+        dict.__init__(self, [(k, copy.deepcopy(v)) for (k,v) in x.items()
+                             if k != 'glms'])
+
+        if layout is None:
+            layout = ParameterLayout(_float_shapes(glms[0]))
+        self.layout = layout
+        skip = set([path for (path,_,_,_) in layout.leaves])
+
+        # Pack the parameters of each neuron unless they are given
+        if params is None:
+            params = np.empty((len(glms), layout.size))
+            for (n,xn) in enumerate(glms):
+                layout.pack(xn, out=params[n])
+        self.params = params
+
+        # Bind the per-neuron dictionaries to rows of the matrix
+        self._views = []
+        self['glms'] = []
+        for (n,xn) in enumerate(glms):
+            xn = _copy_dicts(xn, skip)
+            views = []
+            for (path, off, sz, shp) in layout.leaves:
+                view = params[n, off:off+sz].reshape(shp)
+                _get_parent(xn, path)[path[-1]] = view
+                views.append(view)
+            self._views.append(views)
+            self['glms'].append(xn)
+
+    @property
+    def N(self):
+        return self.params.shape[0]
+
+    def sync(self):
+        """ Copy any GLM parameters that have been rebound to new arrays
+            into the parameter matrix, and bind them to views again.
+        """
+        glms = self['glms']
+        for n in np.arange(self.N):
+            for (view, (path,_,_,_)) in zip(self._views[n], self.layout.leaves):
+                parent = _get_parent(glms[n], path)
+                val = parent[path[-1]]
+                if val is not view:
+                    view[...] = val
+                    parent[path[-1]] = view
+
+    def snapshot(self):
+        """ Copy the state. The GLM parameters are copied with a single
+            array copy.
+        """
+        self.sync()
+        return PopulationState(self, self.layout, np.copy(self.params))
+
+    def glm_values(self, path):
+        """ Get the values of one GLM variable for all neurons, stacked along
+            the first axis. The result is a view of the parameter matrix.
+        """
+        self.sync()
+        for (p, off, sz, shp) in self.layout.leaves:
+            if p == path:
+                return np.reshape(self.params[:, off:off+sz], (self.N,) + shp)
+        return np.array([_get_parent(xn, path)[path[-1]] for xn in self['glms']])
+
+    def __deepcopy__(self, memo):
+        return self.snapshot()
+
+    def __reduce__(self):
+        # Pickle as a plain dictionary so that saved samples do not depend on
+        # this class
+        self.sync()
+        return (dict, (dict(self),))
+
+def as_population_state(x):
+    """ Convert a state dictionary into a PopulationState, unless it is one
+        already.
+    """
+    if isinstance(x, PopulationState):
+        return x
+    return PopulationState(x)
+
+def _float_shapes(d):
+    """ Get the shapes of the floating point arrays in a dictionary, in the
+        format returned by packdict.
+    """
+    shapes = {}
+    for (k,v) in d.items():
+        if isinstance(v, dict):
+            shapes[k] = _float_shapes(v)
+        elif isinstance(v, np.ndarray) and v.dtype == np.float64:
+            shapes[k] = v.shape
+    return shapes
+
+def _copy_dicts(d, skip, prefix=()):
+    """ Copy a hierarchical dictionary. The leaves at the key paths in skip
+        are not copied since they are replaced by views.
+    """
+    c = {}
+    for (k,v) in d.items():
+        path = prefix + (k,)
+        if isinstance(v, dict):
+            c[k] = _copy_dicts(v, skip, path)
+        elif path in skip or isinstance(v, (int, long, float)):
+            c[k] = v
+        else:
+            c[k] = copy.deepcopy(v)
+    return c
@@ -0,0 +1,109 @@
+""" Representations of spike trains. The dense format is a TxN matrix of
+    spike counts. Long recordings at low firing rates are mostly zeros, so
+    they may instead be given as a sparse TxN matrix (scipy.sparse, stored
+    as CSR) or as a list of per-neuron arrays of spike times, which is
+    converted to CSR on loading. Everything that accepts data['S'] accepts
+    either matrix format.
+"""
+import numpy as np
+import scipy.sparse
+
+def is_sparse_spikes(S):
+    """ Check whether S is a sparse spike count matrix
+    """
+    return scipy.sparse.issparse(S)
+
+def as_sparse_spikes(S):
+    """ Convert a spike count matrix to CSR format
+    """
+    if is_sparse_spikes(S):
+        return S.tocsr()
+    return scipy.sparse.csr_matrix(np.asarray(S, dtype=np.float64))
+
+def as_dense_spikes(S):
+    """ Convert a spike count matrix to a dense array
+    """
+    if is_sparse_spikes(S):
+        return S.toarray()
+    return np.asarray(S)
+
+def slice_spikes(S, start, stop):
+    """ Get the time bins start:stop of a spike count matrix. The rows of a
+        dense matrix are a view, and the rows of a CSR matrix share its
+        arrays of nonzero entries.
+    """
+    if not is_sparse_spikes(S):
+        return S[start:stop]
+    S = S.tocsr()
+    (p0, p1) = (S.indptr[start], S.indptr[stop])
+    return scipy.sparse.csr_matrix((S.data[p0:p1], S.indices[p0:p1],
+                                    S.indptr[start:stop+1] - p0),
+                                   shape=(stop-start, S.shape[1]),
+                                   copy=False)
+
+def spike_times_to_sparse(spike_times, dt, nT):
+    """ Bin per-neuron lists of spike times into a sparse nT x N matrix of
+        spike counts with bins of width dt.
+    """
+    N = len(spike_times)
+    rows = []
+    cols = []
+    for (n,ts) in enumerate(spike_times):
+        t_bin = np.floor(np.asarray(ts, dtype=np.float64) / dt).astype(np.int64)
+        t_bin = t_bin[(t_bin >= 0) & (t_bin < nT)]
+        rows.append(t_bin)
+        cols.append(n*np.ones(len(t_bin), dtype=np.int64))
+    rows = np.concatenate(rows) if N > 0 else np.zeros(0, dtype=np.int64)
+    cols = np.concatenate(cols) if N > 0 else np.zeros(0, dtype=np.int64)
+
+    # Duplicate entries are summed, giving the count in each bin
+    S = scipy.sparse.coo_matrix((np.ones(len(rows)), (rows, cols)),
+                                shape=(nT, N))
+    return S.tocsr()
+
+def sparse_to_spike_times(S, dt):
+    """ Convert a spike count matrix into per-neuron arrays of spike times at
+        the start of each bin. Bins with several spikes are repeated.
+    """
+    S = as_sparse_spikes(S).tocsc()
+    spike_times = []
+    for n in np.arange(S.shape[1]):
+        (start, stop) = (S.indptr[n], S.indptr[n+1])
+        counts = np.round(S.data[start:stop]).astype(np.int64)
+        spike_times.append(dt * np.repeat(S.indices[start:stop], counts))
+    return spike_times
+
+def spike_indices(S):
+    """ Get the nonzero bins of a spike count matrix ordered by neuron. Returns
+        the time bins, the neurons and the counts of the nonzero entries, and
+        an array of N+1 offsets such that the entries of neuron n are
+        ptr[n]:ptr[n+1].
+    """
+    if is_sparse_spikes(S):
+        S = S.tocsc()
+        S.sum_duplicates()
+        S.eliminate_zeros()
+        N = S.shape[1]
+        t = S.indices.astype(np.int64)
+        n = np.repeat(np.arange(N), np.diff(S.indptr)).astype(np.int64)
+        c = S.data.astype(np.float64)
+        ptr = S.indptr.astype(np.int64)
+    else:
+        S = np.asarray(S)
+        N = S.shape[1]
+        (n, t) = np.nonzero(S.T)
+        c = S[t, n].astype(np.float64)
+        ptr = np.concatenate(([0], np.cumsum(np.bincount(n, minlength=N))))
+        (t, n, ptr) = (t.astype(np.int64), n.astype(np.int64), ptr.astype(np.int64))
+    return t, n, c, ptr
+
+def load_spikes(data):
+    """ Make data['S'] a spike count matrix. Data given as per-neuron spike
+        times in data['spike_times'] is binned into a sparse matrix with
+        the resolution data['dt'].
+    """
+    if 'S' not in data and 'spike_times' in data:
+        nT = int(np.round(data['T'] / data['dt']))
+        data['S'] = spike_times_to_sparse(data['spike_times'], data['dt'], nT)
+        del data['spike_times']
+    return data
@@ -3,13 +3,19 @@
 """
 import numpy as np
 
+from utils.spikes import as_dense_spikes
+
 def sta(stim, data, L, Ns=None):
     """ Compute the spike-triggered average as an initialization for spatiotemporal
     stimulus filters.
     data : dictionary containing the following keys
-           'S'  : TxN matrix of spike counts for T time bins and N neurons
+           'S'  : TxN matrix of spike counts for T time bins and N neurons,
+                  dense or sparse
            'dt' : bin size for spike matrix
            'dt_stim' : time between stimulus frames
+           'holdout' : (optional) range of time bins whose spikes are left
+                       out of the STA, as in the training data of
+                       utils.io.kfold_splits
     stim : stimulus at sampling interval data['dt_stim']
     L    : length of the STA in bins of size data['dt']
     """
@@ -18,7 +24,7 @@ def sta(stim, data, L, Ns=None):
     D_stim = stim.shape[1]
     # Compute the STA in chunks
     maxchunk = 1e8
-    chunksz = maxchunk//D_stim//L
+    chunksz = int(maxchunk//D_stim//L)
 
     # Interpolate stimulus at the resolution of the data
     S = data['S']
@@ -44,8 +50,6 @@ def sta(stim, data, L, Ns=None):
                        istim))
 
 
-    A = np.zeros((len(Ns),L,D_stim))
-
     # Only compute STA for the specified neurons Ns
     if Ns is None:
         Ns = range(N)
@@ -53,7 +57,14 @@ def sta(stim, data, L, Ns=None):
     if isinstance(Ns, int):
         Ns = [Ns]
 
-    for chunk in np.arange(np.ceil(float(nt)/chunksz)):
+    A = np.zeros((len(Ns),L,D_stim))
+    # Number of spikes averaged for each neuron
+    n_spks = np.zeros(len(Ns))
+
+    # The spikes of the held out bins are not averaged
+    holdout = data.get('holdout', None)
+
+    for chunk in np.arange(int(np.ceil(float(nt)/chunksz))):
         print "Chunk %d" % chunk
         start = chunk*chunksz
         end = min((chunk+1)*chunksz, nt)
@@ -67,7 +78,11 @@ def sta(stim, data, L, Ns=None):
             # np.vstack((np.zeros((l,D_stim)),istim[start:end-l,:]))
 
         for i,n in enumerate(Ns):
-            Sn = S[start:end,n]
+            Sn = np.ravel(as_dense_spikes(S[start:end,n])).astype(np.float64)
+            if holdout is not None:
+                (h_start, h_stop) = holdout
+                Sn[max(h_start-start, 0):max(h_stop-start, 0)] = 0
+            n_spks[i] += Sn.sum()
             # Aflat += np.sum(stim_lag[Sn,:],axis=0)
             Aflat = np.dot(Sn, stim_lag)
 
@@ -78,7 +93,7 @@ def sta(stim, data, L, Ns=None):
 
     # Normalize
     for i,n in enumerate(Ns):
-        A[i,:,:] /= np.sum(S[:,n])
+        A[i,:,:] /= n_spks[i]
 
     # Flip the result so that the first column is the most recent stimulus frame
     #A = A[:,::-1,:]
@@ -0,0 +1,66 @@
+""" Account for the time a command line entry point spends starting up:
+    importing modules, building the model and its symbolic graphs, and
+    compiling Theano functions. Time is measured from the start of the
+    process where the operating system reports it (Linux), so the module
+    may be imported anywhere. Elsewhere it is measured from the import of
+    this module.
+
+    Only plotting is loaded lazily. Everything that builds a Population,
+    including data generation, still imports Theano, because simulating
+    evaluates the model's Theano expressions.
+"""
+import os
+import sys
+import time
+
+def _process_start_time():
+    """ Get the wall clock time at which the process started, or the
+        current time if it is not available.
+    """
+    try:
+        with open('/proc/self/stat') as f:
+            # The fields after the command name, which may contain spaces
+            fields = f.read().rsplit(')', 1)[1].split()
+        with open('/proc/uptime') as f:
+            uptime = float(f.read().split()[0])
+        # The start time since boot is the 22nd field, in clock ticks
+        start = float(fields[19]) / os.sysconf('SC_CLK_TCK')
+        return time.time() - uptime + start
+    except (IOError, OSError, ValueError, IndexError):
+        return time.time()
+
+_t_start = _process_start_time()
+_phases = []
+
+def _compile_time():
+    """ Get the total compile time of the function registry, without
+        importing the backend if it has not been loaded.
+    """
+    wrapper = sys.modules.get('utils.theano_func_wrapper')
+    if wrapper is None:
+        return 0.0
+    return wrapper.get_registry().compile_time
+
+def mark(phase):
+    """ End the current phase of startup and give it a name. Time spent
+        compiling during the phase is reported separately.
+    """
+    _phases.append((phase, time.time(), _compile_time()))
+
+def report():
+    """ Print the time spent in each phase of startup so far
+    """
+    t_now = time.time()
+    c_now = _compile_time()
+
+    rows = []
+    (t_prev, c_prev) = (_t_start, 0.0)
+    for (phase, t, c) in _phases:
+        rows.append((phase, (t-t_prev) - (c-c_prev)))
+        (t_prev, c_prev) = (t, c)
+    rows.append(('other', (t_now-t_prev) - (c_now-c_prev)))
+    rows.append(('compile', c_now))
+
+    print "Startup profile: %.2fs" % (t_now - _t_start)
+    for (phase, dt) in rows:
+        print "  %-12s %6.2fs" % (phase, dt)
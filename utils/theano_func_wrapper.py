@@ -1,13 +1,193 @@
 """ Helper function to abstract the creation of Theano functions for
     symbolic variables.
 """
+import time
 import theano
 import numpy as np
-import hashlib
+
+class CompiledExpression(object):
+    """ A Theano function compiled once for a given expression and a given
+        layout of symbolic inputs. Callers that evaluate the same expression
+        many times should hold onto this handle and call it directly, which
+        bypasses the registry lookup altogether.
+
+    If a DiskFunctionCache is given, the function is loaded from (or saved
+    to) disk. Expressions with givens are always compiled.
+    """
+    def __init__(self, expr, syms, givens=[], cache=None):
+        if isinstance(expr, tuple):
+            expr = list(expr)
+        self.expr = expr
+        self.syms = syms
+        self.givens = givens
+        self.sargs = _flatten(syms)
+        self.plan = AccessorPlan(syms)
+
+        # Create a callable theano function
+        if len(givens) == 0 and cache is not None:
+            self.f = cache.function(self.sargs, expr)
+        elif len(givens) == 0:
+            self.f = theano.function(self.sargs, expr,
+                                     on_unused_input='ignore')
+        else:
+            self.f = theano.function(self.sargs, expr,
+                                     givens=givens,
+                                     on_unused_input='ignore')
+
+    def __call__(self, vals, defaults=None):
+        """ Evaluate the expression given a dictionary of values whose key
+            structure mimics that of syms.
+        """
+        args = self.plan.extract(vals, defaults)
+        return self.f(*args)
+
+class AccessorPlan(object):
+    """ A precompiled list of key paths into a hierarchical dictionary of
+        symbolic variables. The paths are sorted once, in the same order as
+        _flatten, so that extracting the positional arguments for a
+        dictionary of values requires neither sorting nor exception handling.
+    """
+    def __init__(self, syms):
+        self.paths = _key_paths(syms)
+
+    def __len__(self):
+        return len(self.paths)
+
+    def extract(self, vals, defaults=None):
+        """ Extract corresponding values for each path in the plan
+        """
+        args = []
+        for path in self.paths:
+            v = _lookup(vals, path)
+            if v is None and defaults is not None:
+                v = _lookup(defaults, path)
+            if v is None:
+                raise Exception("Key %s not found in either vals or defaults!" % \
+                                '/'.join(map(str, path)))
+            args.append(v)
+        return args
+
+def _key_paths(d, prefix=()):
+    """ Get the list of key paths to the leaves of a hierarchical dictionary.
+        The order matches that of _flatten.
+    """
+    paths = []
+    # This sorting is important!
+    for (k,v) in sorted(d.items(), key=lambda t: t[0]):
+        if isinstance(v, dict):
+            paths.extend(_key_paths(v, prefix + (k,)))
+        else:
+            paths.append(prefix + (k,))
+    return paths
+
+def _lookup(d, path):
+    """ Follow a key path into a hierarchical dictionary. Return None if
+        the path does not exist.
+    """
+    for k in path:
+        if not isinstance(d, dict) or k not in d:
+            return None
+        d = d[k]
+    return d
+
+class FunctionRegistry(object):
+    """ Registry of compiled expressions. Each (expression, symbol layout,
+        givens) triple is compiled at most once. Lookups are keyed on the
+        identity of the Theano variables, so expressions without givens
+        require no hashing of values or scanning of the cache. The values of
+        givens are bound at compile time, so arrays among them are keyed on
+        a digest of their contents.
+    """
+    def __init__(self):
+        self._handles = {}
+        self.hits = 0
+        self.misses = 0
+        self.compile_time = 0.0
+        self.cache = None
+
+    def get(self, expr, syms, givens=[]):
+        """ Get a handle to the compiled expression, compiling it if necessary.
+            Givens are bound at compile time, and an expression is compiled
+            again for every distinct content of their array values.
+
+        The expression may also be a list of expressions, e.g. a value and
+        its gradient, which are then compiled into a single function so
+        that shared subexpressions are only computed once per call.
+        """
+        expr_key = tuple(map(id, expr)) if isinstance(expr, (list, tuple)) \
+                   else id(expr)
+        key = (expr_key,
+               tuple(map(id, _flatten(syms))),
+               tuple(map(lambda (k,v): (id(k), _given_key(v)), givens)))
+        f = self._handles.get(key)
+        if f is None:
+            self.misses += 1
+            start = time.time()
+            f = CompiledExpression(expr, syms, givens, self.cache)
+            self.compile_time += time.time() - start
+            self._handles[key] = f
+        else:
+            self.hits += 1
+        return f
+
+    def stats(self):
+        """ Get the hit and miss counts of the registry
+        """
+        return {'hits' : self.hits,
+                'misses' : self.misses,
+                'size' : len(self._handles),
+                'compile_time' : self.compile_time}
+
+    def clear(self):
+        """ Remove all compiled expressions and reset the counts
+        """
+        self._handles = {}
+        self.hits = 0
+        self.misses = 0
+        self.compile_time = 0.0
+
+    def __str__(self):
+        s = "FunctionRegistry: %d hits, %d misses, %d compiled expressions " \
+            "in %.2fs" % (self.hits, self.misses, len(self._handles),
+                          self.compile_time)
+        if self.cache is not None:
+            s += "\n" + str(self.cache)
+        return s
+
+def _given_key(v):
+    """ Key of the value of a given: arrays are keyed on their contents,
+        which are bound into the compiled function, and Theano variables
+        and scalars on themselves.
+    """
+    if isinstance(v, np.ndarray):
+        from utils.data_cache import array_digest
+        return array_digest(v)
+    return v
 
 # It is expensive to create the Theano functions, so once we've done it
-# we cache the results for future calls
-_func_cache = {}
+# we keep the results for future calls
+_registry = FunctionRegistry()
+
+def get_registry():
+    """ Get the global registry of compiled expressions
+    """
+    return _registry
+
+def enable_disk_cache(cache_dir, model):
+    """ Load compiled functions for the given model from cache_dir, and save
+        newly compiled functions there. Functions which are already in the
+        registry are unaffected.
+    """
+    from utils.function_cache import DiskFunctionCache
+    _registry.cache = DiskFunctionCache(cache_dir, model)
+    return _registry.cache
+
+def compile_expr(expr, syms, givens=[]):
+    """ Compile the symbolic expression for the given layout of symbolic
+        variables and return a callable handle. The handle takes a dictionary
+        of values (and optionally defaults) just like seval.
+    """
+    return _registry.get(expr, syms, givens)
 
 def seval(expr, syms, vals, defaults=None, givens=[]):
     """
@@ -17,42 +197,17 @@ def seval(expr, syms, vals, defaults=None, givens=[]):
     syms : dictionary of symbolic variables
     vals : dictionary of values to assign to the symbolic vars in syms
            key structure should mimic that of syms
-    
-    defaults : an optional dictionary providing backup values for 
+
+    defaults : an optional dictionary providing backup values for
                syms keys not found in vals.
     """
     # Look for a function handle corresponding to this expression with these givens
-    hash_value = lambda v: hashlib.sha1(v).hexdigest() if \
-                           isinstance(v, np.ndarray) else v
-    hashable_givens = tuple(map(lambda (k,v): (k, hash_value(v)), givens))
-    hashable_syms = tuple(map(lambda v: hash_value(v), _flatten(syms)))
-    key = (expr, hashable_syms, hashable_givens)
-    if key in _func_cache.keys():
-        #print "DBG: Found key %s in cache" % str(key)
-        f = _func_cache[key]
-        #print "DBG: Calling expr: %s" % str(expr)
-    else:
-        # Create a callable theano function and cache it
-        #print "DBG: Compiling expr: %s" % str(expr)
-        sargs = _flatten(syms)
-        if len(givens) == 0:
-            #print "DBG: Compiling expression %s with no givens" % expr
-            f = theano.function(sargs, expr,
-                                on_unused_input='ignore')
-        else:
-            #print "DBG: Compiling expression %s with givens: %s" % (expr, str(givens))
-            f = theano.function(sargs, expr,
-                                givens=givens,
-                                on_unused_input='ignore')
-        _func_cache[key] = f
-    
-    # Easiest thing to do is call the function with all symbolic variables
-    args = _extract_vals(syms,vals,defaults)
-    return f(*args) 
+    f = _registry.get(expr, syms, givens)
+    return f(vals, defaults)
 
 def _flatten(d):
     """ Pack a hierarchical dictionary of variables into a list
-        Sorting is important as it ensures the function is called with 
+        Sorting is important as it ensures the function is called with
         the inputs in the same order each time!
     """
     l = []
@@ -80,7 +235,7 @@ def _extract_vals(syms, vals, defaults=None):
         except Exception as e:
             # sk is not in vals
             pass
-        
+
         # Also look in defaults
         vd = None
         try:
@@ -101,5 +256,5 @@ def _extract_vals(syms, vals, defaults=None):
             # Otherwise, append the value to the list
             v = vv if (vv is not None) else vd
             l.append(v)
-        
+
     return l